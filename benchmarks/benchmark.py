@@ -0,0 +1,205 @@
+'''
+    benchmark.py
+
+    Throughput benchmarks of inventory, snapshot, download, mapping and publish against local mock servers.
+    Every scale runs the phases in order on a fresh filesystem_path and reports objects/sec,
+    bytes/sec and request counts per phase, optionally saved as JSON to compare runs.
+
+    python -m benchmarks.benchmark -scales 10,1000,10000 -latency 0.005 -download_workers 4
+'''
+import argparse
+import contextlib
+import csv
+import json
+import os
+import sys
+import tempfile
+import time
+import tableauserverclient as TSC
+from tabpymigrate import config
+from tabpymigrate.inventory import get_inventory_counts, refresh_inventory
+from tabpymigrate.mapping import update_flow_mapping, update_workbook_mapping
+from tabpymigrate.projects import build_project_index, get_project_index
+from tabpymigrate.query import get_items
+from tabpymigrate.tabpymigrate_download import (DATASOURCE_FIELDS, FLOW_FIELDS, WORKBOOK_FIELDS, get_request_options,
+                                                get_workbook_views, tabpymigrate_download)
+from tabpymigrate.tabpymigrate_publish import tabpymigrate_publish
+from tabpymigrate.transport import get_server, sign_in
+from .mock_server import MockSite, MockTableauServer
+
+USERNAME = 'admin'
+PASSWORD = 'admin'
+TAG_NAME = 'migrate'
+PHASES = ['inventory', 'snapshot', 'snapshot_refresh', 'download', 'mapping', 'publish']
+
+
+@contextlib.contextmanager
+def quiet(verbose=False):
+    # The download and publish print every object, which would dominate the timings at scale
+    if verbose:
+        yield
+        return
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def measure(phase, scale, function, mock_server=None, byte_stat='BytesSent'):
+    '''
+    Run function() which returns (objects, errors, local_bytes) and time it.
+    Bytes are the mock server byte_stat of the phase, or local_bytes for phases without server calls.
+    '''
+    if mock_server is not None:
+        mock_server.reset_stats()
+    start = time.perf_counter()
+    objects, errors, local_bytes = function()
+    seconds = time.perf_counter() - start
+    stats = mock_server.get_stats() if mock_server is not None else {'Requests': 0, 'ByRoute': {}}
+    size = stats[byte_stat] if mock_server is not None else local_bytes
+    return {'Scale': scale,
+            'Phase': phase,
+            'Objects': objects,
+            'Errors': errors,
+            'Seconds': round(seconds, 3),
+            'Bytes': size,
+            'Requests': stats['Requests'],
+            'ObjectsPerSecond': round(objects / seconds, 1) if seconds else None,
+            'BytesPerSecond': round(size / seconds) if seconds else None,
+            'RequestsByRoute': stats['ByRoute']}
+
+
+def run_inventory(server_address, page_size, workers):
+    # List projects, tagged objects and their views the way the download does
+    server = get_server(server_address, workers=workers)
+    with sign_in(server, TSC.TableauAuth(USERNAME, PASSWORD)):
+        objects = len(get_project_index(server, page_size=page_size)['ById'])
+        for endpoint, fields in ((server.flows, FLOW_FIELDS), (server.datasources, DATASOURCE_FIELDS)):
+            objects += sum(1 for _ in get_items(endpoint, get_request_options(TAG_NAME, fields=fields,
+                                                                              page_size=page_size)))
+        workbooks = list(get_items(server.workbooks, get_request_options(TAG_NAME, fields=WORKBOOK_FIELDS,
+                                                                         page_size=page_size)))
+        workbook_views = get_workbook_views(server, workbooks, page_size=page_size)
+        objects += len(workbooks) + sum(len(views) for views in workbook_views.values())
+    return objects, 0, 0
+
+
+def run_snapshot(server_address, filesystem_path, page_size, workers):
+    # Take the inventory snapshot of the site, or refresh the one already in filesystem_path
+    server = get_server(server_address, workers=workers)
+    with sign_in(server, TSC.TableauAuth(USERNAME, PASSWORD)):
+        inventory = refresh_inventory(server, filesystem_path, page_size=page_size, workers=workers)
+    return sum(get_inventory_counts(inventory).values()), 0, 0
+
+
+def count_results(results, stage):
+    if isinstance(results, str):
+        raise RuntimeError(results)
+    successes = results.get_total(stage, "Success")
+    return successes, results.get_total(stage) - successes, 0
+
+
+def run_download(server_address, filesystem_path, page_size, workers):
+    _, results = tabpymigrate_download(server_address=server_address, username=USERNAME, password=PASSWORD,
+                                       filesystem_path=filesystem_path, tag_name=TAG_NAME,
+                                       page_size=page_size, download_workers=workers, incremental=False)
+    return count_results(results, 'download')
+
+
+def run_mapping(target_server, filesystem_path):
+    # Map the downloaded flows and workbooks to the target, reading the files without any server calls
+    project_index = build_project_index((project['Id'], project['Name'], project['ParentId'])
+                                        for project in target_server.site.project_list())
+    objects, errors, size = 0, 0, 0
+    for csv_name in ('flows.csv', 'workbooks.csv'):
+        with open(os.path.join(filesystem_path, csv_name), 'r', newline='') as csvfile:
+            for row in csv.DictReader(csvfile):
+                if row['Response'] != "Success":
+                    continue
+                try:
+                    if row['Type'] == 'Flow':
+                        update_flow_mapping(row, target_server.url, project_index, filesystem_path)
+                    else:
+                        update_workbook_mapping(row['Path'], target_server.url, row['ProjectName'], filesystem_path,
+                                                object_id=row['Id'])
+                    objects += 1
+                    size += os.path.getsize(row['Path'])
+                except Exception as e:
+                    print("Error in mapping:", row['Path'], str(e), file=sys.stderr)
+                    errors += 1
+    return objects, errors, size
+
+
+def run_publish(server_address, filesystem_path, workers):
+    _, results = tabpymigrate_publish(server_address, username=USERNAME, password=PASSWORD,
+                                      filesystem_path=filesystem_path, publish_workers=workers)
+    return count_results(results, 'publish')
+
+
+def run_scale(scale, args):
+    '''
+    Run every phase at one scale: the source mock holds scale objects, the target mock the same project tree.
+    '''
+    source_site = MockSite(scale, tag_name=TAG_NAME, file_size=args.file_size, seed=args.seed)
+    target_site = MockSite(0, project_count=len(source_site.items['projects']), file_size=0)
+    server_options = {'latency': args.latency, 'bandwidth': args.bandwidth, 'max_page_size': args.max_page_size,
+                      'failure_rate': args.failure_rate, 'token_lifetime': args.token_lifetime,
+                      'username': USERNAME, 'password': PASSWORD, 'seed': args.seed}
+    results = []
+    with MockTableauServer(source_site, **server_options) as source_server, \
+            MockTableauServer(target_site, **server_options) as target_server, \
+            tempfile.TemporaryDirectory(prefix='tabpymigrate_benchmark_') as filesystem_path, \
+            quiet(args.verbose):
+        results.append(measure('inventory', scale, lambda: run_inventory(source_server.url, args.page_size,
+                                                                         args.download_workers), source_server))
+        for phase in ('snapshot', 'snapshot_refresh'):
+            results.append(measure(phase, scale, lambda: run_snapshot(source_server.url, filesystem_path, args.page_size,
+                                                                      args.inventory_workers), source_server))
+        results.append(measure('download', scale, lambda: run_download(source_server.url, filesystem_path,
+                                                                        args.page_size, args.download_workers),
+                               source_server))
+        results.append(measure('mapping', scale, lambda: run_mapping(target_server, filesystem_path)))
+        results.append(measure('publish', scale, lambda: run_publish(target_server.url, filesystem_path,
+                                                                     args.publish_workers),
+                               target_server, byte_stat='BytesReceived'))
+    return results
+
+
+def print_results(results):
+    columns = ['Scale', 'Phase', 'Objects', 'Errors', 'Seconds', 'ObjectsPerSecond', 'BytesPerSecond', 'Requests']
+    print(''.join(f"{column:>18}" for column in columns))
+    for result in results:
+        print(''.join(f"{str(result[column]):>18}" for column in columns))
+
+
+def benchmark():
+    '''
+    Benchmark function will parse argument and run every scale
+    '''
+    parser = argparse.ArgumentParser(description="TabPyMigrate throughput benchmarks against a local mock server")
+    parser.add_argument("-scales", help="Comma separated object counts, Default to 10,1000,10000", default="10,1000,10000")
+    parser.add_argument("-latency", help="Seconds added to every mock server response, Default to 0", type=float, default=0.0)
+    parser.add_argument("-bandwidth", help="Content bytes per second of the mock server, Default to 0 (unlimited)", type=int, default=0)
+    parser.add_argument("-max_page_size", help="Largest page returned by the mock server, Default to 1000", type=int, default=1000)
+    parser.add_argument("-failure_rate", help="Share of requests answered with 503, Default to 0", type=float, default=0.0)
+    parser.add_argument("-token_lifetime", help="Requests an auth token is valid for, Default to 0 (unlimited)", type=int, default=0)
+    parser.add_argument("-file_size", help="Extract bytes in every generated package, Default to 16384", type=int, default=16 * 1024)
+    parser.add_argument("-page_size", help="Number of objects requested per page, Default to 1000", type=int, default=1000)
+    parser.add_argument("-inventory_workers", help="Number of pages of a snapshot listing fetched concurrently, Default to 8", type=int, default=config.INVENTORY_WORKERS)
+    parser.add_argument("-download_workers", help="Number of objects downloaded in parallel, Default to 1", type=int, default=1)
+    parser.add_argument("-publish_workers", help="Number of objects published in parallel, Default to 1", type=int, default=1)
+    parser.add_argument("-seed", help="Seed of the generated content and failure injection, Default to 0", type=int, default=0)
+    parser.add_argument("-output", help="JSON file the results are written to")
+    parser.add_argument("-verbose", help="Keep the download and publish output", action="store_true")
+    args = parser.parse_args()
+
+    results = []
+    for scale in (int(scale) for scale in args.scales.split(',')):
+        results.extend(run_scale(scale, args))
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'Options': vars(args), 'Results': results}, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,653 @@
+'''
+    mock_server.py
+
+    Local stand-in for the Tableau Server REST API used by the benchmarks. It serves sign-in,
+    paged and filtered listing of projects, flows, datasources, workbooks and views, content
+    download, publish as one multipart request or through file-upload sessions, extract refresh
+    jobs and the Metadata API connections listings verification reads.
+    Latency, bandwidth, the server page size cap and failures are configurable, and every
+    request is counted so runs can be compared by request count as well as by time.
+'''
+import io
+import json
+import random
+import re
+import threading
+import time
+import uuid
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from xml.sax.saxutils import escape, quoteattr, unescape
+
+NAMESPACE = 'http://tableau.com/api'
+PRODUCT_VERSION = '2023.3.0'
+REST_API_VERSION = '3.21'
+
+# Error code of the REST API for a missing, invalid or expired auth token
+TOKEN_EXPIRED_CODE = '401002'
+
+CONTENT_TYPES = ['flows', 'datasources', 'workbooks']
+
+# Fields expressions of the listings, items are trimmed to the requested fields and other field names
+# are rejected as by the server; related resources are requested as project.id, project.name, ...
+LIST_FIELDS = {'projects': {'id', 'name', 'parentProjectId'},
+               'flows': {'id', 'name', 'updatedAt', 'createdAt', 'contentUrl', 'project.id', 'project.name',
+                         'owner.id', 'tags'},
+               'datasources': {'id', 'name', 'updatedAt', 'createdAt', 'contentUrl', 'project.id', 'project.name',
+                               'owner.id', 'tags'},
+               'workbooks': {'id', 'name', 'updatedAt', 'createdAt', 'contentUrl', 'project.id', 'project.name',
+                             'owner.id', 'tags', 'showTabs', 'size'},
+               'views': {'id', 'name', 'updatedAt', 'contentUrl', 'workbook.id', 'owner.id', 'project.id'}}
+# Field lists standing for all the fields of the default listing
+DEFAULT_FIELD_LISTS = ['', '_default_', '_all_']
+FILE_EXTENSIONS = {'flows': 'tflx', 'datasources': 'tdsx', 'workbooks': 'twbx'}
+ITEM_TAGS = {'projects': 'project', 'flows': 'flow', 'datasources': 'datasource',
+             'workbooks': 'workbook', 'views': 'view'}
+
+# Number of distinct datasources the generated flows and workbooks read from
+REFERENCED_DATASOURCES = 10
+
+API_PATH = r'/api/[^/]+'
+SITE_PATH = API_PATH + r'/sites/[^/]+'
+ROUTES = [
+    ('GET', re.compile(API_PATH + r'/serverInfo$'), 'server_info'),
+    ('POST', re.compile(API_PATH + r'/auth/signin$'), 'sign_in'),
+    ('POST', re.compile(API_PATH + r'/auth/signout$'), 'sign_out'),
+    ('GET', re.compile(SITE_PATH + r'/(projects|flows|datasources|workbooks|views)$'), 'list'),
+    ('GET', re.compile(SITE_PATH + r'/workbooks/([^/]+)/views$'), 'workbook_views'),
+    ('GET', re.compile(SITE_PATH + r'/(flows|datasources|workbooks)/([^/]+)/content$'), 'download'),
+    ('GET', re.compile(SITE_PATH + r'/(flows|datasources|workbooks)/([^/]+)$'), 'get_item'),
+    ('POST', re.compile(SITE_PATH + r'/(flows|datasources|workbooks)$'), 'publish'),
+    ('POST', re.compile(SITE_PATH + r'/(datasources|workbooks)/([^/]+)/refresh$'), 'refresh'),
+    ('GET', re.compile(SITE_PATH + r'/jobs/([^/]+)$'), 'get_job'),
+    ('POST', re.compile(SITE_PATH + r'/projects$'), 'create_project'),
+    ('POST', re.compile(SITE_PATH + r'/fileUploads$'), 'initiate_upload'),
+    ('PUT', re.compile(SITE_PATH + r'/fileUploads/([^/]+)$'), 'append_upload'),
+    ('POST', re.compile(r'/api/metadata/graphql$'), 'metadata'),
+]
+
+ITEM_NAME = re.compile(rb'<(?:flow|datasource|workbook)\b[^>]*?\sname="([^"]*)"')
+PROJECT_ID = re.compile(rb'<project\b[^>]*?\sid="([^"]*)"')
+HIDDEN_VIEW = re.compile(rb'<view\b[^>]*?\sname="([^"]*)"[^>]*?\shidden="true"')
+WORKSHEET_NAME = re.compile(r'<worksheet name=("[^"]*"|\'[^\']*\')')
+UPLOAD_FILE_PART = re.compile(rb'name="tableau_file"; filename="[^"]*"\r\nContent-Type: [^\r]*\r\n\r\n(.*)\r\n--', re.S)
+
+# Data sources with a connection in a .twb, connection tags in a .tds, extract elements of a .tds
+TWB_CONNECTED_DATASOURCE = re.compile(r'<datasource\b[^>]*>(?:(?!</datasource>).)*?<connection[\s/>]', re.S)
+TDS_CONNECTION = re.compile(r'<connection\s[^>]*>')
+TDS_EXTRACT = re.compile(r'<extract\b.*?</extract>', re.S)
+XML_ATTRIBUTE = re.compile(r'([\w:.-]+)=(["\'])(.*?)\2', re.S)
+
+# Metadata API listings by content type, their upstream fields are lists of {id} nodes
+METADATA_LISTINGS = {'flowsConnection': 'flows', 'publishedDatasourcesConnection': 'datasources',
+                     'workbooksConnection': 'workbooks'}
+METADATA_FIELD = re.compile(r'\b(upstreamDatasources|upstreamDatabases|embeddedDatasources)\b')
+
+
+def get_timestamp(offset_seconds=0):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() - offset_seconds))
+
+
+def get_published_view_names(body):
+    # Worksheets of the workbook package in a publish request less its hidden views, None without a package
+    try:
+        with zipfile.ZipFile(io.BytesIO(body)) as zip_file:
+            twb = next(zip_file.read(name) for name in zip_file.namelist() if name.endswith('.twb')).decode()
+    except (zipfile.BadZipFile, StopIteration):
+        return None
+    hidden_views = {unescape(name.decode(), {'&quot;': '"'}) for name in HIDDEN_VIEW.findall(body)}
+    view_names = [unescape(name[1:-1], {'&quot;': '"', '&apos;': "'"}) for name in WORKSHEET_NAME.findall(twb)]
+    return [name for name in view_names if name not in hidden_views]
+
+
+def get_connection_count(item_type, content):
+    # Connections of a package as the Metadata API lists them: the embedded datasources of a workbook,
+    # the distinct databases of a datasource, the database connections and input datasources of a flow
+    try:
+        with zipfile.ZipFile(io.BytesIO(content)) as zip_file:
+            extension = {'flows': 'flow', 'datasources': '.tds', 'workbooks': '.twb'}[item_type]
+            member = next(zip_file.read(name) for name in zip_file.namelist() if name.endswith(extension)).decode()
+    except (zipfile.BadZipFile, StopIteration):
+        return 0
+    if item_type == 'workbooks':
+        return len(TWB_CONNECTED_DATASOURCE.findall(member))
+    if item_type == 'datasources':
+        databases = set()
+        for tag in TDS_CONNECTION.findall(TDS_EXTRACT.sub('', member)):
+            attributes = {match.group(1): match.group(3) for match in XML_ATTRIBUTE.finditer(tag)}
+            if attributes.get('class') != 'federated':
+                databases.add((attributes.get('class'), attributes.get('server'), attributes.get('dbname')))
+        return len(databases)
+    flow_content = json.loads(member)
+    inputs = {node.get('datasourceName') or node.get('name') for node in flow_content.get('nodes', {}).values()
+              if node.get('nodeType', '').endswith('LoadSqlProxy')}
+    return len(flow_content.get('connections', {})) + len(inputs)
+
+
+def split_filter(filter_expression):
+    # Split "field:op:value,field:op:[a,b]" on the commas outside of brackets
+    parts, part, depth = [], '', 0
+    for character in filter_expression:
+        if character == ',' and depth == 0:
+            parts.append(part)
+            part = ''
+            continue
+        depth += {'[': 1, ']': -1}.get(character, 0)
+        part += character
+    if part:
+        parts.append(part)
+    return [part.split(':', 2) for part in parts]
+
+
+def match_filter(item, field, operator, value):
+    if field == 'tags':
+        return value in item['Tags']
+    item_value = {'name': item['Name'], 'projectName': item.get('ProjectName'), 'ownerName': item.get('OwnerName'),
+                  'updatedAt': item.get('UpdatedAt'), 'workbookName': item.get('WorkbookName'),
+                  'parentProjectId': item.get('ParentId')}.get(field)
+    if operator == 'eq':
+        return item_value == value
+    if operator == 'in':
+        return item_value in value.strip('[]').split(',')
+    if operator == 'gte':
+        return item_value is not None and item_value >= value
+    if operator == 'lte':
+        return item_value is not None and item_value <= value
+    raise ValueError(f"Unsupported filter operator: {operator}")
+
+
+def build_archive(members, padding):
+    # Zip package of the given members plus a stored padding member standing in for extract data
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for name, content in members.items():
+            zip_file.writestr(name, content)
+        if padding:
+            zip_file.writestr('Data/Extracts/extract.hyper', padding, compress_type=zipfile.ZIP_STORED)
+    return archive.getvalue()
+
+
+def build_flow_file(datasource_name, project_name, source_address, padding):
+    flow_content = {'nodes': {
+        'input': {'nodeType': '.v1.LoadSqlProxy', 'name': datasource_name, 'datasourceName': datasource_name,
+                  'serverUrl': source_address, 'projectLuid': str(uuid.uuid4()), 'projectName': project_name},
+        'output': {'nodeType': '.v1.PublishExtract', 'name': 'Output', 'serverUrl': source_address,
+                   'projectLuid': str(uuid.uuid4()), 'projectName': project_name}}}
+    return build_archive({'flow': json.dumps(flow_content), 'displaySettings': '{}'}, padding)
+
+
+# Extract definition of the datasources and workbooks, kept when downloaded without the extract data
+EXTRACT_XML = "<extract enabled='true'><connection class='hyper' dbname='Data/Extracts/extract.hyper'/></extract>"
+
+
+def build_datasource_file(source_address, padding):
+    tds = ("<?xml version='1.0' encoding='utf-8' ?>\n<datasource formatted-name='extract' version='18.1'>"
+           f"<connection class='postgres' dbname='warehouse' server='{source_address}' port='5432' username='etl'/>"
+           f"{EXTRACT_XML}</datasource>")
+    return build_archive({'datasource.tds': tds}, padding)
+
+
+def build_workbook_file(datasource_name, source_address, view_names, padding):
+    worksheets = ''.join(f"<worksheet name={quoteattr(name)}><table/></worksheet>" for name in view_names)
+    twb = ("<?xml version='1.0' encoding='utf-8' ?>\n<workbook version='18.1'><datasources>"
+           f"<datasource caption={quoteattr(datasource_name)} name='sqlproxy.0'>"
+           f"<repository-location id={quoteattr(datasource_name)} path='/datasources'/>"
+           f"<connection class='sqlproxy' dbname={quoteattr(datasource_name)} server='{source_address}'"
+           f" port='443' username=''/>{EXTRACT_XML}</datasource></datasources>"
+           f"<worksheets>{worksheets}</worksheets></workbook>")
+    return build_archive({'workbook.twb': twb}, padding)
+
+
+class MockSite(object):
+    '''
+    Content of the mock site: a nested project tree and tagged flows, datasources and workbooks.
+    object_count is split 20/40/40 between flows, datasources and workbooks.
+    '''
+
+    def __init__(self, object_count=0, tag_name='migrate', project_count=None, views_per_workbook=3,
+                 file_size=16 * 1024, source_address='source.example.com', seed=0):
+        self.tag_name = tag_name
+        self.file_size = file_size
+        self.source_address = source_address
+        self.items = {item_type: {} for item_type in ITEM_TAGS}
+        self._padding = random.Random(seed).getrandbits(8 * file_size).to_bytes(file_size, 'little') if file_size else b''
+        self._content_cache = {}
+        self._lock = threading.Lock()
+
+        project_count = project_count if project_count is not None else max(1, object_count // 100)
+        for index in range(project_count):
+            # Every fourth project is top level, the others nest under the latest top level project
+            parent = None if index % 4 == 0 else self.project_list()[index - index % 4]
+            self.add_project(f"Project {index:05d}", parent['Id'] if parent else None)
+
+        flow_count = object_count // 5
+        datasource_count = (object_count * 2) // 5
+        workbook_count = object_count - flow_count - datasource_count
+        projects = self.project_list()
+        for item_type, count in (('flows', flow_count), ('datasources', datasource_count),
+                                 ('workbooks', workbook_count)):
+            for index in range(count):
+                project = projects[index % len(projects)]
+                name = f"{ITEM_TAGS[item_type].capitalize()} {index:05d}"
+                item = self.add_item(item_type, name, project['Id'], tags=[tag_name], updated_ago=index)
+                if item_type == 'workbooks':
+                    for view_index in range(views_per_workbook):
+                        self.add_view(item, f"Sheet {view_index + 1}")
+
+    def project_list(self):
+        return list(self.items['projects'].values())
+
+    def add_project(self, name, parent_id=None):
+        project = {'Id': str(uuid.uuid4()), 'Name': name, 'ParentId': parent_id, 'Tags': []}
+        with self._lock:
+            self.items['projects'][project['Id']] = project
+        return project
+
+    def add_item(self, item_type, name, project_id, tags=(), updated_ago=0, size=None):
+        project = self.items['projects'][project_id]
+        item = {'Id': str(uuid.uuid4()), 'Name': name, 'ProjectId': project_id, 'ProjectName': project['Name'],
+                'OwnerId': 'owner', 'OwnerName': 'admin', 'Tags': list(tags), 'UpdatedAt': get_timestamp(updated_ago),
+                'Size': size, 'Views': []}
+        with self._lock:
+            self.items[item_type][item['Id']] = item
+        return item
+
+    def add_view(self, workbook, name):
+        view = {'Id': str(uuid.uuid4()), 'Name': name, 'WorkbookId': workbook['Id'], 'WorkbookName': workbook['Name'],
+                'ProjectId': workbook['ProjectId'], 'OwnerId': workbook['OwnerId'], 'Tags': [],
+                'UpdatedAt': workbook['UpdatedAt']}
+        with self._lock:
+            self.items['views'][view['Id']] = view
+            workbook['Views'].append(view)
+        return view
+
+    def get_datasource_name(self, index):
+        datasource_count = min(len(self.items['datasources']), REFERENCED_DATASOURCES)
+        return f"Datasource {index % max(datasource_count, 1):05d}"
+
+    def get_content(self, item_type, item, include_extract=True):
+        # Generated packages are cached per referenced datasource, so memory stays flat at any scale
+        index = int(item['Name'].rsplit(' ', 1)[-1]) if item['Name'][-1:].isdigit() else 0
+        datasource_name = self.get_datasource_name(index)
+        view_names = tuple(view['Name'] for view in item['Views'])
+        key = (item_type, datasource_name, item['ProjectName'], view_names, include_extract)
+        content = self._content_cache.get(key)
+        if content is None:
+            # The padding stands in for the extract data, left out when downloaded without it
+            padding = self._padding if include_extract or item_type == 'flows' else b''
+            if item_type == 'flows':
+                content = build_flow_file(datasource_name, item['ProjectName'], self.source_address, padding)
+            elif item_type == 'datasources':
+                content = build_datasource_file(self.source_address, padding)
+            else:
+                content = build_workbook_file(datasource_name, self.source_address, view_names, padding)
+            self._content_cache[key] = content
+        return content
+
+    def get_connection_count(self, item_type, item):
+        # Items added to the site and not published have the connections of their generated package
+        if item.get('Connections') is None:
+            item['Connections'] = get_connection_count(item_type, self.get_content(item_type, item))
+        return item['Connections']
+
+    def publish_item(self, item_type, name, project_id, size, view_names=None, connection_count=None):
+        # Publishing overwrites an item with the same name in the project, keeping its id
+        with self._lock:
+            item = next((item for item in self.items[item_type].values()
+                         if item['Name'] == name and item['ProjectId'] == project_id), None)
+            if item is not None:
+                item['UpdatedAt'] = get_timestamp()
+                item['Size'] = size
+                item['Connections'] = connection_count
+        if item is None:
+            item = self.add_item(item_type, name, project_id, size=size)
+            item['Connections'] = connection_count
+        # The views of a workbook are created again from the published sheets
+        if item_type == 'workbooks' and view_names is not None:
+            with self._lock:
+                for view in item['Views']:
+                    self.items['views'].pop(view['Id'], None)
+                item['Views'] = []
+            for view_name in view_names:
+                self.add_view(item, view_name)
+        return item
+
+
+def get_item_xml(item_type, item, fields=None):
+    # Item element with the given fields, all the fields of the default listing when fields is None
+    fields = LIST_FIELDS[item_type] if fields is None else fields
+    tag = ITEM_TAGS[item_type]
+    if item_type == 'projects':
+        attributes = {'id': item['Id'], 'name': item['Name'], 'parentProjectId': item['ParentId']}
+    else:
+        attributes = {'id': item['Id'], 'name': item['Name'], 'updatedAt': item['UpdatedAt']}
+        if item_type == 'views':
+            attributes['contentUrl'] = f"{item['WorkbookName']}/sheets/{item['Name']}"
+        else:
+            attributes.update(createdAt=item['UpdatedAt'], contentUrl=item['Name'].replace(' ', ''))
+        if item_type == 'workbooks':
+            attributes.update(showTabs='true', size=str(item['Size'] or 1))
+    attribute_text = ' '.join(f'{key}={quoteattr(str(value))}' for key, value in attributes.items()
+                              if key in fields and value)
+    if item_type == 'projects':
+        return f"<project {attribute_text}/>"
+
+    children = ''
+    if 'workbook.id' in fields:
+        children += f"<workbook id={quoteattr(item['WorkbookId'])}/>"
+    project_attributes = {'id': item['ProjectId'], 'name': item.get('ProjectName')}
+    project_text = ' '.join(f'{key}={quoteattr(value)}' for key, value in project_attributes.items()
+                            if 'project.' + key in fields and value)
+    if project_text:
+        children += f"<project {project_text}/>"
+    if 'owner.id' in fields:
+        children += f"<owner id={quoteattr(item['OwnerId'])}/>"
+    if 'tags' in fields:
+        children += '<tags>' + ''.join(f"<tag label={quoteattr(tag_label)}/>" for tag_label in item['Tags']) + '</tags>'
+    return f"<{tag} {attribute_text}>{children}</{tag}>"
+
+
+def get_response_xml(body):
+    return f'<?xml version="1.0" encoding="UTF-8"?><tsResponse xmlns="{NAMESPACE}">{body}</tsResponse>'.encode()
+
+
+def get_error_xml(code, summary, detail):
+    return get_response_xml(f'<error code="{code}"><summary>{escape(summary)}</summary>'
+                            f'<detail>{escape(detail)}</detail></error>')
+
+
+class MockTableauServer(object):
+    '''
+    Threaded HTTP server answering the REST calls TabPyMigrate makes, on 127.0.0.1 and a free port.
+
+    Args:
+        site (MockSite): The content served.
+        latency (float): Seconds added to every response.
+        bandwidth (int): Bytes per second for downloaded and uploaded content, 0 for unlimited.
+        max_page_size (int): Largest page the server returns whatever page size is requested.
+        failure_rate (float): Share of authenticated requests answered with 503 and Retry-After: 0.
+        token_lifetime (int): Authenticated requests a token is valid for before 401002, 0 for unlimited.
+        refresh_duration (float): Seconds an extract refresh job runs before it completes successfully.
+        seed (int): Seed of the failure injection.
+    '''
+
+    def __init__(self, site, latency=0.0, bandwidth=0, max_page_size=1000, failure_rate=0.0, token_lifetime=0,
+                 refresh_duration=0.0, username='admin', password='admin', seed=0):
+        self.site = site
+        self.site_id = str(uuid.uuid4())
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.max_page_size = max_page_size
+        self.failure_rate = failure_rate
+        self.token_lifetime = token_lifetime
+        self.refresh_duration = refresh_duration
+        self.credentials = (username, password)
+        self._random = random.Random(seed)
+        self._tokens = {}
+        self._uploads = {}
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.reset_stats()
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), self._get_handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._httpd.server_address[1]}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {'Requests': 0, 'BytesSent': 0, 'BytesReceived': 0, 'InjectedFailures': 0,
+                           'ExpiredTokens': 0, 'ByRoute': {}}
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['ByRoute'] = dict(self._stats['ByRoute'])
+        return stats
+
+    def _count(self, route, bytes_received, bytes_sent):
+        with self._lock:
+            self._stats['Requests'] += 1
+            self._stats['BytesReceived'] += bytes_received
+            self._stats['BytesSent'] += bytes_sent
+            self._stats['ByRoute'][route] = self._stats['ByRoute'].get(route, 0) + 1
+
+    def _throttle(self, size):
+        if self.bandwidth:
+            time.sleep(size / self.bandwidth)
+
+    def _check_auth(self, token):
+        # Returns the error response for a rejected request, or None
+        with self._lock:
+            if self.failure_rate and self._random.random() < self.failure_rate:
+                self._stats['InjectedFailures'] += 1
+                return 503, get_error_xml('503000', 'Service Unavailable', 'Injected failure'), {'Retry-After': '0'}
+            if token not in self._tokens:
+                return 401, get_error_xml(TOKEN_EXPIRED_CODE, 'Signin Error', 'Invalid authentication token'), {}
+            self._tokens[token] += 1
+            if self.token_lifetime and self._tokens[token] > self.token_lifetime:
+                del self._tokens[token]
+                self._stats['ExpiredTokens'] += 1
+                return 401, get_error_xml(TOKEN_EXPIRED_CODE, 'Signin Error', 'Authentication token expired'), {}
+        return None
+
+    def _get_handler(self):
+        mock_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self.handle_request('GET')
+
+            def do_POST(self):
+                self.handle_request('POST')
+
+            def do_PUT(self):
+                self.handle_request('PUT')
+
+            def handle_request(self, method):
+                # The body is always read so the kept-alive connection stays in sync
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                url = urlsplit(self.path)
+                query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                if mock_server.latency:
+                    time.sleep(mock_server.latency)
+
+                route, arguments = 'unknown', ()
+                for route_method, pattern, route_name in ROUTES:
+                    match = pattern.match(url.path)
+                    if route_method == method and match:
+                        route, arguments = route_name, match.groups()
+                        break
+
+                if route not in ('server_info', 'sign_in', 'sign_out', 'unknown'):
+                    rejected = mock_server._check_auth(self.headers.get('X-Tableau-Auth'))
+                    if rejected is not None:
+                        mock_server._count(route, len(body), len(rejected[1]))
+                        return self.send(*rejected)
+                if route == 'unknown':
+                    status, content, headers = 404, get_error_xml('404000', 'Not Found', url.path), {}
+                else:
+                    mock_server._throttle(len(body))
+                    status, content, headers = getattr(mock_server, 'handle_' + route)(query, body, *arguments)
+                mock_server._count(route, len(body), len(content))
+                self.send(status, content, headers)
+
+            def send(self, status, content, headers):
+                self.send_response(status)
+                self.send_header('Content-Type', headers.pop('Content-Type', 'application/xml'))
+                self.send_header('Content-Length', str(len(content)))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+        return Handler
+
+    def handle_server_info(self, query, body):
+        return 200, get_response_xml(f'<serverInfo><productVersion build="20233.0">{PRODUCT_VERSION}</productVersion>'
+                                     f'<restApiVersion>{REST_API_VERSION}</restApiVersion></serverInfo>'), {}
+
+    def handle_sign_in(self, query, body):
+        token = uuid.uuid4().hex
+        with self._lock:
+            self._tokens[token] = 0
+        return 200, get_response_xml(f'<credentials token="{token}"><site id="{self.site_id}" contentUrl=""/>'
+                                     f'<user id="{uuid.uuid4()}"/></credentials>'), {}
+
+    def handle_sign_out(self, query, body):
+        return 204, b'', {}
+
+    def list_items(self, item_type, items, query):
+        fields = None
+        if query.get('fields', '') not in DEFAULT_FIELD_LISTS:
+            fields = set(query['fields'].split(','))
+            unknown_fields = fields - LIST_FIELDS[item_type]
+            if unknown_fields:
+                return 400, get_error_xml('400000', 'Bad Request',
+                                          f"Invalid fields: {','.join(sorted(unknown_fields))}"), {}
+        for field, operator, value in split_filter(query.get('filter', '')):
+            items = [item for item in items if match_filter(item, field, operator, value)]
+        page_size = min(int(query.get('pageSize', 100)), self.max_page_size)
+        page_number = int(query.get('pageNumber', 1))
+        page = items[(page_number - 1) * page_size:page_number * page_size]
+        tag = ITEM_TAGS[item_type]
+        item_xml = ''.join(get_item_xml(item_type, item, fields) for item in page)
+        return 200, get_response_xml(f'<pagination pageNumber="{page_number}" pageSize="{page_size}" '
+                                     f'totalAvailable="{len(items)}"/><{tag}s>' + item_xml + f'</{tag}s>'), {}
+
+    def handle_list(self, query, body, item_type):
+        return self.list_items(item_type, list(self.site.items[item_type].values()), query)
+
+    def handle_workbook_views(self, query, body, workbook_id):
+        workbook = self.site.items['workbooks'].get(workbook_id)
+        if workbook is None:
+            return 404, get_error_xml('404006', 'Resource Not Found', workbook_id), {}
+        return self.list_items('views', workbook['Views'], query)
+
+    def handle_get_item(self, query, body, item_type, item_id):
+        item = self.site.items[item_type].get(item_id)
+        if item is None:
+            return 404, get_error_xml('404000', 'Resource Not Found', item_id), {}
+        return 200, get_response_xml(get_item_xml(item_type, item)), {}
+
+    def handle_download(self, query, body, item_type, item_id):
+        item = self.site.items[item_type].get(item_id)
+        if item is None:
+            return 404, get_error_xml('404000', 'Resource Not Found', item_id), {}
+        content = self.site.get_content(item_type, item, query.get('includeExtract', 'true').lower() != 'false')
+        self._throttle(len(content))
+        filename = f"{item['Name']}.{FILE_EXTENSIONS[item_type]}"
+        return 200, content, {'Content-Type': 'application/octet-stream',
+                              'Content-Disposition': f'attachment; filename="{filename}"'}
+
+    def handle_publish(self, query, body, item_type):
+        size, content = len(body), body
+        if 'uploadSessionId' in query:
+            with self._lock:
+                content = self._uploads.pop(query['uploadSessionId'], None)
+            if content is None:
+                return 404, get_error_xml('404000', 'Upload Session Not Found', query['uploadSessionId']), {}
+            size = len(content)
+        name_match = ITEM_NAME.search(body)
+        project_match = PROJECT_ID.search(body)
+        project_id = project_match.group(1).decode() if project_match else None
+        if project_id not in self.site.items['projects']:
+            return 404, get_error_xml('404005', 'Project Not Found', str(project_id)), {}
+        name = name_match.group(1).decode() if name_match and name_match.group(1) else ITEM_TAGS[item_type]
+        view_names = get_published_view_names(body) if item_type == 'workbooks' else None
+        item = self.site.publish_item(item_type, name, project_id, size, view_names,
+                                      get_connection_count(item_type, bytes(content)))
+        return 201, get_response_xml(get_item_xml(item_type, item)), {}
+
+    def get_job_xml(self, job_id):
+        job = self._jobs[job_id]
+        attributes = f'id="{job_id}" type="RefreshExtract" createdAt="{get_timestamp()}"'
+        if time.monotonic() - job['Started'] >= self.refresh_duration:
+            attributes += f' completedAt="{get_timestamp()}" finishCode="0" progress="100"'
+        return get_response_xml(f'<job {attributes}><extractRefreshJob>'
+                                f'<{job["Tag"]} id="{job["ItemId"]}"/></extractRefreshJob></job>')
+
+    def handle_refresh(self, query, body, item_type, item_id):
+        if item_id not in self.site.items[item_type]:
+            return 404, get_error_xml('404000', 'Resource Not Found', item_id), {}
+        job_id = str(uuid.uuid4())
+        with self._lock:
+            self._jobs[job_id] = {'Tag': ITEM_TAGS[item_type], 'ItemId': item_id, 'Started': time.monotonic()}
+        return 202, self.get_job_xml(job_id), {}
+
+    def handle_get_job(self, query, body, job_id):
+        if job_id not in self._jobs:
+            return 404, get_error_xml('404000', 'Job Not Found', job_id), {}
+        return 200, self.get_job_xml(job_id), {}
+
+    def handle_create_project(self, query, body):
+        name_match = re.search(rb'<project\b[^>]*?\sname="([^"]*)"', body)
+        parent_match = re.search(rb'\sparentProjectId="([^"]*)"', body)
+        project = self.site.add_project(name_match.group(1).decode() if name_match else 'Project',
+                                        parent_match.group(1).decode() if parent_match else None)
+        return 201, get_response_xml(get_item_xml('projects', project)), {}
+
+    def handle_initiate_upload(self, query, body):
+        upload_session_id = uuid.uuid4().hex
+        with self._lock:
+            self._uploads[upload_session_id] = bytearray()
+        return 201, get_response_xml(f'<fileUpload uploadSessionId="{upload_session_id}" fileSize="0"/>'), {}
+
+    def handle_append_upload(self, query, body, upload_session_id):
+        with self._lock:
+            if upload_session_id not in self._uploads:
+                return 404, get_error_xml('404000', 'Upload Session Not Found', upload_session_id), {}
+            file_part = UPLOAD_FILE_PART.search(body)
+            self._uploads[upload_session_id] += file_part.group(1) if file_part else b''
+            file_size = len(self._uploads[upload_session_id])
+        return 200, get_response_xml(f'<fileUpload uploadSessionId="{upload_session_id}" '
+                                     f'fileSize="{file_size // (1024 * 1024)}"/>'), {}
+
+    def handle_metadata(self, query, body):
+        # Paged connections listing of one content type filtered by luidWithin, the only query verification sends
+        graphql = json.loads(body)
+        variables = graphql.get('variables') or {}
+        listing = next((name for name in METADATA_LISTINGS if name in graphql['query']), None)
+        if listing is None:
+            return 200, json.dumps({'errors': [{'message': 'Unsupported query'}]}).encode(), \
+                {'Content-Type': 'application/json'}
+        item_type = METADATA_LISTINGS[listing]
+        fields = METADATA_FIELD.findall(graphql['query'])
+        luids = variables.get('luids')
+        items = [item for item in self.site.items[item_type].values() if luids is None or item['Id'] in luids]
+        start = int(variables.get('afterToken') or 0)
+        end = start + int(variables.get('first') or 100)
+        nodes = []
+        for item in items[start:end]:
+            node = {'luid': item['Id']}
+            connection_count = self.site.get_connection_count(item_type, item)
+            for field in fields:
+                # Every connection is reported under the first field
+                node[field] = [{'id': str(uuid.uuid4())} for _ in range(connection_count if field == fields[0] else 0)]
+            nodes.append(node)
+        page_info = {'hasNextPage': end < len(items), 'endCursor': str(end) if end < len(items) else None}
+        return 200, json.dumps({'data': {listing: {'nodes': nodes, 'pageInfo': page_info}}}).encode(), \
+            {'Content-Type': 'application/json'}
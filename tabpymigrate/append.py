@@ -0,0 +1,159 @@
+'''
+    append.py
+
+    Append-mode publishing of extract datasources whose rows only grow, such as event or log tables.
+    A datasource of APPEND_DATASOURCES is published whole the first time, together with the highest
+    value of its watermark column. On later runs, while the target datasource is still the one
+    published then, only the rows of the downloaded extract above that watermark are written to a
+    delta .hyper and published with the Append mode, instead of uploading the whole extract again.
+    Building the delta needs the optional tableauhyperapi package, without it datasources are
+    published whole. Appends only add rows: a changed connection needs a whole publish, e.g. with the
+    datasource left out of APPEND_DATASOURCES for one run, and rows added later with a watermark equal
+    to the last one are not appended.
+'''
+import os
+import tempfile
+import zipfile
+import tableauserverclient as TSC
+from . import config
+from .mapping import get_connection_count
+from .store import (get_publish_hash, get_published_key, get_published_state_path, get_unchanged_publish,
+                    is_published_current, load_published_state, save_published)
+from .transport import call_with_reauth
+from .upload import publish_datasource_in_chunks
+
+try:
+    from tableauhyperapi import (Connection, HyperProcess, SchemaName, TableDefinition, TableName, Telemetry,
+                                 escape_name, escape_string_literal)
+except ImportError:
+    # Optional dependency, append mode is not available without it
+    HyperProcess = None
+
+HYPER_EXTENSION = '.hyper'
+DELTA_FILENAME = 'delta.hyper'
+# Aliases of the downloaded extract and of the delta database in the Hyper session
+SOURCE_ALIAS = 'source'
+DELTA_ALIAS = 'delta'
+
+
+def get_append_column(datasource_name, append_datasources=None):
+    # Watermark column of a datasource published in append mode, None for other datasources
+    return (append_datasources or {}).get(datasource_name)
+
+
+def extract_hyper_file(package_path, work_path):
+    # The extract of a downloaded datasource, None unless the package has exactly one .hyper file
+    if package_path.lower().endswith(HYPER_EXTENSION):
+        return package_path
+    if not zipfile.is_zipfile(package_path):
+        return None
+    with zipfile.ZipFile(package_path) as package:
+        members = [member for member in package.namelist() if member.lower().endswith(HYPER_EXTENSION)]
+        if len(members) != 1:
+            return None
+        return package.extract(members[0], work_path)
+
+
+def get_watermark(connection, tables, column):
+    # Highest value of the watermark column over all tables, None when a table lacks the column or all are empty
+    values = []
+    for table in tables:
+        if connection.catalog.get_table_definition(table).get_column_by_name(column) is None:
+            return None
+        value = connection.execute_scalar_query(f"SELECT MAX({escape_name(column)}) FROM {table}")
+        if value is not None:
+            values.append(value)
+    return str(max(values)) if values else None
+
+
+def build_append_delta(package_path, work_path, column, last_watermark=None):
+    '''
+    Read the watermark of the downloaded extract and write the rows above last_watermark to a delta
+    .hyper in work_path, with the tables of the extract. Returns the new watermark, the delta path
+    and its row count; the delta path is None without last_watermark or when the extract has no watermark.
+    '''
+    hyper_path = extract_hyper_file(package_path, work_path)
+    if hyper_path is None:
+        return None, None, 0
+    delta_path = os.path.join(work_path, DELTA_FILENAME)
+    rows = 0
+    with HyperProcess(telemetry=Telemetry.DO_NOT_SEND_USAGE_DATA_TO_TABLEAU) as hyper:
+        with Connection(hyper.endpoint) as connection:
+            connection.catalog.attach_database(hyper_path, alias=SOURCE_ALIAS)
+            tables = [table for schema in connection.catalog.get_schema_names(SOURCE_ALIAS)
+                      for table in connection.catalog.get_table_names(schema)]
+            watermark = get_watermark(connection, tables, column)
+            if watermark is not None and last_watermark is not None:
+                connection.catalog.create_database(delta_path)
+                connection.catalog.attach_database(delta_path, alias=DELTA_ALIAS)
+                # Appended tables are matched by name on the server, so the delta keeps the schema and table names
+                for table in tables:
+                    delta_table = TableName(DELTA_ALIAS, table.schema_name.name, table.name)
+                    connection.catalog.create_schema_if_not_exists(SchemaName(DELTA_ALIAS, table.schema_name.name))
+                    connection.catalog.create_table(TableDefinition(delta_table,
+                                                                    connection.catalog.get_table_definition(table).columns))
+                    # The watermark is an untyped literal, compared in the type of the column. Rows equal to
+                    # it were published with it, a strict '>' keeps them from being appended twice
+                    rows += connection.execute_command(f"INSERT INTO {delta_table} SELECT * FROM {table} "
+                                                       f"WHERE {escape_name(column)} > {escape_string_literal(last_watermark)}") or 0
+            connection.catalog.detach_all_databases()
+    if watermark is None or last_watermark is None:
+        return watermark, None, 0
+    return watermark, delta_path, rows
+
+
+def publish_append(server, datasource, project_id, delta_path, upload_state_path=None):
+    # Append the rows of the delta to the target datasource with the same name in the project
+    datasource_item = TSC.DatasourceItem(project_id=project_id, name=datasource['Name'])
+    append_mode = TSC.Server.PublishMode.Append
+    if upload_state_path is not None and os.path.getsize(delta_path) >= config.UPLOAD_CHUNK_THRESHOLD:
+        return publish_datasource_in_chunks(server, datasource_item, delta_path, upload_state_path, append_mode)
+    return server.datasources.publish(datasource_item, delta_path, append_mode)
+
+
+def publish_datasource_appending(server, filesystem_path, project_id, datasource, filepath, column, publish_function,
+                                 skip_unchanged=True, upload_state_path=None):
+    '''
+    Publish a datasource whose rows only grow: skipped when unchanged, appended to the target with the
+    rows above the watermark of the last publish, or published whole by publish_function otherwise.
+    The new watermark is kept in the published state of the target.
+    Returns the webpage URL and ID of the target datasource, True when nothing was uploaded, and details.
+    '''
+    state_path = get_published_state_path(filesystem_path, server)
+    key = get_published_key('Datasource', project_id, datasource['Name'])
+    publish_hash = get_publish_hash(filepath)
+    if skip_unchanged:
+        record = get_unchanged_publish(server, server.datasources, state_path, key, publish_hash)
+        if record is not None:
+            return record['Url'], record['Id'], True, ''
+    if HyperProcess is None:
+        published_item = publish_function()
+        save_published(state_path, key, publish_hash, published_item, datasource,
+                       connection_count=get_connection_count('Datasource', filepath))
+        return (published_item.webpage_url, published_item.id, False,
+                "\nPublished whole, append mode needs the tableauhyperapi package")
+
+    # Rows are only appended onto the datasource of the last publish, unchanged on the target since
+    record = load_published_state(state_path).get(key)
+    last_watermark = None
+    if record is not None and record.get('Watermark') is not None \
+            and is_published_current(server, server.datasources, record):
+        last_watermark = record['Watermark']
+
+    # The extract is unpacked next to the downloads, extracts can be larger than the temp folder
+    with tempfile.TemporaryDirectory(prefix='_append_', dir=filesystem_path) as work_path:
+        watermark, delta_path, rows = build_append_delta(filepath, work_path, column, last_watermark)
+        if delta_path is None:
+            published_item = publish_function()
+            details = (f"\nPublished whole up to the watermark {watermark}" if watermark is not None
+                       else f"\nPublished whole, no watermark column {column} in the extract")
+        elif rows == 0:
+            return record['Url'], record['Id'], True, f"\nNo rows above the watermark {last_watermark}, upload skipped"
+        else:
+            published_item = call_with_reauth(server, publish_append, server, datasource, project_id, delta_path,
+                                              upload_state_path)
+            details = f"\nAppended {rows} rows above the watermark {last_watermark}"
+    # Appending rows leaves the connections of the target datasource as published whole
+    save_published(state_path, key, publish_hash, published_item, datasource, watermark=watermark,
+                   connection_count=get_connection_count('Datasource', filepath))
+    return published_item.webpage_url, published_item.id, False, details
@@ -6,14 +6,114 @@
     Below are defined variables in TabPyMigrate
 
 '''
+from typing import Any, Dict, List
+
 # Download & Publish
 ACTION=""
 DOWNLOAD = True
 PUBLISH = True
+# Download the objects of filesystem_path/plan.csv written by the PLAN action instead of listing the source
+FROM_PLAN = False
 
 # Tag name for selectig the objects to download
 TAG_NAME = ''
 
+# Optional filters applied on the server along with the tag - None to disable
+PROJECT_NAME = None
+OWNER_NAME = None
+UPDATED_SINCE = None  # UTC timestamp, e.g. '2024-01-31T00:00:00Z'
+
+# Number of objects requested per page when listing the server
+PAGE_SIZE = 1000
+
+# Select the objects to download and plan from the inventory snapshot of the site in filesystem_path/_cache,
+# refreshed on every run with only the objects updated since the last one (the INVENTORY action only refreshes it)
+INVENTORY = False
+# Number of pages of an inventory listing fetched concurrently once the first page gives the total count
+INVENTORY_WORKERS = 8
+# Seconds the snapshot refresh reaches back before the last one, covering the clock skew with the server
+INVENTORY_REFRESH_OVERLAP = 300
+# Seconds between the listings of every id which drop the objects deleted since from the snapshot, a refresh
+# in between only lists the objects updated since and keeps deleted objects, 0 to list the ids on every refresh
+INVENTORY_SWEEP_INTERVAL = 24 * 60 * 60
+
+# Number of parallel downloads and the cap on concurrent requests to one server
+DOWNLOAD_WORKERS = 1
+MAX_CONNECTIONS_PER_SERVER = 4
+# Cap on the bytes of the objects downloaded or published at once per server, 0 for no limit
+MAX_INFLIGHT_BYTES = 4 * 1024 * 1024 * 1024
+# Cap on the REST requests per second sent to one server, 0 for no limit
+MAX_REQUESTS_PER_SECOND = 0
+
+# HTTP transport shared by download and publish: connection pool floor and retries with backoff
+MIN_POOL_SIZE = 10
+RETRY_TOTAL = 5
+RETRY_BACKOFF_FACTOR = 1
+RETRY_BACKOFF_MAX = 120
+RETRY_STATUS_CODES = [429, 502, 503, 504]
+
+# Skip downloading objects not updated on the server since the last download (manifest.json)
+INCREMENTAL_DOWNLOAD = True
+
+# Number of parallel publishes, above 1 publishes by datasource dependency levels
+PUBLISH_WORKERS = 1
+
+# Seconds the project index of a server is cached under filesystem_path/_cache, 0 to disable
+PROJECT_CACHE_TTL = 0
+
+# Create the missing project paths on the target before publishing
+CREATE_PROJECTS = False
+
+# Files from this size are published in resumable chunks, retried from the last chunk on failure
+UPLOAD_CHUNK_THRESHOLD = 64 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+UPLOAD_RETRIES = 3
+
+# Resume the last run from filesystem_path/journal.jsonl, skipping objects it already completed
+RESUME = False
+
+# Overlap download, mapping and publish for DOWNLOAD_AND_PUBLISH, objects pass between stages in bounded queues
+PIPELINE = False
+PIPELINE_QUEUE_SIZE = 100
+# Bytes downloaded or mapped and not yet published in the pipeline, 0 for no limit
+STAGING_BUDGET_BYTES = 10 * 1024 * 1024 * 1024
+
+# Record run metrics in filesystem_path/metrics.jsonl and metrics_summary.json
+METRICS = True
+# Prometheus textfile the run summary is also written to (node_exporter textfile collector), '' to disable
+METRICS_TEXTFILE = ''
+
+# Deduplicate identical downloads as hard links to one file in the content store filesystem_path/_store
+CONTENT_STORE = True
+# Skip the upload of objects the target already has from an identical file with the same publish options
+SKIP_UNCHANGED_PUBLISH = True
+
+# Download datasources and workbooks with their extract data, FALSE downloads and publishes only the
+# connection definitions and starts an extract refresh on the target after each publish
+INCLUDE_EXTRACT = True
+# Wait for the extract refresh jobs started on the target, polled every REFRESH_POLL_INTERVAL seconds
+WAIT_FOR_REFRESH = False
+REFRESH_TIMEOUT = 3600
+REFRESH_POLL_INTERVAL = 10
+
+# Check every published object on the target after the publish, from one paged listing per content type:
+# project, views and update time are compared and the mismatches written to verify.csv
+VERIFY_PUBLISH = False
+
+# JSON file of connection remapping rules applied to flows, datasources and workbooks on publish, '' for none.
+# The first rule matching the source class, server, port, dbname and username (* ? [] wildcards) sets the target values:
+# [{"match": {"class": "postgres", "server": "*.corp.example.com", "dbname": "sales"},
+#   "set": {"server": "pg.cloud.example.com", "username": "svc_sales"}}]
+# Connections to published datasources are mapped to the target server unless a rule maps them
+CONNECTION_RULES_FILE = ''
+
+# Extract datasources whose rows only grow, by name, with the column whose values only grow, e.g. a load time:
+# {'Sales Events': 'event_time'}. Once published, only the rows above the highest value of the last publish are
+# appended to the target datasource. Needs the optional tableauhyperapi package, otherwise published whole.
+# Rows are compared in the type of the column with a strict '>', so a row added later with a value equal to
+# the highest value already published is not appended: use a column whose values are unique per load
+APPEND_DATASOURCES: Dict[str, str] = {}
+
 # Filesystem for Downloading and Publishing Tableau Objects
 FILESYSTEM_PATH = ''
 
@@ -30,3 +130,8 @@ TARGET_SITE_ID = None
 TARGET_USERNAME = ''
 TARGET_PASSWORD = ''
 TARGET_IS_PERSONAL_ACCESS_TOKEN = False  # Give True if using Personal access token
+
+# Publish to several targets at once instead of the target above, e.g.
+# [{'name': 'prod', 'server_address': 'https://prod', 'site_id': 'finance', 'username': '', 'password': '',
+#   'is_personal_access_token': False}]
+TARGETS: List[Dict[str, Any]] = []
@@ -0,0 +1,188 @@
+'''
+    fanout.py
+
+    Publish one download to many target sites or servers. The download CSVs are read and the
+    datasource dependencies parsed once for all targets, then every target publishes concurrently
+    with its own connection, project index, publish CSVs and staging folder
+    filesystem_path/_targets/<target>, so mapped files of different targets never overwrite each
+    other and are reused by the next run of the same target.
+'''
+import hashlib
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from . import config
+from . import metrics
+from .journal import get_publish_journal_key, open_journal, record_state
+from .mapping import update_datasource_mapping, update_flow_mapping, update_workbook_mapping
+from .projects import create_project_paths, get_project_index
+from .refresh import wait_for_refresh_jobs
+from .results import Results
+from .rules import load_connection_rules
+from .scheduler import build_publish_graph, get_publish_levels, get_task_size, run_levels
+from .throttle import get_byte_budget
+from .tabpymigrate_publish import (get_publish_project_paths, gettableauauth, publish_datasource_row, publish_flow_row,
+                                   publish_workbook_row, read_download_rows, write_publish_csv)
+from .transport import sign_in
+from .verify import verify_publish
+
+TARGETS_FOLDER = '_targets'
+
+PUBLISH_CSV_FILENAMES = {'Flow': 'flows_publish.csv',
+                         'Datasource': 'datasources_publish.csv',
+                         'Workbook': 'workbooks_publish.csv'}
+
+
+def get_target_name(target):
+    # Name of the target in output and staging folders, the server host and site unless named in the config
+    if target.get('name'):
+        return target['name']
+    host = re.sub(r'^\w+://', '', target['server_address']).rstrip('/')
+    return f"{host}/{target['site_id']}" if target.get('site_id') else host
+
+
+def get_target_staging_path(filesystem_path, target):
+    # The hash keeps targets apart when names only differ by characters not allowed in folder names
+    target_hash = hashlib.sha1(f"{target['server_address']}|{target.get('site_id') or ''}".encode()).hexdigest()[:8]
+    folder_name = re.sub(r'[^\w.-]+', '_', get_target_name(target)).strip('_')
+    return os.path.join(filesystem_path, TARGETS_FOLDER, f"{folder_name}_{target_hash}")
+
+
+def map_for_target(server, row, staging_path, project_index, journal=None, connection_rules=None):
+    '''
+    Map an object to the target into its staging folder, reusing the mapped copy of an earlier run when the
+    download and the connection rules didn't change. Returns the mapped path, None for datasources without
+    connection rules and failed mappings.
+    '''
+    if row['Response'] != "Success" or (row['Type'] == 'Datasource' and not connection_rules):
+        return None
+    # A failed mapping is left to the publish, which maps again and reports the error
+    try:
+        if row['Type'] == 'Flow':
+            mapped_path, _ = update_flow_mapping(row, server.server_address, project_index, staging_path,
+                                                 reuse_mapped=True, connection_rules=connection_rules)
+        elif row['Type'] == 'Datasource':
+            mapped_path = update_datasource_mapping(row['Path'], server.server_address, row['ProjectName'],
+                                                    staging_path, reuse_mapped=True, connection_rules=connection_rules,
+                                                    object_id=row.get('Id'))
+        else:
+            mapped_path = update_workbook_mapping(row['Path'], server.server_address, row['ProjectName'],
+                                                  staging_path, reuse_mapped=True, connection_rules=connection_rules,
+                                                  object_id=row.get('Id'))
+    except Exception as e:
+        print(f"Error in mapping {row['Type']} '{row['Name']}' to {server.server_address}: {str(e)}")
+        return None
+    record_state(journal, get_publish_journal_key(server, row), 'mapped', Path=mapped_path)
+    return mapped_path
+
+
+def get_target_stage(target):
+    # Stage of the publish results of a target in the results sink
+    return 'publish:' + get_target_name(target)
+
+
+def get_target_verify_stage(target):
+    return 'verify:' + get_target_name(target)
+
+
+def publish_target(target, filesystem_path, levels, project_paths, publish_workers, journal, skip_unchanged,
+                   wait_for_refresh=False, connection_rules=None, verify=False, append_datasources=None, results=None):
+    '''
+    Publish the shared publish levels to one target. Every publish result is reported to the results
+    sink under the stage of the target, and every verification result under its verify stage. Returns the sink.
+    '''
+    results = results if results is not None else Results()
+    staging_path = get_target_staging_path(filesystem_path, target)
+    os.makedirs(staging_path, exist_ok=True)
+    server, tableau_auth = gettableauauth(target['server_address'], username=target.get('username'),
+                                          password=target.get('password'), site_id=target.get('site_id'),
+                                          is_personal_access_token=target.get('is_personal_access_token', False),
+                                          workers=publish_workers)
+    publish_functions = {'Flow': publish_flow_row,
+                         'Datasource': publish_datasource_row,
+                         'Workbook': publish_workbook_row}
+    target_name = get_target_name(target)
+    stage = get_target_stage(target)
+
+    with sign_in(server, tableau_auth):
+        with metrics.phase('target_projects'):
+            project_index = get_project_index(server, filesystem_path)
+            if project_paths:
+                create_project_paths(server, project_index, project_paths, filesystem_path)
+
+        def publish(task):
+            mapped_path = map_for_target(server, task['Row'], staging_path, project_index, journal, connection_rules)
+            options = {'mapped_path': mapped_path} if mapped_path else {}
+            if task['Type'] == 'Datasource':
+                options['append_datasources'] = append_datasources
+            return publish_functions[task['Type']](server, task['Row'], staging_path, project_index, journal,
+                                                   skip_unchanged=skip_unchanged, connection_rules=connection_rules,
+                                                   **options)
+
+        with ExitStack() as csv_files, metrics.phase('publish_target'):
+            csvwriters = {object_type: csv_files.enter_context(write_publish_csv(os.path.join(staging_path,
+                                                                                              csv_filename)))
+                          for object_type, csv_filename in PUBLISH_CSV_FILENAMES.items()}
+            for level, task, object_details in run_levels(levels, publish, publish_workers, get_size=get_task_size,
+                                                          byte_budget=get_byte_budget(server.server_address)):
+                print(f"Published to {target_name} level", level, object_details)
+                csvwriters[task['Type']].writerow(object_details)
+                results.add(stage, object_details)
+
+        if wait_for_refresh:
+            wait_for_refresh_jobs(server, staging_path, workers=publish_workers)
+        if verify:
+            with metrics.phase('verify_target'):
+                verify_publish(server, filesystem_path, staging_path, results, get_target_verify_stage(target),
+                               journal=journal)
+    return results
+
+
+def tabpymigrate_publish_targets(targets, filesystem_path=None, publish_workers=config.PUBLISH_WORKERS,
+                                 create_projects=config.CREATE_PROJECTS, skip_unchanged=config.SKIP_UNCHANGED_PUBLISH,
+                                 wait_for_refresh=config.WAIT_FOR_REFRESH, connection_rules_file=config.CONNECTION_RULES_FILE,
+                                 verify=config.VERIFY_PUBLISH, append_datasources=config.APPEND_DATASOURCES,
+                                 results=None, journal=None, resume=False):
+    '''
+    Publish the download in filesystem_path to every target of the targets list concurrently.
+    A target is a dict with server_address, site_id, username, password, is_personal_access_token
+    and an optional name. Every publish result is reported to the results sink under the stage
+    'publish:<target name>', and every verification result under 'verify:<target name>'. Returns ("Success", {target name: (status, counts by type and response)}).
+    '''
+    try:
+        results = results if results is not None else Results()
+        if journal is None:
+            journal = open_journal(filesystem_path, resume)
+
+        # Metadata shared by all targets: the download rows, their dependencies, the project paths and the connection rules
+        with metrics.phase('publish_graph'):
+            tasks = build_publish_graph(read_download_rows(os.path.join(filesystem_path, 'flows.csv')),
+                                        read_download_rows(os.path.join(filesystem_path, 'datasources.csv')),
+                                        read_download_rows(os.path.join(filesystem_path, 'workbooks.csv')))
+            levels = get_publish_levels(tasks)
+            project_paths = get_publish_project_paths(filesystem_path) if create_projects else set()
+            connection_rules = load_connection_rules(connection_rules_file)
+
+        print(f"Starting publish to {len(targets)} targets")
+        target_results = {}
+        with ThreadPoolExecutor(max_workers=max(len(targets), 1)) as executor:
+            futures = {executor.submit(publish_target, target, filesystem_path, levels, project_paths,
+                                       max(publish_workers, 1), journal, skip_unchanged,
+                                       wait_for_refresh, connection_rules, verify, append_datasources,
+                                       results): target
+                       for target in targets}
+            for future in as_completed(futures):
+                target_name = get_target_name(futures[future])
+                try:
+                    future.result()
+                    target_results[target_name] = ("Success",
+                                                   results.get_summary().get(get_target_stage(futures[future]), {}))
+                except Exception as e:
+                    target_results[target_name] = ("Error", "Error in TabPyMigrate Publish Execution:" + str(e))
+                print(f"Publish to {target_name}:", *target_results[target_name])
+        return "Success", target_results
+    except Exception as e:
+        response_details = "Error in TabPyMigrate Publish Execution:" + str(e)
+        print(response_details)
+        return "Error", response_details
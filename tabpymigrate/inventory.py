@@ -0,0 +1,225 @@
+'''
+    inventory.py
+
+    Local inventory snapshot of a site: its projects, flows, datasources, workbooks and views with
+    only the fields selection and planning need, kept in filesystem_path/_cache. Every listing fetches
+    the pages after the first concurrently. A later run refreshes the snapshot by listing only the
+    objects updated since it was taken and the ids of the tagged objects, to find the objects tagged
+    or untagged since, so selecting and planning over a large site doesn't page through every object
+    again. Deleting an object doesn't show in such a listing: the ids of every object are only listed
+    once the sweep interval passed since the last time, to drop the objects deleted since.
+'''
+import datetime
+import hashlib
+import json
+import os
+from types import SimpleNamespace
+from . import config
+from . import metrics
+from .projects import PROJECT_FIELDS, build_project_index
+from .query import get_items_parallel
+from .tabpymigrate_download import DATASOURCE_FIELDS, FLOW_FIELDS, WORKBOOK_FIELDS, get_request_options, getTableauAuth
+from .transport import sign_in
+
+# Endpoints in the snapshot with the fields listed, views with the server defaults as get_workbook_views
+INVENTORY_TYPES = [('projects', PROJECT_FIELDS),
+                   ('flows', FLOW_FIELDS),
+                   ('datasources', DATASOURCE_FIELDS),
+                   ('workbooks', WORKBOOK_FIELDS),
+                   ('views', None)]
+
+# Object types selected from the snapshot and their endpoint
+SELECTION_TYPES = [('Flow', 'flows'), ('Datasource', 'datasources'), ('Workbook', 'workbooks')]
+SELECTION_ENDPOINTS = [endpoint_name for _, endpoint_name in SELECTION_TYPES]
+
+# Fields of the listing finding the objects deleted since the snapshot, TSC can't parse items without a project
+ID_FIELDS = ['id', 'project.id']
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def parse_timestamp(timestamp):
+    # ISO timestamps of the snapshot and UPDATED_SINCE style filters as aware UTC datetimes
+    parsed = datetime.datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    return parsed if parsed.tzinfo is not None else parsed.replace(tzinfo=datetime.timezone.utc)
+
+
+def get_inventory_path(filesystem_path, server):
+    server_key = f"{server.server_address}|{server.site_id}".encode()
+    return os.path.join(filesystem_path, '_cache', f"inventory_{hashlib.sha1(server_key).hexdigest()}.json")
+
+
+def load_inventory(inventory_path):
+    if not os.path.isfile(inventory_path):
+        return None
+    with open(inventory_path, 'r') as inventory_file:
+        inventory = json.load(inventory_file)
+    # A snapshot missing an endpoint is from another version and is taken again
+    if set(inventory.get('Items', {})) != {endpoint_name for endpoint_name, _ in INVENTORY_TYPES}:
+        return None
+    return inventory
+
+
+def save_inventory(inventory_path, inventory):
+    os.makedirs(os.path.dirname(inventory_path), exist_ok=True)
+    temp_path = inventory_path + '.tmp'
+    with open(temp_path, 'w') as inventory_file:
+        json.dump(inventory, inventory_file)
+    os.replace(temp_path, inventory_path)
+
+
+def get_record(endpoint_name, item):
+    # Snapshot record of a listed item
+    if endpoint_name == 'projects':
+        return {'Id': item.id, 'Name': item.name, 'ParentId': item.parent_id}
+    record = {'Id': item.id,
+              'Name': item.name,
+              'UpdatedAt': item.updated_at.isoformat() if item.updated_at is not None else None}
+    if endpoint_name == 'views':
+        record['WorkbookId'] = item.workbook_id
+        return record
+    record.update(ProjectId=item.project_id, ProjectName=item.project_name, Tags=sorted(item.tags or []))
+    if endpoint_name == 'workbooks':
+        record.update(ShowTabs=item.show_tabs, Size=item.size)
+    return record
+
+
+def list_records(server, endpoint_name, fields, page_size, workers, updated_since=None):
+    request_options = get_request_options(None, updated_since=updated_since, fields=fields, page_size=page_size)
+    return {item.id: get_record(endpoint_name, item)
+            for item in get_items_parallel(getattr(server, endpoint_name), request_options, workers)}
+
+
+def list_ids(server, endpoint_name, page_size, workers, tag_name=None):
+    request_options = get_request_options(tag_name, fields=ID_FIELDS, page_size=page_size)
+    return {item.id for item in get_items_parallel(getattr(server, endpoint_name), request_options, workers)}
+
+
+def update_tag_membership(records, tag_name, tagged_ids):
+    # Add or remove the tag on the records whose membership changed since they were listed
+    for item_id, record in records.items():
+        if (item_id in tagged_ids) != (tag_name in record['Tags']):
+            record['Tags'] = sorted(set(record['Tags']) ^ {tag_name})
+
+
+def is_sweep_due(inventory, refreshed_at, sweep_interval):
+    # Snapshots of an earlier version have no sweep time and are swept
+    swept_at = inventory.get('SweptAt')
+    return swept_at is None or (refreshed_at - parse_timestamp(swept_at)).total_seconds() >= sweep_interval
+
+
+def refresh_inventory(server, filesystem_path, page_size=config.PAGE_SIZE, workers=config.INVENTORY_WORKERS,
+                      overlap=config.INVENTORY_REFRESH_OVERLAP, full=False, tag_name=None,
+                      sweep_interval=config.INVENTORY_SWEEP_INTERVAL):
+    '''
+    Take the inventory snapshot of the signed-in site, or refresh the snapshot of an earlier run with
+    the objects updated since it was taken less overlap seconds. Tagging doesn't change the update
+    time of an object, so a refresh lists the ids tagged tag_name again; other tags of objects not
+    updated since may be stale. Objects deleted since stay in the snapshot until a refresh lists the
+    ids of every object, sweep_interval seconds after the last one. Returns the snapshot, a dict with
+    the records by id of every endpoint in 'Items'.
+    '''
+    inventory_path = get_inventory_path(filesystem_path, server)
+    inventory = None if full else load_inventory(inventory_path)
+    refreshed_at = datetime.datetime.now(datetime.timezone.utc)
+    sweep = inventory is None
+    if inventory is not None:
+        updated_since = (parse_timestamp(inventory['RefreshedAt'])
+                         - datetime.timedelta(seconds=overlap)).strftime(TIMESTAMP_FORMAT)
+        sweep = is_sweep_due(inventory, refreshed_at, sweep_interval)
+
+    items = {}
+    updated_records = {}
+    for endpoint_name, fields in INVENTORY_TYPES:
+        with metrics.phase('inventory_' + endpoint_name):
+            # Projects are few and hold the parent links, they are listed whole on every refresh
+            if inventory is None or endpoint_name == 'projects':
+                items[endpoint_name] = list_records(server, endpoint_name, fields, page_size, workers)
+                continue
+            records = dict(inventory['Items'][endpoint_name])
+            if sweep:
+                current_ids = list_ids(server, endpoint_name, page_size, workers)
+                records = {item_id: record for item_id, record in records.items() if item_id in current_ids}
+            elif endpoint_name == 'views':
+                # Publishing a workbook again may replace its views, they are all in the updated views
+                records = {item_id: record for item_id, record in records.items()
+                           if record['WorkbookId'] not in updated_records['workbooks']}
+            updated_records[endpoint_name] = list_records(server, endpoint_name, fields, page_size, workers,
+                                                          updated_since)
+            records.update(updated_records[endpoint_name])
+            if tag_name and endpoint_name in SELECTION_ENDPOINTS:
+                update_tag_membership(records, tag_name, list_ids(server, endpoint_name, page_size, workers, tag_name))
+            items[endpoint_name] = records
+
+    inventory = {'ServerAddress': server.server_address,
+                 'SiteId': server.site_id,
+                 'RefreshedAt': refreshed_at.strftime(TIMESTAMP_FORMAT),
+                 'SweptAt': refreshed_at.strftime(TIMESTAMP_FORMAT) if sweep else inventory['SweptAt'],
+                 'Items': items}
+    save_inventory(inventory_path, inventory)
+    return inventory
+
+
+def get_inventory_counts(inventory):
+    return {endpoint_name: len(records) for endpoint_name, records in inventory['Items'].items()}
+
+
+def get_inventory_project_index(inventory):
+    return build_project_index((project['Id'], project['Name'], project['ParentId'])
+                               for project in inventory['Items']['projects'].values())
+
+
+def get_inventory_item(record, workbook_views=None):
+    # Snapshot record in the shape of listed server items, as plan.load_plan_items
+    return SimpleNamespace(id=record['Id'], name=record['Name'], project_id=record['ProjectId'],
+                           project_name=record['ProjectName'], tags=set(record['Tags']),
+                           updated_at=parse_timestamp(record['UpdatedAt']) if record['UpdatedAt'] else None,
+                           show_tabs=record.get('ShowTabs', True), size=record.get('Size'),
+                           views=(workbook_views or {}).get(record['Id'], []))
+
+
+def get_inventory_objects(inventory, endpoint_name):
+    # Objects of one endpoint by (project id, name), as plan.get_target_objects
+    return {(record['ProjectId'], record['Name']): get_inventory_item(record)
+            for record in inventory['Items'][endpoint_name].values()}
+
+
+def select_inventory_items(inventory, tag_name=None, project_name=None, updated_since=None):
+    '''
+    Select the objects with the tag, project and update time filters of a listing from the snapshot.
+    Returns the items by type, in the shape of plan.load_plan_items.
+    '''
+    since = parse_timestamp(updated_since) if updated_since else None
+    workbook_views = {}
+    for view in inventory['Items']['views'].values():
+        workbook_views.setdefault(view['WorkbookId'], []).append(view['Name'])
+
+    selected = {}
+    for item_type, endpoint_name in SELECTION_TYPES:
+        selected[item_type] = [get_inventory_item(record, workbook_views)
+                               for record in inventory['Items'][endpoint_name].values()
+                               if tag_name and tag_name in record['Tags']
+                               and (not project_name or record['ProjectName'] == project_name)
+                               and (since is None or (record['UpdatedAt'] and parse_timestamp(record['UpdatedAt']) >= since))]
+    return selected
+
+
+def tabpymigrate_inventory(server_address, username=None, password=None, site_id=None, is_personal_access_token=False,
+                           filesystem_path=None, page_size=config.PAGE_SIZE, workers=config.INVENTORY_WORKERS,
+                           full=False, tag_name=None):
+    '''
+    Take or refresh the inventory snapshot of a site, with the current members of the tag tag_name.
+    Returns ("Success", snapshot) or ("Error", details).
+    '''
+    try:
+        server, tableau_auth = getTableauAuth(server_address, username=username, password=password, site_id=site_id,
+                                              is_personal_access_token=is_personal_access_token, workers=workers)
+        with sign_in(server, tableau_auth):
+            inventory = refresh_inventory(server, filesystem_path, page_size=page_size, workers=workers, full=full,
+                                          tag_name=tag_name)
+        print(f"Inventory of {server_address}:", get_inventory_counts(inventory))
+        return "Success", inventory
+    except Exception as e:
+        response_details = "Error in TabPyMigrate Inventory Execution:" + str(e)
+        print(response_details)
+        return "Error", response_details
@@ -0,0 +1,88 @@
+'''
+    journal.py
+
+    Durable run journal in filesystem_path/journal.jsonl. Every state transition of an object
+    (listed, downloaded, mapped, published, verified) is appended as one JSON line and fsync'd,
+    so a crashed run can be resumed by skipping the objects which already reached a state.
+'''
+import datetime
+import json
+import os
+import threading
+
+JOURNAL_FILENAME = 'journal.jsonl'
+
+# Object states in the order they are reached
+STATES = ['listed', 'downloaded', 'mapped', 'published', 'verified']
+
+# Fields of the latest record of an object kept for resuming: its state, download path and publish row
+RESUME_FIELDS = ['State', 'Path', 'Row']
+
+_journal_lock = threading.Lock()
+
+
+def read_journal_records(journal_path):
+    if not os.path.isfile(journal_path):
+        return
+    with open(journal_path, 'r') as journal_file:
+        for line in journal_file:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # A line cut short by a crash is ignored
+                continue
+
+
+def open_journal(filesystem_path, resume=False):
+    '''
+    Start a new run, or continue the latest run of the journal when resume is set.
+    Returns the journal with its RunId and, when resuming, the latest state of each object of the run.
+    States recorded during the run are only appended to the file, so memory doesn't grow with the objects.
+    '''
+    journal_path = os.path.join(filesystem_path, JOURNAL_FILENAME)
+    run_id = None
+    states = {}
+    if resume:
+        for record in read_journal_records(journal_path):
+            if record['RunId'] != run_id:
+                run_id, states = record['RunId'], {}
+            states[record['Key']] = {field: record[field] for field in RESUME_FIELDS if field in record}
+        if run_id is not None:
+            print(f"Resuming run {run_id}: {len(states)} objects in journal")
+    if run_id is None:
+        run_id = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+    return {'Path': journal_path, 'RunId': run_id, 'States': states}
+
+
+def get_journal_key(object_type, object_id, target=None):
+    return '|'.join(str(part) for part in (object_type, object_id, target) if part is not None)
+
+
+def get_publish_journal_key(server, row):
+    # Key of a download CSV row published to the signed-in server and site
+    return get_journal_key(row['Type'], row.get('Id') or row['Path'], f"{server.server_address}/{server.site_id}")
+
+
+def record_state(journal, key, state, **details):
+    if journal is None:
+        return
+    record = {'Time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+              'RunId': journal['RunId'],
+              'Key': key,
+              'State': state}
+    record.update(details)
+    with _journal_lock:
+        with open(journal['Path'], 'a') as journal_file:
+            journal_file.write(json.dumps(record, default=str) + '\n')
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+
+def get_completed_record(journal, key, state):
+    # The latest record of the object when it reached at least the given state in the resumed run, otherwise None
+    if journal is None:
+        return None
+    record = journal['States'].get(key)
+    if record is None or record['State'] not in STATES or STATES.index(record['State']) < STATES.index(state):
+        return None
+    return record
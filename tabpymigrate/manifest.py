@@ -0,0 +1,74 @@
+'''
+    manifest.py
+
+    Content manifest of downloaded objects kept in filesystem_path/manifest.json.
+    Each entry is keyed by the object LUID and records the server updated_at,
+    file size, content hash and local path, so unchanged objects are not downloaded again.
+'''
+import hashlib
+import json
+import os
+import threading
+
+MANIFEST_FILENAME = 'manifest.json'
+
+_manifest_lock = threading.Lock()
+
+
+def get_file_hash(filepath, block_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as hash_file:
+        for block in iter(lambda: hash_file.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def load_manifest(filesystem_path):
+    manifest_path = os.path.join(filesystem_path, MANIFEST_FILENAME)
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_manifest(filesystem_path, manifest):
+    # Write to a temp file and rename so an interrupted run keeps the previous manifest
+    manifest_path = os.path.join(filesystem_path, MANIFEST_FILENAME)
+    with _manifest_lock:
+        temp_path = manifest_path + '.tmp'
+        with open(temp_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        os.replace(temp_path, manifest_path)
+
+
+def get_unchanged_path(manifest, item, include_extract=True):
+    '''
+    Return the local path of the previous download when the object wasn't updated on the server,
+    was downloaded with the same extract option and the file on disk still has the recorded size,
+    otherwise None.
+    '''
+    with _manifest_lock:
+        entry = manifest.get(item.id)
+    if entry is None or item.updated_at is None or entry['UpdatedAt'] != item.updated_at.isoformat():
+        return None
+    if entry.get('IncludeExtract', True) != include_extract:
+        return None
+    if not os.path.isfile(entry['Path']) or os.path.getsize(entry['Path']) != entry['Size']:
+        return None
+    return entry['Path']
+
+
+def update_manifest_entry(manifest, item, item_type, filepath, include_extract=True):
+    entry = {'Type': item_type,
+             'Name': item.name,
+             'ProjectName': item.project_name,
+             'UpdatedAt': item.updated_at.isoformat() if item.updated_at is not None else None,
+             'Size': os.path.getsize(filepath),
+             'Hash': get_file_hash(filepath),
+             'IncludeExtract': include_extract,
+             'Path': filepath}
+    with _manifest_lock:
+        manifest[item.id] = entry
+    return entry
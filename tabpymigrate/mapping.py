@@ -1,7 +1,34 @@
+import copy
+import hashlib
 import json
+import re
+import shutil
+import struct
 import zipfile
 import os
-from tableaudocumentapi import Workbook
+from contextlib import contextmanager
+from xml.sax.saxutils import escape, unescape
+from defusedxml.ElementTree import iterparse
+from . import metrics
+from .projects import get_project_index_digest, get_unresolved_project_details, resolve_project_id
+
+# Start tags of <connection> elements, not <connection-customization> or other connection-* elements,
+# and their attributes in .twb/.tds XML
+CONNECTION_TAG = re.compile(rb'<connection(?=[\s/>])[^>]*>')
+XML_ATTRIBUTE = re.compile(rb'(\s)([\w:.-]+)=(["\'])(.*?)\3', re.S)
+XML_ESCAPES = {'"': '&quot;', "'": '&apos;'}
+XML_UNESCAPES = {'&quot;': '"', '&apos;': "'"}
+
+# zipfile internals copy_zip_member uses to copy members compressed as-is, members are decompressed and
+# compressed again through the public API when a Python release lacks one of them
+RAW_COPY_SUPPORTED = (all(hasattr(zipfile, name) for name in ('structFileHeader', 'sizeFileHeader',
+                                                              '_FH_FILENAME_LENGTH', '_FH_EXTRA_FIELD_LENGTH',
+                                                              '_strip_extra'))
+                      and hasattr(zipfile.ZipInfo, 'FileHeader'))
+RAW_COPY_ZIPFILE_ATTRIBUTES = ('fp', 'filelist', 'NameToInfo', 'start_dir', '_didModify')
+
+# Extension of the file next to a reusable mapped copy holding the hash of its mapping inputs
+MAPPING_INPUTS_EXTENSION = '.inputs'
 
 
 def parse_zipfile(filename):
@@ -18,77 +45,438 @@ def get_flow_from_archive(zip_content):
     return None
 
 
-def update_flow_mapping(flow, server_address=None, project_list={}, filesystem=None):
-    # Open flow file in Zip file and flow_content
-    flow_path = flow['Path']
-    flow_extension = os.path.splitext(flow_path)[1].split('.')[-1]
-    try:
-        zip_content = parse_zipfile(flow_path)
-        flow_content = get_flow_from_archive(zip_content)
-    except Exception as error:
-        response += f"\nError in opening flow file: {str(e)}"
-        raise f"\nError in opening flow file: {str(e)}"         
+def can_copy_raw(target_zip):
+    # The raw copy relies on private zipfile internals, which any Python release may change
+    return RAW_COPY_SUPPORTED and all(hasattr(target_zip, name) for name in RAW_COPY_ZIPFILE_ATTRIBUTES)
+
+
+def copy_zip_member(source_zip, target_zip, zip_info, block_size=1024 * 1024):
+    # Copy a member's compressed bytes as-is into target_zip, without decompressing or re-deflating it
+    if not can_copy_raw(target_zip):
+        return copy_zip_member_decompressed(source_zip, target_zip, zip_info, block_size)
+    source_file = source_zip.fp
+    source_file.seek(zip_info.header_offset)
+    file_header = struct.unpack(zipfile.structFileHeader, source_file.read(zipfile.sizeFileHeader))
+    data_offset = (zip_info.header_offset + zipfile.sizeFileHeader
+                   + file_header[zipfile._FH_FILENAME_LENGTH] + file_header[zipfile._FH_EXTRA_FIELD_LENGTH])
+
+    # Sizes and CRC go in the local header, so no data descriptor is written after the data
+    target_info = copy.copy(zip_info)
+    target_info.flag_bits &= ~0x08
+    target_info.extra = zipfile._strip_extra(zip_info.extra, (1,))
+    target_info.header_offset = target_zip.fp.tell()
+    zip64 = target_info.file_size > zipfile.ZIP64_LIMIT or target_info.compress_size > zipfile.ZIP64_LIMIT
+    target_zip.fp.write(target_info.FileHeader(zip64))
+
+    source_file.seek(data_offset)
+    remaining = zip_info.compress_size
+    while remaining > 0:
+        block = source_file.read(min(block_size, remaining))
+        if not block:
+            raise zipfile.BadZipFile(f"Truncated member in archive: {zip_info.filename}")
+        target_zip.fp.write(block)
+        remaining -= len(block)
 
-    # Process and update serverUrl and projectLuid
+    target_zip.filelist.append(target_info)
+    target_zip.NameToInfo[target_info.filename] = target_info
+    target_zip.start_dir = target_zip.fp.tell()
+    target_zip._didModify = True
+
+
+def copy_zip_member_decompressed(source_zip, target_zip, zip_info, block_size=1024 * 1024):
+    # Stream a member through zipfile's public API, decompressing and compressing it again
+    target_info = zipfile.ZipInfo(zip_info.filename, zip_info.date_time)
+    target_info.compress_type = zip_info.compress_type
+    target_info.external_attr = zip_info.external_attr
+    target_info.comment = zip_info.comment
+    force_zip64 = zip_info.file_size > zipfile.ZIP64_LIMIT
+    with source_zip.open(zip_info) as source, target_zip.open(target_info, 'w', force_zip64=force_zip64) as target:
+        shutil.copyfileobj(source, target, block_size)
+
+
+def update_flow_content(flow_content, server_address=None, project_index=None, connection_rules=None):
+    # Process and update serverUrl and projectLuid, and the database connections by the connection rules
     response = ""
+    for connection_id, connection in flow_content.get('connections', {}).items():
+        attributes = connection.get('connectionAttributes') or {}
+        updates = get_dbname_for_source_to_target(connection_rules, attributes)
+        mapped = {name: value for name, value in updates.items() if name in attributes}
+        if mapped:
+            attributes.update(mapped)
+            response += f"\nConnection mapped {connection.get('name', connection_id)}:{mapped}"
     for node in flow_content['nodes']:
         if flow_content['nodes'][node].get('serverUrl') is not None:
             flow_content['nodes'][node]['serverUrl'] = server_address
             response += "serverUrl updated:" + str(flow_content['nodes'][node]['serverUrl'])
         if flow_content['nodes'][node].get('projectLuid') is not None:
-            if flow_content['nodes'][node].get('projectName') is not None:
-                projectName = flow_content['nodes'][node].get('projectName')
-                newprojectLuid = project_list.get(projectName)
+            projectName = flow_content['nodes'][node].get('projectName')
+            if projectName is not None:
+                newprojectLuid = resolve_project_id(project_index, project_name=projectName) if project_index else None
                 if newprojectLuid is not None:
                     flow_content['nodes'][node]['projectLuid'] = newprojectLuid
                     response += "\nUpdated projectLuid:" + newprojectLuid
+                elif project_index:
+                    response += "\nError: " + get_unresolved_project_details(project_index, project_name=projectName)
                 else:
                     response += f"\nError: Target Project not found in server - {projectName}"
             else:
-                response += f"\nError: projectLuid found but projectName not found - {projectName}"
+                response += f"\nError: projectLuid found but projectName not found - {node}"
+    return response
+
+
+def get_mapped_folder(filesystem, project_name, source_path, object_id=None):
+    '''
+    Create the _temp folder of one mapped copy, named after the project and keyed by the object ID, or by the
+    download path without one, as nested projects and objects mapped concurrently can share names.
+    '''
+    object_key = object_id or hashlib.sha1(os.path.abspath(source_path).encode()).hexdigest()[:12]
+    folder_name = re.sub(r'[^\w.-]+', '_', project_name or '').strip('_')
+    mapped_folder = os.path.join(filesystem, '_temp', f"{folder_name}_{object_key}" if folder_name else object_key)
+    os.makedirs(mapped_folder, exist_ok=True)
+    return mapped_folder
+
+
+def get_mapping_inputs_hash(source_path, server_address=None, connection_rules=None, project_index=None):
+    # Hash of what a mapped copy is built from: the source file, the target server, the connection rules
+    # and, for flows whose projectLuid is mapped, the target project index
+    source_stat = os.stat(source_path)
+    inputs = [os.path.abspath(source_path), source_stat.st_size, source_stat.st_mtime_ns, server_address,
+              connection_rules.digest if connection_rules is not None else None,
+              get_project_index_digest(project_index) if project_index else None]
+    return hashlib.sha1(json.dumps(inputs).encode()).hexdigest()
+
+
+def is_mapped_copy_current(mapped_path, inputs_hash):
+    # A mapped copy built from the same inputs can be published again as-is
+    inputs_path = mapped_path + MAPPING_INPUTS_EXTENSION
+    if not os.path.isfile(mapped_path) or not os.path.isfile(inputs_path):
+        return False
+    with open(inputs_path, 'r') as inputs_file:
+        return inputs_file.read() == inputs_hash
 
-    # Create project folder in temp directory and updated filename
+
+@contextmanager
+def recording_mapping_inputs(mapped_path, inputs_hash):
+    # The inputs of the previous copy are removed while mapping, so an interrupted mapping is never reused
+    inputs_path = mapped_path + MAPPING_INPUTS_EXTENSION
+    if inputs_hash is not None and os.path.isfile(inputs_path):
+        os.remove(inputs_path)
+    yield
+    if inputs_hash is not None:
+        with open(inputs_path, 'w') as inputs_file:
+            inputs_file.write(inputs_hash)
+
+
+def update_flow_mapping(flow, server_address=None, project_index=None, filesystem=None, reuse_mapped=False,
+                        connection_rules=None):
+    '''
+    Write a copy of the flow archive to its _temp folder with serverUrl and projectLuid mapped to the target,
+    and the database connections mapped by the connection rules (rules.ConnectionRules).
+    The archive is read once: only the flow member is re-encoded, other members are copied compressed as-is.
+    With reuse_mapped, a copy already mapped from the same flow file, project index and rules is returned as-is.
+    '''
+    flow_path = flow['Path']
+    flow_extension = os.path.splitext(flow_path)[1].split('.')[-1]
+    response = ""
+
+    # Create the folder of the flow in temp directory and updated filename
     updated_filename = flow['Name'] + "." + flow_extension
-    updated_filepath = os.path.join(filesystem, '_temp', flow['ProjectName'])
-    os.makedirs(updated_filepath, exist_ok=True)
+    updated_filepath = get_mapped_folder(filesystem, flow['ProjectName'], flow_path, flow.get('Id'))
     updated_file = os.path.join(updated_filepath, updated_filename)
+    inputs_hash = get_mapping_inputs_hash(flow_path, server_address, connection_rules, project_index) \
+        if reuse_mapped else None
+    if reuse_mapped and is_mapped_copy_current(updated_file, inputs_hash):
+        return updated_file, "Reused mapped flow file:" + str(updated_file)
+
+    zip_content = parse_zipfile(flow_path)
+    if zip_content is None:
+        raise ValueError(f"Error in opening flow file: not a flow archive - {flow_path}")
 
-    # Read zip file contents and write to new file
+    # Stream members across to the new file in one pass
     try:
-        new_zipfile = zipfile.ZipFile(updated_file, 'w', zipfile.ZIP_DEFLATED)
-        zip_content = parse_zipfile(flow_path)
-        for filename in zip_content.namelist():
-            if filename == 'flow':
-                    new_zipfile.writestr('flow', json.dumps(flow_content))
-            else:
-                    file_content = zip_content.open(filename).read()
-                    new_zipfile.writestr(filename, file_content)
+        with metrics.track_object('mapping', 'Flow', flow['Name'], os.path.getsize(flow_path)), \
+                recording_mapping_inputs(updated_file, inputs_hash), \
+                zip_content, zipfile.ZipFile(updated_file, 'w', zipfile.ZIP_DEFLATED) as new_zipfile:
+            for zip_info in zip_content.infolist():
+                if zip_info.filename == 'flow':
+                    flow_content = json.loads(zip_content.read(zip_info))
+                    response += update_flow_content(flow_content, server_address, project_index, connection_rules)
+                    # The source member time keeps the mapped archive identical when mapped again
+                    new_zipfile.writestr(zipfile.ZipInfo('flow', zip_info.date_time), json.dumps(flow_content),
+                                         compress_type=zipfile.ZIP_DEFLATED)
+                else:
+                    copy_zip_member(zip_content, new_zipfile, zip_info)
         response += "\nUpdated flow file saved successfully:" + str(updated_file)
     except Exception as e:
-            response += f"\nError in saving updated flow file: {str(e)}"
-            raise f"\nError in saving updated flow file: {str(e)}"
-    finally:
-         new_zipfile.close()
-         zip_content.close()
+        raise Exception(f"Error in saving updated flow file: {str(e)}") from e
 
     return updated_file, response
 
 
-def get_dbname_for_source_to_target():
-     return
+def get_dbname_for_source_to_target(connection_rules, attributes, server_address=None):
+    '''
+    Target values of a source connection: those of the first matching connection rule, and for
+    connections to published datasources (sqlproxy) the target server unless a rule maps it.
+    '''
+    updates = connection_rules.get_updates(attributes) if connection_rules else {}
+    if (server_address is not None and attributes.get('class') == 'sqlproxy'
+            and attributes.get('server') is not None and 'server' not in updates):
+        updates = dict(updates, server=server_address)
+    return updates
+
+
+def rewrite_connection_tag(connection_tag, get_attribute_updates):
+    # Replace attribute values of one <connection ...> start tag, other bytes of the tag are kept as-is
+    attributes = {match.group(2).decode(): unescape(match.group(4).decode(), XML_UNESCAPES)
+                  for match in XML_ATTRIBUTE.finditer(connection_tag)}
+    updates = get_attribute_updates(attributes)
+    if not updates:
+        return connection_tag
+
+    def replace_attribute(match):
+        name = match.group(2).decode()
+        if name not in updates:
+            return match.group(0)
+        value = escape(str(updates[name]), XML_ESCAPES).encode()
+        return match.group(1) + match.group(2) + b'=' + match.group(3) + value + match.group(3)
+
+    return XML_ATTRIBUTE.sub(replace_attribute, connection_tag)
 
 
-def update_workbook_mapping(workbookpath, server_address):
-    sourceWB = Workbook(workbookpath)
-    for datasource in sourceWB.datasources:
-        for connection in datasource.connections:
-            print(connection.server, connection.dbname, connection.username)
-            connection.server = server_address
-            #connection.dbname = get_dbname_for_source_to_target(
-            #                                    connection.dbname,
-            #                                    source_datasource,
-            #                                    taget_datasource)
+def rewrite_connections(source, target, get_attribute_updates, block_size=1024 * 1024):
+    '''
+    Stream XML from source to target rewriting the attributes of every <connection> tag.
+    get_attribute_updates(attributes) returns the new values of existing attributes.
+    Returns the number of connection tags seen.
+    '''
+    connection_count = 0
 
-    sourceWB.save()
-    return workbookpath
+    def rewrite(match):
+        nonlocal connection_count
+        connection_count += 1
+        return rewrite_connection_tag(match.group(0), get_attribute_updates)
+
+    pending = b''
+    while True:
+        block = source.read(block_size)
+        pending += block
+        # Rewrite up to the last complete tag, the rest waits for the next block
+        cut = pending.rfind(b'>') + 1 if block else len(pending)
+        target.write(CONNECTION_TAG.sub(rewrite, pending[:cut]))
+        pending = pending[cut:]
+        if not block:
+            return connection_count
+
+
+def rewrite_workbook_file(workbookpath, updated_file, get_attribute_updates, extensions=('.twb',)):
+    # Rewrite connections into updated_file, inside the package for .twbx/.tdsx with other members copied untouched
+    zip_content = parse_zipfile(workbookpath)
+    if zip_content is None:
+        with open(workbookpath, 'rb') as source, open(updated_file, 'wb') as target:
+            return rewrite_connections(source, target, get_attribute_updates)
+
+    connection_count = 0
+    with zip_content, zipfile.ZipFile(updated_file, 'w', zipfile.ZIP_DEFLATED) as new_zipfile:
+        for zip_info in zip_content.infolist():
+            if zip_info.filename.lower().endswith(extensions):
+                target_info = zipfile.ZipInfo(zip_info.filename, zip_info.date_time)
+                target_info.compress_type = zipfile.ZIP_DEFLATED
+                target_info.external_attr = zip_info.external_attr
+                with zip_content.open(zip_info) as source, new_zipfile.open(target_info, 'w') as target:
+                    connection_count += rewrite_connections(source, target, get_attribute_updates)
+            else:
+                copy_zip_member(zip_content, new_zipfile, zip_info)
+    return connection_count
 
+
+def update_workbook_mapping(workbookpath, server_address, project_name='', filesystem=None, reuse_mapped=False,
+                            connection_rules=None, object_id=None):
+    '''
+    Write a copy of the workbook to its _temp folder with the connections mapped to the target: published
+    datasource connections to the target server, database connections by the connection rules.
+    The downloaded workbook is left untouched. With reuse_mapped, a copy already mapped from the
+    same workbook file, target server and connection rules is returned without mapping again.
+    '''
+    filesystem = filesystem if filesystem is not None else os.path.dirname(workbookpath)
+    updated_filepath = get_mapped_folder(filesystem, project_name, workbookpath, object_id)
+    updated_file = os.path.join(updated_filepath, os.path.basename(workbookpath))
+    inputs_hash = get_mapping_inputs_hash(workbookpath, server_address, connection_rules) if reuse_mapped else None
+    if reuse_mapped and is_mapped_copy_current(updated_file, inputs_hash):
+        return updated_file
+
+    def get_attribute_updates(attributes):
+        return get_dbname_for_source_to_target(connection_rules, attributes, server_address)
+
+    with metrics.track_object('mapping', 'Workbook', os.path.basename(workbookpath), os.path.getsize(workbookpath)), \
+            recording_mapping_inputs(updated_file, inputs_hash):
+        rewrite_workbook_file(workbookpath, updated_file, get_attribute_updates)
+    return updated_file
+
+
+def update_datasource_mapping(datasourcepath, server_address, project_name='', filesystem=None, reuse_mapped=False,
+                              connection_rules=None, object_id=None):
+    '''
+    Write a copy of the datasource to its _temp folder with its connections mapped by the connection rules.
+    The downloaded datasource is left untouched. With reuse_mapped, a copy already mapped from the
+    same datasource file, target server and connection rules is returned without mapping again.
+    '''
+    filesystem = filesystem if filesystem is not None else os.path.dirname(datasourcepath)
+    updated_filepath = get_mapped_folder(filesystem, project_name, datasourcepath, object_id)
+    updated_file = os.path.join(updated_filepath, os.path.basename(datasourcepath))
+    inputs_hash = get_mapping_inputs_hash(datasourcepath, server_address, connection_rules) if reuse_mapped else None
+    if reuse_mapped and is_mapped_copy_current(updated_file, inputs_hash):
+        return updated_file
+
+    def get_attribute_updates(attributes):
+        return get_dbname_for_source_to_target(connection_rules, attributes, server_address)
+
+    with metrics.track_object('mapping', 'Datasource', os.path.basename(datasourcepath),
+                              os.path.getsize(datasourcepath)), recording_mapping_inputs(updated_file, inputs_hash):
+        rewrite_workbook_file(datasourcepath, updated_file, get_attribute_updates, ('.tds',))
+    return updated_file
+
+
+@contextmanager
+def open_workbook_xml(workbookpath, extensions=('.twb',)):
+    # Yield the .twb XML stream of a workbook, reading it from inside the package for .twbx
+    zip_content = parse_zipfile(workbookpath)
+    if zip_content is None:
+        with open(workbookpath, 'rb') as xml_file:
+            yield xml_file
+        return
+    try:
+        twb_names = [name for name in zip_content.namelist() if name.lower().endswith(extensions)]
+        if not twb_names:
+            raise ValueError(f"No {'/'.join(extensions)} found in package: {workbookpath}")
+        with zip_content.open(twb_names[0]) as xml_file:
+            yield xml_file
+    finally:
+        zip_content.close()
+
+
+def get_workbook_datasource_names(workbookpath):
+    # Names of the published datasources (sqlproxy connections) a workbook connects to
+    names = set()
+    with open_workbook_xml(workbookpath) as xml_file:
+        for event, element in iterparse(xml_file, events=('end',)):
+            if element.tag == 'datasource':
+                connection = element.find('connection')
+                if connection is not None and connection.get('class') == 'sqlproxy':
+                    names.add(element.get('caption') or connection.get('dbname'))
+                    repository_location = element.find('repository-location')
+                    if repository_location is not None and repository_location.get('id'):
+                        names.add(repository_location.get('id'))
+                element.clear()
+            elif element.tag in ('worksheet', 'dashboard', 'window'):
+                element.clear()
+    names.discard(None)
+    return names
+
+
+def has_extract_definitions(filepath):
+    # Whether a workbook or datasource defines extracts, also when downloaded without the extract data
+    with open_workbook_xml(filepath, ('.twb', '.tds')) as xml_file:
+        for event, element in iterparse(xml_file, events=('start', 'end')):
+            if event == 'start' and element.tag == 'extract' and element.get('enabled', 'true') == 'true':
+                return True
+            if event == 'end' and element.tag in ('datasource', 'worksheet', 'dashboard', 'window'):
+                element.clear()
+    return False
+
+
+def get_workbook_sheet_names(workbookpath):
+    # Names of the worksheets, dashboards and stories of a workbook which are not hidden in the workbook
+    sheet_names = []
+    hidden_sheet_names = set()
+    with open_workbook_xml(workbookpath) as xml_file:
+        for event, element in iterparse(xml_file, events=('start', 'end')):
+            if event == 'start':
+                if element.tag in ('worksheet', 'dashboard') and element.get('name') is not None:
+                    sheet_names.append(element.get('name'))
+                elif element.tag == 'window' and element.get('hidden') == 'true':
+                    hidden_sheet_names.add(element.get('name'))
+            elif element.tag in ('worksheet', 'dashboard', 'window', 'datasource'):
+                element.clear()
+    return [name for name in sheet_names if name not in hidden_sheet_names]
+
+
+def get_hidden_views(workbookpath, display_views):
+    # Sheets which would be published as views but were not visible views on the source server
+    return [name for name in get_workbook_sheet_names(workbookpath) if name not in display_views]
+
+
+def get_flow_datasource_names(flow_path):
+    # Names of the published datasources a flow reads as input
+    zip_content = parse_zipfile(flow_path)
+    if zip_content is None:
+        return set()
+    try:
+        flow_content = get_flow_from_archive(zip_content) or {}
+    finally:
+        zip_content.close()
+    return get_flow_input_names(flow_content)
+
+
+def get_flow_input_names(flow_content):
+    # Names of the published datasources read by the input nodes of a flow's content
+    names = set()
+    for node in flow_content.get('nodes', {}).values():
+        if node.get('nodeType', '').endswith('LoadSqlProxy'):
+            names.add(node.get('datasourceName') or node.get('name'))
+    names.discard(None)
+    return names
+
+
+def get_workbook_connection_count(workbookpath):
+    # Data sources of a workbook with a connection, one embedded datasource each on the server
+    connection_count = 0
+    with open_workbook_xml(workbookpath) as xml_file:
+        for event, element in iterparse(xml_file, events=('end',)):
+            if element.tag == 'datasource':
+                if element.find('connection') is not None:
+                    connection_count += 1
+                element.clear()
+            elif element.tag in ('worksheet', 'dashboard', 'window'):
+                element.clear()
+    return connection_count
+
+
+def get_datasource_connection_count(datasourcepath):
+    # Distinct databases a datasource connects to, leaving out federated connections and the extract
+    databases = set()
+    extract_depth = 0
+    with open_workbook_xml(datasourcepath, ('.tds',)) as xml_file:
+        for event, element in iterparse(xml_file, events=('start', 'end')):
+            if element.tag == 'extract':
+                extract_depth += 1 if event == 'start' else -1
+            elif event == 'start' and element.tag == 'connection' and not extract_depth \
+                    and element.get('class') != 'federated':
+                databases.add((element.get('class'), element.get('server'), element.get('dbname')))
+    return len(databases)
+
+
+def get_flow_connection_count(flow_path):
+    # Database connections and published datasources a flow reads
+    zip_content = parse_zipfile(flow_path)
+    if zip_content is None:
+        return 0
+    try:
+        flow_content = get_flow_from_archive(zip_content) or {}
+    finally:
+        zip_content.close()
+    return len(flow_content.get('connections', {})) + len(get_flow_input_names(flow_content))
+
+
+# Connection count of the file published as each object type
+CONNECTION_COUNTERS = {'Flow': get_flow_connection_count,
+                       'Datasource': get_datasource_connection_count,
+                       'Workbook': get_workbook_connection_count}
+
+
+def get_connection_count(object_type, filepath):
+    # Connection count of a file to publish as verification compares it with the target, None when it can't be read
+    try:
+        return CONNECTION_COUNTERS[object_type](filepath)
+    except Exception as e:
+        print(f"Could not count the connections of {filepath}: {str(e)}")
+        return None
@@ -0,0 +1,317 @@
+'''
+    metrics.py
+
+    Run instrumentation: per-object and per-phase wall time and bytes, REST request counts and
+    latencies by route, retries, re-sign-ins and queue depths. Events are appended as JSON lines to
+    filesystem_path/metrics.jsonl, the summary is written to metrics_summary.json and, optionally,
+    to a Prometheus textfile. Nothing is recorded when no run is started, and without a filesystem_path
+    the run is only summarized in memory and in the Prometheus textfile when one is given.
+'''
+import datetime
+import functools
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+METRICS_FILENAME = 'metrics.jsonl'
+SUMMARY_FILENAME = 'metrics_summary.json'
+
+# Upper bounds in seconds of the request latency buckets
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+# Object IDs and upload session IDs in REST paths, replaced so requests group by route
+ROUTE_IDS = re.compile(r'/([0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}|[0-9a-fA-F]{32})(?=/|$)')
+API_PREFIX = re.compile(r'^/api/[^/]+(/sites/\{id\})?')
+
+_run = None
+_run_lock = threading.Lock()
+
+
+def start_run(filesystem_path, prometheus_path=None):
+    '''
+    Start recording a run into filesystem_path, replacing the events of a previous run.
+    Without a filesystem_path no events or summary files are written, not even in the working directory.
+    '''
+    global _run
+    events = None
+    if filesystem_path:
+        os.makedirs(filesystem_path, exist_ok=True)
+        events = open(os.path.join(filesystem_path, METRICS_FILENAME), 'w', buffering=1)
+    with _run_lock:
+        _run = {'Path': filesystem_path,
+                'PrometheusPath': prometheus_path,
+                'Events': events,
+                'Start': time.perf_counter(),
+                'StartedAt': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                'Phases': {}, 'Objects': {}, 'Requests': {}, 'Retries': {}, 'Reauths': 0, 'Queues': {}}
+    emit('run_started')
+
+
+def end_run():
+    '''
+    Stop recording, write the summary files and return the summary, or None when no run was started.
+    '''
+    global _run
+    if _run is None:
+        return None
+    summary = get_summary()
+    emit('run_summary', **summary)
+    with _run_lock:
+        run, _run = _run, None
+        if run['Events'] is not None:
+            run['Events'].close()
+
+    if run['Path']:
+        write_json(os.path.join(run['Path'], SUMMARY_FILENAME), summary)
+    if run['PrometheusPath']:
+        write_prometheus_textfile(run['PrometheusPath'], summary)
+    return summary
+
+
+def emit(event, **fields):
+    if _run is None or _run['Events'] is None:
+        return
+    record = {'Time': datetime.datetime.now(datetime.timezone.utc).isoformat(), 'Event': event}
+    record.update(fields)
+    line = json.dumps(record, default=str) + '\n'
+    with _run_lock:
+        if _run is not None and _run['Events'] is not None:
+            _run['Events'].write(line)
+
+
+@contextmanager
+def phase(name, **fields):
+    # Time a phase of the run, phases with the same name add up
+    start = time.perf_counter()
+    emit('phase_started', Phase=name, **fields)
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        emit('phase_finished', Phase=name, Seconds=round(seconds, 6), **fields)
+        with _run_lock:
+            if _run is not None:
+                entry = _run['Phases'].setdefault(name, {'Count': 0, 'Seconds': 0.0})
+                entry['Count'] += 1
+                entry['Seconds'] += seconds
+
+
+@contextmanager
+def track_object(phase_name, object_type, name, size=0):
+    '''
+    Time the work on one object. The yielded dict takes the 'Response' and the 'Bytes' handled,
+    an exception records the object as an error.
+    '''
+    tracked = {'Response': "Success", 'Bytes': size}
+    start = time.perf_counter()
+    try:
+        yield tracked
+    except Exception:
+        tracked['Response'] = "Error"
+        raise
+    finally:
+        record_object(phase_name, object_type, name, time.perf_counter() - start, tracked['Bytes'],
+                      tracked['Response'])
+
+
+def timed_object(phase_name, object_type):
+    # Decorator tracking a function which returns the CSV details of one object (a dict with Response and Path)
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            object_details = function(*args, **kwargs)
+            path = object_details.get('Path')
+            size = os.path.getsize(path) if path and os.path.isfile(path) else 0
+            record_object(phase_name, object_type, object_details.get('Name'), time.perf_counter() - start, size,
+                          object_details.get('Response'))
+            return object_details
+        return wrapper
+    return decorator
+
+
+def record_object(phase_name, object_type, name, seconds, size, response):
+    if _run is None:
+        return
+    emit('object', Phase=phase_name, Type=object_type, Name=name, Seconds=round(seconds, 6), Bytes=size,
+         Response=response)
+    with _run_lock:
+        if _run is not None:
+            key = f"{phase_name}|{object_type}"
+            entry = _run['Objects'].setdefault(key, {'Phase': phase_name, 'Type': object_type, 'Count': 0,
+                                                     'Errors': 0, 'Seconds': 0.0, 'MaxSeconds': 0.0, 'Bytes': 0})
+            entry['Count'] += 1
+            entry['Errors'] += response != "Success"
+            entry['Seconds'] += seconds
+            entry['MaxSeconds'] = max(entry['MaxSeconds'], seconds)
+            entry['Bytes'] += size or 0
+
+
+def get_route(url):
+    path = ROUTE_IDS.sub('/{id}', urlsplit(url).path)
+    return API_PREFIX.sub('', path) or '/'
+
+
+def record_request(method, url, status, seconds, bytes_sent, bytes_received):
+    if _run is None:
+        return
+    with _run_lock:
+        if _run is not None:
+            key = f"{method} {get_route(url)}"
+            entry = _run['Requests'].setdefault(key, {'Method': method, 'Route': get_route(url), 'Count': 0,
+                                                      'Errors': 0, 'Seconds': 0.0, 'MaxSeconds': 0.0,
+                                                      'BytesSent': 0, 'BytesReceived': 0,
+                                                      'Buckets': [0] * len(LATENCY_BUCKETS)})
+            entry['Count'] += 1
+            entry['Errors'] += status >= 400
+            entry['Seconds'] += seconds
+            entry['MaxSeconds'] = max(entry['MaxSeconds'], seconds)
+            entry['BytesSent'] += bytes_sent
+            entry['BytesReceived'] += bytes_received
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    entry['Buckets'][index] += 1
+
+
+def record_retry(method, url, status=None, error=None):
+    if _run is None:
+        return
+    emit('retry', Method=method, Route=get_route(url or ''), Status=status, Error=error)
+    with _run_lock:
+        if _run is not None:
+            key = f"{method} {get_route(url or '')}"
+            _run['Retries'][key] = _run['Retries'].get(key, 0) + 1
+
+
+def record_reauth(server_address):
+    if _run is None:
+        return
+    emit('reauth', Server=server_address)
+    with _run_lock:
+        if _run is not None:
+            _run['Reauths'] += 1
+
+
+def record_queue_depth(queue, depth):
+    # Objects waiting or in flight on a worker queue, kept as last and max per queue
+    if _run is None:
+        return
+    with _run_lock:
+        if _run is not None:
+            entry = _run['Queues'].setdefault(queue, {'Depth': 0, 'MaxDepth': 0, 'Samples': 0})
+            entry['Depth'] = depth
+            entry['MaxDepth'] = max(entry['MaxDepth'], depth)
+            entry['Samples'] += 1
+
+
+def get_summary():
+    with _run_lock:
+        if _run is None:
+            return None
+        return json.loads(json.dumps({'StartedAt': _run['StartedAt'],
+                                      'Seconds': round(time.perf_counter() - _run['Start'], 6),
+                                      'Phases': _run['Phases'],
+                                      'Objects': list(_run['Objects'].values()),
+                                      'Requests': list(_run['Requests'].values()),
+                                      'Retries': _run['Retries'],
+                                      'Reauths': _run['Reauths'],
+                                      'Queues': _run['Queues']}))
+
+
+def write_json(path, content):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as json_file:
+        json.dump(content, json_file, indent=2)
+    os.replace(temp_path, path)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def get_labels(**labels):
+    return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in labels.items()) + '}'
+
+
+def write_prometheus_textfile(path, summary):
+    '''
+    Write the summary in the Prometheus text format for the node_exporter textfile collector.
+    The file is replaced atomically so the collector never reads a partial file.
+    '''
+    lines = []
+
+    def add_metric(name, metric_type, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.extend(f"{name}{labels} {value}" for labels, value in samples)
+
+    add_metric('tabpymigrate_run_seconds', 'gauge', 'Wall time of the last run.',
+               [('', summary['Seconds'])])
+    add_metric('tabpymigrate_phase_seconds', 'gauge', 'Wall time of each phase of the last run.',
+               [(get_labels(phase=name), entry['Seconds']) for name, entry in summary['Phases'].items()])
+    add_metric('tabpymigrate_objects_total', 'counter', 'Objects handled by phase and type.',
+               [(get_labels(phase=entry['Phase'], type=entry['Type']), entry['Count'])
+                for entry in summary['Objects']])
+    add_metric('tabpymigrate_object_errors_total', 'counter', 'Objects failed by phase and type.',
+               [(get_labels(phase=entry['Phase'], type=entry['Type']), entry['Errors'])
+                for entry in summary['Objects']])
+    add_metric('tabpymigrate_object_seconds_total', 'counter', 'Time spent on objects by phase and type.',
+               [(get_labels(phase=entry['Phase'], type=entry['Type']), entry['Seconds'])
+                for entry in summary['Objects']])
+    add_metric('tabpymigrate_object_bytes_total', 'counter', 'Bytes of the objects handled by phase and type.',
+               [(get_labels(phase=entry['Phase'], type=entry['Type']), entry['Bytes'])
+                for entry in summary['Objects']])
+
+    histogram = []
+    for entry in summary['Requests']:
+        labels = {'method': entry['Method'], 'route': entry['Route']}
+        for bound, count in zip(LATENCY_BUCKETS, entry['Buckets']):
+            histogram.append((get_labels(le=bound, **labels), count))
+        histogram.append((get_labels(le='+Inf', **labels), entry['Count']))
+    lines.append("# HELP tabpymigrate_request_seconds REST request latency by route.")
+    lines.append("# TYPE tabpymigrate_request_seconds histogram")
+    lines.extend(f"tabpymigrate_request_seconds_bucket{labels} {value}" for labels, value in histogram)
+    for entry in summary['Requests']:
+        labels = get_labels(method=entry['Method'], route=entry['Route'])
+        lines.append(f"tabpymigrate_request_seconds_sum{labels} {entry['Seconds']}")
+        lines.append(f"tabpymigrate_request_seconds_count{labels} {entry['Count']}")
+
+    add_metric('tabpymigrate_request_errors_total', 'counter', 'REST requests answered with an error status by route.',
+               [(get_labels(method=entry['Method'], route=entry['Route']), entry['Errors'])
+                for entry in summary['Requests']])
+    add_metric('tabpymigrate_request_bytes_total', 'counter', 'REST request and response bytes by route.',
+               [(get_labels(method=entry['Method'], route=entry['Route'], direction=direction), entry[key])
+                for entry in summary['Requests']
+                for direction, key in (('sent', 'BytesSent'), ('received', 'BytesReceived'))])
+    add_metric('tabpymigrate_retries_total', 'counter', 'REST requests retried by route.',
+               [(get_labels(method=key.split(' ', 1)[0], route=key.split(' ', 1)[1]), count)
+                for key, count in summary['Retries'].items()])
+    add_metric('tabpymigrate_reauths_total', 'counter', 'Sign-ins after an expired auth token.',
+               [('', summary['Reauths'])])
+    add_metric('tabpymigrate_queue_depth_max', 'gauge', 'Largest number of objects waiting or in flight per queue.',
+               [(get_labels(queue=queue), entry['MaxDepth']) for queue, entry in summary['Queues'].items()])
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as textfile:
+        textfile.write('\n'.join(lines) + '\n')
+    os.replace(temp_path, path)
+
+
+def print_summary(summary):
+    # Short per-phase report printed at the end of a run
+    if summary is None:
+        return
+    print(f"Run time: {summary['Seconds']:.1f}s")
+    for name, entry in summary['Phases'].items():
+        print(f"  phase {name}: {entry['Seconds']:.1f}s")
+    for entry in summary['Objects']:
+        print(f"  {entry['Phase']} {entry['Type']}: {entry['Count']} objects, {entry['Errors']} errors, "
+              f"{entry['Bytes']} bytes, {entry['Seconds']:.1f}s")
+    request_count = sum(entry['Count'] for entry in summary['Requests'])
+    request_seconds = sum(entry['Seconds'] for entry in summary['Requests'])
+    print(f"  REST requests: {request_count} in {request_seconds:.1f}s, "
+          f"{sum(summary['Retries'].values())} retries, {summary['Reauths']} re-sign-ins")
@@ -0,0 +1,292 @@
+'''
+    pipeline.py
+
+    Pipelined DOWNLOAD_AND_PUBLISH: every object goes through download -> mapping -> publish stages
+    connected by bounded queues, so the first objects are live on the target while later ones are
+    still downloading. Datasources go through first and flows and workbooks wait for the datasources
+    they read before publishing. Bytes staged on disk and not yet published are capped by a budget.
+'''
+import os
+import queue
+import shutil
+import threading
+from contextlib import ExitStack
+from . import config
+from . import metrics
+from .manifest import load_manifest, save_manifest
+from .mapping import (get_flow_datasource_names, get_workbook_datasource_names, update_datasource_mapping,
+                      update_flow_mapping, update_workbook_mapping)
+from .projects import create_project_paths, escape_project_name, get_project_index
+from .refresh import wait_for_refresh_jobs
+from .results import Results
+from .rules import load_connection_rules
+from .scheduler import get_datasource_references
+from .store import get_store_root, prune_store
+from .tabpymigrate_download import (DATASOURCE_FIELDS, FLOW_FIELDS, WORKBOOK_FIELDS, download_datasources,
+                                    download_flows, download_workbooks, get_request_options, getTableauAuth)
+from .tabpymigrate_publish import (gettableauauth, publish_datasource_row, publish_flow_row, publish_workbook_row,
+                                   write_publish_csv)
+from .journal import get_publish_journal_key, open_journal, record_state
+from .throttle import get_byte_budget
+from .transport import sign_in
+from .verify import verify_publish
+
+# Datasources go first, so every datasource of the run is known before a dependent is downloaded
+DOWNLOAD_STAGES = [('download_datasources', download_datasources, 'Datasource', DATASOURCE_FIELDS),
+                   ('download_flows', download_flows, 'Flow', FLOW_FIELDS),
+                   ('download_workbooks', download_workbooks, 'Workbook', WORKBOOK_FIELDS)]
+
+PUBLISH_CSV_FILENAMES = {'Flow': 'flows_publish.csv',
+                         'Datasource': 'datasources_publish.csv',
+                         'Workbook': 'workbooks_publish.csv'}
+
+
+class StagingBudget(object):
+    '''
+    Soft cap of the bytes downloaded or mapped and not yet published. A download only starts while
+    the staged bytes are below the budget, so parallel downloads can overshoot it by one object each.
+    '''
+
+    def __init__(self, max_bytes=config.STAGING_BUDGET_BYTES):
+        self.max_bytes = max_bytes
+        self.staged = 0
+        self._condition = threading.Condition()
+
+    def wait_for_room(self):
+        if not self.max_bytes:
+            return
+        with self._condition:
+            # Nothing staged always leaves room, so an object larger than the budget still goes through
+            self._condition.wait_for(lambda: self.staged < self.max_bytes or self.staged == 0)
+
+    def add(self, size):
+        with self._condition:
+            self.staged += size
+            metrics.record_queue_depth('staged_bytes', self.staged)
+
+    def release(self, size):
+        with self._condition:
+            self.staged -= size
+            metrics.record_queue_depth('staged_bytes', self.staged)
+            self._condition.notify_all()
+
+
+def to_csv_row(row):
+    # Rows handed between the stages look like rows read back from the download CSVs
+    return {key: '' if value is None else str(value) for key, value in row.items()}
+
+
+def get_file_size(path):
+    return os.path.getsize(path) if path and os.path.isfile(path) else 0
+
+
+def get_publish_options(task, append_datasources=None):
+    # Keyword arguments of the publish function of a task beyond those shared by all object types
+    options = {'mapped_path': task['MappedPath']} if task['MappedPath'] else {}
+    if task['Type'] == 'Datasource':
+        options['append_datasources'] = append_datasources
+    return options
+
+
+def map_row(server, row, filesystem_path, project_index, journal=None, create_projects=False, connection_rules=None):
+    '''
+    Mapping stage of one object: create its target project when asked, map the file to the target
+    and read the datasources it depends on. Returns the publish task of the object.
+    '''
+    task = {'Type': row['Type'], 'Row': row, 'MappedPath': None, 'DependsOn': set()}
+    if row['Response'] != "Success":
+        return task
+
+    project_path = row.get('ProjectPath') or escape_project_name(row['ProjectName'])
+    if create_projects and project_path not in project_index['ByPath']:
+        create_project_paths(server, project_index, [project_path], filesystem_path)
+
+    # A failed mapping is left to the publish stage, which maps again and reports the error
+    try:
+        if row['Type'] == 'Flow':
+            task['MappedPath'], _ = update_flow_mapping(row, server.server_address, project_index, filesystem_path,
+                                                        connection_rules=connection_rules)
+            task['DependsOn'] = get_datasource_references(row, get_flow_datasource_names)
+        elif row['Type'] == 'Workbook':
+            task['MappedPath'] = update_workbook_mapping(row['Path'], server.server_address, row['ProjectName'],
+                                                         filesystem_path, connection_rules=connection_rules,
+                                                         object_id=row.get('Id'))
+            task['DependsOn'] = get_datasource_references(row, get_workbook_datasource_names)
+        elif connection_rules:
+            task['MappedPath'] = update_datasource_mapping(row['Path'], server.server_address, row['ProjectName'],
+                                                           filesystem_path, connection_rules=connection_rules,
+                                                           object_id=row.get('Id'))
+    except Exception as e:
+        print(f"Error in mapping {row['Type']} '{row['Name']}': {str(e)}")
+    if task['MappedPath'] is not None:
+        record_state(journal, get_publish_journal_key(server, row), 'mapped', Path=task['MappedPath'])
+    return task
+
+
+def tabpymigrate_pipeline(source_server_address, target_server_address, source_username=None, source_password=None,
+                          source_site_id=None, source_is_personal_access_token=False, target_username=None,
+                          target_password=None, target_site_id=None, target_is_personal_access_token=False,
+                          filesystem_path=None, tag_name=None, project_name=None, owner_name=None, updated_since=None,
+                          page_size=config.PAGE_SIZE, download_workers=config.DOWNLOAD_WORKERS,
+                          incremental=config.INCREMENTAL_DOWNLOAD, publish_workers=config.PUBLISH_WORKERS,
+                          create_projects=config.CREATE_PROJECTS, staging_budget=config.STAGING_BUDGET_BYTES,
+                          queue_size=config.PIPELINE_QUEUE_SIZE, content_store=config.CONTENT_STORE,
+                          skip_unchanged=config.SKIP_UNCHANGED_PUBLISH, include_extract=config.INCLUDE_EXTRACT,
+                          wait_for_refresh=config.WAIT_FOR_REFRESH, connection_rules_file=config.CONNECTION_RULES_FILE,
+                          verify=config.VERIFY_PUBLISH, append_datasources=config.APPEND_DATASOURCES,
+                          plan_items=None, results=None, journal=None, resume=False):
+    '''
+    Download from the source and publish to the target in one pass. The download CSVs and publish CSVs
+    are written as by the separate DOWNLOAD and PUBLISH actions, and every download and publish result
+    is reported to the results sink. Returns ("Success", the sink) or ("Error", details).
+    '''
+    try:
+        results = results if results is not None else Results()
+        source_server, source_auth = getTableauAuth(source_server_address, username=source_username,
+                                                    password=source_password, site_id=source_site_id,
+                                                    is_personal_access_token=source_is_personal_access_token,
+                                                    workers=download_workers)
+        target_server, target_auth = gettableauauth(target_server_address, username=target_username,
+                                                    password=target_password, site_id=target_site_id,
+                                                    is_personal_access_token=target_is_personal_access_token,
+                                                    workers=publish_workers)
+        if journal is None:
+            journal = open_journal(filesystem_path, resume)
+
+        with sign_in(source_server, source_auth), sign_in(target_server, target_auth):
+            run_pipeline(source_server, target_server, filesystem_path, tag_name,
+                         {'project_name': project_name, 'owner_name': owner_name,
+                          'updated_since': updated_since, 'page_size': page_size},
+                         download_workers, incremental, publish_workers, create_projects,
+                         StagingBudget(staging_budget), queue_size, journal,
+                         get_store_root(filesystem_path) if content_store else None,
+                         skip_unchanged, plan_items, include_extract,
+                         load_connection_rules(connection_rules_file), results, append_datasources)
+            if wait_for_refresh:
+                wait_for_refresh_jobs(target_server, filesystem_path, workers=publish_workers)
+            if verify:
+                with metrics.phase('verify'):
+                    verify_publish(target_server, filesystem_path, results=results, journal=journal)
+        results.print_summary()
+        return "Success", results
+    except Exception as e:
+        response_details = "Error in TabPyMigrate Pipeline Execution:" + str(e)
+        print(response_details)
+        return "Error", response_details
+
+
+def run_pipeline(source_server, target_server, filesystem_path, tag_name, filters, download_workers, incremental,
+                 publish_workers, create_projects, staging_budget, queue_size, journal, store_root=None,
+                 skip_unchanged=config.SKIP_UNCHANGED_PUBLISH, plan_items=None, include_extract=True,
+                 connection_rules=None, results=None, append_datasources=None):
+    with metrics.phase('list_projects'):
+        source_project_index = get_project_index(source_server, filesystem_path, page_size=filters['page_size'])
+    with metrics.phase('target_projects'):
+        target_project_index = get_project_index(target_server, filesystem_path)
+
+    publish_workers = max(publish_workers, 1)
+    map_queue = queue.Queue(maxsize=queue_size)
+    publish_queue = queue.Queue(maxsize=queue_size)
+    # Publish events of the datasources of this run by name, set once published or failed
+    datasource_events = {}
+    stage_errors = []
+    results = results if results is not None else Results()
+    csv_lock = threading.Lock()
+    publish_functions = {'Flow': publish_flow_row,
+                         'Datasource': publish_datasource_row,
+                         'Workbook': publish_workbook_row}
+
+    def enqueue_download(row):
+        row = to_csv_row(row)
+        if row['Type'] == 'Datasource':
+            datasource_events.setdefault(row['Name'], {})[row['Sno']] = threading.Event()
+        map_queue.put(row)
+        metrics.record_queue_depth('map', map_queue.qsize())
+
+    def download_stage():
+        try:
+            manifest = load_manifest(filesystem_path) if incremental else None
+            for phase_name, download_function, item_type, fields in DOWNLOAD_STAGES:
+                with metrics.phase(phase_name):
+                    download_function(source_server, filesystem_path, tag_name, results,
+                                      get_request_options(tag_name, fields=fields, **filters),
+                                      download_workers=download_workers, manifest=manifest,
+                                      project_index=source_project_index, journal=journal,
+                                      staging_budget=staging_budget, row_callback=enqueue_download,
+                                      store_root=store_root, items=(plan_items or {}).get(item_type),
+                                      **({'include_extract': include_extract} if item_type != 'Flow' else {}))
+                if manifest is not None:
+                    save_manifest(filesystem_path, manifest)
+            if store_root is not None:
+                prune_store(store_root)
+        except Exception as e:
+            stage_errors.append(e)
+        finally:
+            map_queue.put(None)
+
+    def mapping_stage():
+        try:
+            for row in iter(map_queue.get, None):
+                task = map_row(target_server, row, filesystem_path, target_project_index, journal, create_projects,
+                               connection_rules)
+                staging_budget.add(get_file_size(task['MappedPath']))
+                publish_queue.put(task)
+                metrics.record_queue_depth('publish', publish_queue.qsize())
+        except Exception as e:
+            stage_errors.append(e)
+            # Drain the download stage so it can't block on a full queue
+            for _ in iter(map_queue.get, None):
+                pass
+        finally:
+            for _ in range(publish_workers):
+                publish_queue.put(None)
+
+    byte_budget = get_byte_budget(target_server.server_address)
+
+    def publish_stage():
+        for task in iter(publish_queue.get, None):
+            row = task['Row']
+            try:
+                for name in task['DependsOn']:
+                    for event in datasource_events.get(name, {}).values():
+                        event.wait()
+                with byte_budget.reserve(get_file_size(task['MappedPath'] or row['Path'])):
+                    object_details = publish_functions[task['Type']](target_server, row, filesystem_path,
+                                                                     target_project_index, journal,
+                                                                     skip_unchanged=skip_unchanged,
+                                                                     connection_rules=connection_rules,
+                                                                     **get_publish_options(task, append_datasources))
+            except Exception as e:
+                object_details = {'Sno': row['Sno'], 'Type': row['Type'], 'Name': row['Name'],
+                                  'ProjectName': row['ProjectName'], 'Path': row['Path'],
+                                  'Response': "Error", 'Details': str(e)}
+            finally:
+                if task['Type'] == 'Datasource':
+                    datasource_events[row['Name']][row['Sno']].set()
+                # The mapped copy is only needed for the publish, the download stays for incremental runs
+                staging_budget.release(get_file_size(row['Path']) + get_file_size(task['MappedPath']))
+                # The folder of the mapped copy belongs to this object alone
+                if task['MappedPath']:
+                    shutil.rmtree(os.path.dirname(task['MappedPath']), ignore_errors=True)
+            print("Published", object_details)
+            with csv_lock:
+                csvwriters[task['Type']].writerow(object_details)
+            results.add('publish', object_details)
+
+    threads = ([threading.Thread(target=download_stage, name='pipeline-download'),
+                threading.Thread(target=mapping_stage, name='pipeline-mapping')]
+               + [threading.Thread(target=publish_stage, name=f'pipeline-publish-{number}')
+                  for number in range(publish_workers)])
+    with ExitStack() as csv_files, metrics.phase('pipeline'):
+        # Opened before the publish threads start, closed once they all ended
+        csvwriters = {object_type: csv_files.enter_context(write_publish_csv(os.path.join(filesystem_path,
+                                                                                          csv_filename)))
+                      for object_type, csv_filename in PUBLISH_CSV_FILENAMES.items()}
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    if stage_errors:
+        raise stage_errors[0]
+    return results
@@ -0,0 +1,214 @@
+'''
+    plan.py
+
+    PLAN action: one paged inventory of the tagged source objects and of the target site, joined in
+    memory into filesystem_path/plan.csv with the action each object would get on publish
+    (create, overwrite, skip or error) and its estimated bytes, before anything is transferred.
+    A download with from_plan takes its objects from plan.csv instead of listing the source again.
+    With inventory both sites are read from their refreshed inventory snapshots (inventory.py).
+'''
+import ast
+import csv
+import datetime
+import os
+from types import SimpleNamespace
+from . import config
+from . import metrics
+from .inventory import (get_inventory_objects, get_inventory_project_index, refresh_inventory,
+                        select_inventory_items)
+from .manifest import load_manifest
+from .projects import (escape_project_name, get_project_index, get_project_path, get_unresolved_project_details,
+                       resolve_project_id)
+from .query import get_items
+from .store import get_published_key, get_published_state_path, load_published_state
+from .tabpymigrate_download import (DATASOURCE_FIELDS, FLOW_FIELDS, WORKBOOK_FIELDS, WORKBOOK_SIZE_UNIT,
+                                    get_item_size, get_request_options, get_tagged_items, get_workbook_views,
+                                    getTableauAuth)
+from .tabpymigrate_publish import gettableauauth
+from .transport import sign_in
+
+PLAN_FILENAME = 'plan.csv'
+PLAN_FIELDS = ['Sno', 'Type', 'Id', 'Name', 'ProjectId', 'ProjectName', 'ProjectPath', 'UpdatedAt', 'Show_Tabs',
+               'Views', 'TargetProjectId', 'TargetId', 'Action', 'Bytes', 'Details']
+
+# Actions of plan rows which are not downloaded when executing from the plan
+NOT_TRANSFERRED_ACTIONS = ['skip', 'error']
+
+# Fields requested when listing the target, enough to find the object a publish overwrites
+TARGET_FIELDS = ['id', 'name', 'project.id', 'updatedAt']
+
+PLAN_TYPES = [('Flow', 'flows', FLOW_FIELDS),
+              ('Datasource', 'datasources', DATASOURCE_FIELDS),
+              ('Workbook', 'workbooks', WORKBOOK_FIELDS)]
+
+
+def get_updated_at(item):
+    return item.updated_at.isoformat() if item.updated_at is not None else None
+
+
+def get_target_objects(server, item_type, endpoint_name, page_size):
+    # Target objects of one type by (project id, name), the object a publish to that project overwrites
+    request_options = get_request_options(None, fields=TARGET_FIELDS, page_size=page_size)
+    return {(item.project_id, item.name): item
+            for item in get_items(getattr(server, endpoint_name), request_options)}
+
+
+def plan_item(item, item_type, source_project_index, target_project_index, target_objects, published_state,
+              manifest, create_projects=False, skip_unchanged=config.SKIP_UNCHANGED_PUBLISH):
+    '''
+    Plan one source object against the target inventory. Returns the plan row without Sno.
+    '''
+    project_path = get_project_path(source_project_index, item.project_id) or ''
+    row = {'Type': item_type,
+           'Id': item.id,
+           'Name': item.name,
+           'ProjectId': item.project_id,
+           'ProjectName': item.project_name,
+           'ProjectPath': project_path,
+           'UpdatedAt': get_updated_at(item),
+           'Bytes': get_item_size(item, manifest)}
+
+    if item.project_name is None:
+        row.update(Action='error', Details=f"Could not retrieve project name for {item_type} '{item.name}'")
+        return row
+    target_project_id = resolve_project_id(target_project_index, project_path, item.project_name)
+    if target_project_id is None:
+        if create_projects:
+            row.update(Action='create',
+                       Details="Target project will be created: " + (project_path or escape_project_name(item.project_name)))
+        else:
+            row.update(Action='error', Details=get_unresolved_project_details(target_project_index, project_path,
+                                                                              item.project_name))
+        return row
+
+    row['TargetProjectId'] = target_project_id
+    target_item = target_objects.get((target_project_id, item.name))
+    if target_item is None:
+        row.update(Action='create', Details="Not on the target")
+        return row
+
+    row['TargetId'] = target_item.id
+    # Unchanged on the source since its last publish and untouched on the target since
+    record = published_state.get(get_published_key(item_type, target_project_id, item.name))
+    if (skip_unchanged and record is not None and record.get('SourceId') == item.id
+            and record.get('SourceUpdatedAt') == row['UpdatedAt'] and record['Id'] == target_item.id
+            and record['UpdatedAt'] == get_updated_at(target_item)):
+        row.update(Action='skip', Details="Unchanged since the last publish")
+    else:
+        row.update(Action='overwrite', Details="Overwrites the target object updated at " + str(get_updated_at(target_item)))
+    return row
+
+
+def write_plan(filesystem_path, plan_rows):
+    with open(os.path.join(filesystem_path, PLAN_FILENAME), 'w', newline='') as plan_file:
+        writer = csv.DictWriter(plan_file, fieldnames=PLAN_FIELDS)
+        writer.writeheader()
+        writer.writerows(plan_rows)
+
+
+def get_plan_summary(plan_rows):
+    summary = {}
+    for row in plan_rows:
+        action_summary = summary.setdefault(row['Action'], {'Objects': 0, 'Bytes': 0, 'UnknownBytes': 0})
+        action_summary['Objects'] += 1
+        if row['Bytes'] is None:
+            action_summary['UnknownBytes'] += 1
+        else:
+            action_summary['Bytes'] += row['Bytes']
+    return summary
+
+
+def print_plan_summary(summary):
+    print(f"{'Action':<12}{'Objects':>10}{'Bytes':>16}{'Unknown size':>14}")
+    for action in ['create', 'overwrite', 'skip', 'error']:
+        if action in summary:
+            action_summary = summary[action]
+            print(f"{action:<12}{action_summary['Objects']:>10}{action_summary['Bytes']:>16}"
+                  f"{action_summary['UnknownBytes']:>14}")
+
+
+def tabpymigrate_plan(source_server_address, target_server_address, source_username=None, source_password=None,
+                      source_site_id=None, source_is_personal_access_token=False, target_username=None,
+                      target_password=None, target_site_id=None, target_is_personal_access_token=False,
+                      filesystem_path=None, tag_name=None, project_name=None, owner_name=None, updated_since=None,
+                      page_size=config.PAGE_SIZE, create_projects=config.CREATE_PROJECTS,
+                      skip_unchanged=config.SKIP_UNCHANGED_PUBLISH, inventory=False,
+                      inventory_workers=config.INVENTORY_WORKERS):
+    '''
+    Write the migration plan of the tagged source objects to filesystem_path/plan.csv.
+    With inventory the objects are selected from the inventory snapshots, which have no owners.
+    Returns ("Success", plan rows) or ("Error", details).
+    '''
+    try:
+        source_server, source_auth = getTableauAuth(source_server_address, username=source_username,
+                                                    password=source_password, site_id=source_site_id,
+                                                    is_personal_access_token=source_is_personal_access_token)
+        target_server, target_auth = gettableauauth(target_server_address, username=target_username,
+                                                    password=target_password, site_id=target_site_id,
+                                                    is_personal_access_token=target_is_personal_access_token)
+        filters = {'project_name': project_name, 'owner_name': owner_name,
+                   'updated_since': updated_since, 'page_size': page_size}
+        manifest = load_manifest(filesystem_path)
+        plan_rows = []
+
+        with sign_in(source_server, source_auth), sign_in(target_server, target_auth):
+            with metrics.phase('plan_inventory'):
+                if inventory:
+                    # Refreshed snapshots are as current as a listing, so the plan can rely on them
+                    source_inventory = refresh_inventory(source_server, filesystem_path, page_size, inventory_workers,
+                                                         tag_name=tag_name)
+                    target_inventory = refresh_inventory(target_server, filesystem_path, page_size, inventory_workers)
+                    source_project_index = get_inventory_project_index(source_inventory)
+                    target_project_index = get_inventory_project_index(target_inventory)
+                    source_items = select_inventory_items(source_inventory, tag_name, project_name, updated_since)
+                else:
+                    # The plan is only as good as the target inventory, so the project cache is not used
+                    source_project_index = get_project_index(source_server, filesystem_path, page_size=page_size)
+                    target_project_index = get_project_index(target_server, page_size=page_size)
+                published_state = load_published_state(get_published_state_path(filesystem_path, target_server))
+                for item_type, endpoint_name, fields in PLAN_TYPES:
+                    if inventory:
+                        target_objects = get_inventory_objects(target_inventory, endpoint_name)
+                        items = source_items[item_type]
+                        workbook_views = {item.id: item.views for item in items}
+                    else:
+                        target_objects = get_target_objects(target_server, item_type, endpoint_name, page_size)
+                        items = list(get_tagged_items(getattr(source_server, endpoint_name),
+                                                      get_request_options(tag_name, fields=fields, **filters),
+                                                      tag_name))
+                        workbook_views = get_workbook_views(source_server, items, page_size=page_size) \
+                            if item_type == 'Workbook' else {}
+                    for item in items:
+                        row = plan_item(item, item_type, source_project_index, target_project_index, target_objects,
+                                        published_state, manifest, create_projects, skip_unchanged)
+                        row['Sno'] = len(plan_rows) + 1
+                        if item_type == 'Workbook':
+                            row['Show_Tabs'] = item.show_tabs
+                            row['Views'] = workbook_views.get(item.id, [])
+                        plan_rows.append(row)
+
+        write_plan(filesystem_path, plan_rows)
+        print_plan_summary(get_plan_summary(plan_rows))
+        return "Success", plan_rows
+    except Exception as e:
+        response_details = "Error in TabPyMigrate Plan Execution:" + str(e)
+        print(response_details)
+        return "Error", response_details
+
+
+def load_plan_items(filesystem_path):
+    '''
+    Read the objects to transfer from plan.csv by type, in the shape of listed server items.
+    '''
+    items = {'Flow': [], 'Datasource': [], 'Workbook': []}
+    with open(os.path.join(filesystem_path, PLAN_FILENAME), 'r', newline='') as plan_file:
+        for row in csv.DictReader(plan_file):
+            if row['Action'] in NOT_TRANSFERRED_ACTIONS:
+                continue
+            items[row['Type']].append(SimpleNamespace(
+                id=row['Id'], name=row['Name'], project_id=row['ProjectId'], project_name=row['ProjectName'] or None,
+                updated_at=datetime.datetime.fromisoformat(row['UpdatedAt']) if row['UpdatedAt'] else None,
+                show_tabs=row['Show_Tabs'].lower() != 'false', views=ast.literal_eval(row['Views'] or '[]'),
+                # The estimated bytes in the unit of listed workbook sizes, for ordering the downloads
+                size=int(row['Bytes']) / WORKBOOK_SIZE_UNIT if row['Bytes'] else None))
+    return items
@@ -0,0 +1,175 @@
+'''
+    projects.py
+
+    Project index keyed by full project path ("Parent/Child/Grandchild") with parent links.
+    Built once per run from a paged listing, optionally cached on disk with a TTL, and used to
+    resolve publish targets even when nested projects share a name. A "/" inside a project
+    name is escaped as "\\/" in the path.
+'''
+import hashlib
+import json
+import os
+import time
+import tableauserverclient as TSC
+from . import config
+from .query import FieldsRequestOptions, get_items
+
+PROJECT_FIELDS = ['id', 'name', 'parentProjectId']
+
+
+def escape_project_name(name):
+    return name.replace('\\', '\\\\').replace('/', '\\/')
+
+
+def split_project_path(project_path):
+    # Split a project path into project names, honouring escaped separators
+    names, name, escaped = [], '', False
+    for character in project_path:
+        if escaped:
+            name += character
+            escaped = False
+        elif character == '\\':
+            escaped = True
+        elif character == '/':
+            names.append(name)
+            name = ''
+        else:
+            name += character
+    names.append(name)
+    return names
+
+
+def join_project_path(names):
+    return '/'.join(escape_project_name(name) for name in names)
+
+
+def build_project_index(projects):
+    '''
+    Build the index from (id, name, parent_id) tuples.
+    Returns a dict with the project entries by 'ById' and 'ByPath' plus the paths of each name in 'ByName'.
+    '''
+    by_id = {project_id: {'Id': project_id, 'Name': name, 'ParentId': parent_id, 'Path': None}
+             for project_id, name, parent_id in projects}
+
+    def get_path(project_id, visiting=()):
+        project = by_id[project_id]
+        if project['Path'] is None:
+            parent_id = project['ParentId']
+            if parent_id in by_id and parent_id not in visiting:
+                parent_path = get_path(parent_id, visiting + (project_id,))
+                project['Path'] = parent_path + '/' + escape_project_name(project['Name'])
+            else:
+                project['Path'] = escape_project_name(project['Name'])
+        return project['Path']
+
+    project_index = {'ById': by_id, 'ByPath': {}, 'ByName': {}}
+    for project_id in by_id:
+        add_project(project_index, by_id[project_id], get_path(project_id))
+    return project_index
+
+
+def add_project(project_index, project, project_path):
+    project_index.pop('Digest', None)
+    project['Path'] = project_path
+    project_index['ById'][project['Id']] = project
+    project_index['ByPath'][project_path] = project
+    project_index['ByName'].setdefault(project['Name'], []).append(project_path)
+
+
+def get_project_index_digest(project_index):
+    # Hash of the project ids and paths, kept in the index until a project is added
+    digest = project_index.get('Digest')
+    if digest is None:
+        projects = sorted((project['Id'], project['Path']) for project in project_index['ById'].values())
+        digest = project_index['Digest'] = hashlib.sha1(json.dumps(projects).encode()).hexdigest()
+    return digest
+
+
+def get_project_cache_path(filesystem_path, server):
+    server_key = f"{server.server_address}|{server.site_id}".encode()
+    return os.path.join(filesystem_path, '_cache', f"projects_{hashlib.sha1(server_key).hexdigest()}.json")
+
+
+def save_project_index(cache_path, project_index):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    projects = [[project['Id'], project['Name'], project['ParentId']] for project in project_index['ById'].values()]
+    temp_path = cache_path + '.tmp'
+    with open(temp_path, 'w') as cache_file:
+        json.dump({'CreatedAt': time.time(), 'Projects': projects}, cache_file)
+    os.replace(temp_path, cache_path)
+
+
+def get_project_index(server, filesystem_path=None, cache_ttl=config.PROJECT_CACHE_TTL, page_size=config.PAGE_SIZE):
+    '''
+    Page all projects of the signed-in site into a project index, reusing the on-disk cache
+    in filesystem_path/_cache when it is younger than cache_ttl seconds.
+    '''
+    cache_path = get_project_cache_path(filesystem_path, server) if filesystem_path and cache_ttl else None
+    if cache_path is not None and os.path.isfile(cache_path):
+        with open(cache_path, 'r') as cache_file:
+            cache = json.load(cache_file)
+        if time.time() - cache['CreatedAt'] < cache_ttl:
+            return build_project_index(tuple(project) for project in cache['Projects'])
+
+    request_options = FieldsRequestOptions(pagesize=page_size, fields=PROJECT_FIELDS)
+    project_index = build_project_index((project.id, project.name, project.parent_id)
+                                        for project in get_items(server.projects, request_options))
+    if cache_path is not None:
+        save_project_index(cache_path, project_index)
+    return project_index
+
+
+def get_project_path(project_index, project_id):
+    project = project_index['ById'].get(project_id)
+    return project['Path'] if project is not None else None
+
+
+def resolve_project_id(project_index, project_path=None, project_name=None):
+    '''
+    Return the ID of the project at project_path, or of the only project called project_name
+    when no path is known. Returns None when not found or when the name is ambiguous.
+    '''
+    if project_path:
+        project = project_index['ByPath'].get(project_path)
+        return project['Id'] if project is not None else None
+    paths = project_index['ByName'].get(project_name, [])
+    if len(paths) > 1:
+        return None
+    return project_index['ByPath'][paths[0]]['Id'] if paths else None
+
+
+def get_unresolved_project_details(project_index, project_path=None, project_name=None):
+    # Error details of a project resolve_project_id returned no ID for, a name shared by nested projects is ambiguous
+    paths = project_index['ByName'].get(project_name, []) if not project_path else []
+    if len(paths) > 1:
+        return f"Project name is ambiguous in server:{project_name} ({', '.join(sorted(paths))})"
+    return "Project not found in server:" + str(project_path or project_name)
+
+
+def create_project_paths(server, project_index, project_paths, filesystem_path=None):
+    '''
+    Create every missing project along the given paths, parents before children and each one once.
+    Returns the list of created paths.
+    '''
+    missing_paths = set()
+    for project_path in project_paths:
+        names = split_project_path(project_path)
+        for depth in range(1, len(names) + 1):
+            path = join_project_path(names[:depth])
+            if path not in project_index['ByPath']:
+                missing_paths.add((depth, path))
+
+    created_paths = []
+    for depth, path in sorted(missing_paths):
+        names = split_project_path(path)
+        parent = project_index['ByPath'].get(join_project_path(names[:-1])) if depth > 1 else None
+        new_project = server.projects.create(TSC.ProjectItem(name=names[-1],
+                                                             parent_id=parent['Id'] if parent else None))
+        add_project(project_index, {'Id': new_project.id, 'Name': new_project.name,
+                                    'ParentId': new_project.parent_id}, path)
+        created_paths.append(path)
+        print("Created project", path)
+
+    if created_paths and filesystem_path and config.PROJECT_CACHE_TTL:
+        save_project_index(get_project_cache_path(filesystem_path, server), project_index)
+    return created_paths
@@ -0,0 +1,63 @@
+'''
+    query.py
+
+    Paged REST queries keeping filters and the trimmed field list on every page.
+'''
+import copy
+from concurrent.futures import ThreadPoolExecutor
+import tableauserverclient as TSC
+from .transport import call_with_reauth
+
+
+# Request options which also send the trimmed field list to the server
+class FieldsRequestOptions(TSC.RequestOptions):
+    def __init__(self, pagenumber=1, pagesize=100, fields=None):
+        super().__init__(pagenumber=pagenumber, pagesize=pagesize)
+        self.fields = fields
+
+    def get_query_params(self):
+        params = super().get_query_params()
+        if self.fields:
+            params['fields'] = ','.join(self.fields)
+        return params
+
+
+# Page through an endpoint keeping filters and fields on every page (TSC.Pager drops the fields)
+def get_items(endpoint, request_options):
+    while True:
+        items, pagination_item = call_with_reauth(endpoint.parent_srv, endpoint.get, request_options)
+        for item in items:
+            yield item
+        if pagination_item.total_available is None or not items:
+            return
+        if pagination_item.page_number * pagination_item.page_size >= pagination_item.total_available:
+            return
+        request_options.pagenumber = pagination_item.page_number + 1
+
+
+def get_page_count(pagination_item):
+    if not pagination_item.total_available or not pagination_item.page_size:
+        return 1
+    return -(-pagination_item.total_available // pagination_item.page_size)
+
+
+def get_page(endpoint, request_options, page_number):
+    # One page of a listing, on a copy of the request options so pages can be fetched concurrently
+    page_options = copy.deepcopy(request_options)
+    page_options.pagenumber = page_number
+    return call_with_reauth(endpoint.parent_srv, endpoint.get, page_options)
+
+
+# Page through an endpoint like get_items, the pages after the first are fetched concurrently once the
+# first page tells the total count. Items are still yielded in page order.
+def get_items_parallel(endpoint, request_options, workers=1):
+    items, pagination_item = get_page(endpoint, request_options, 1)
+    yield from items
+    page_count = get_page_count(pagination_item)
+    if page_count <= 1 or not items:
+        return
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = [executor.submit(get_page, endpoint, request_options, page_number)
+                   for page_number in range(2, page_count + 1)]
+        for future in futures:
+            yield from future.result()[0]
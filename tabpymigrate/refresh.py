@@ -0,0 +1,132 @@
+'''
+    refresh.py
+
+    Extract refreshes on the target for datasources and workbooks downloaded without their extract
+    data (include_extract=False). Only the connection definitions are transferred and published; an
+    extract refresh job is started on the target right after each publish, so the target rebuilds
+    the extracts in parallel, and the jobs can be waited on together at the end of the publish.
+'''
+import csv
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import tableauserverclient as TSC
+from . import config
+from . import metrics
+from .mapping import has_extract_definitions
+from .transport import call_with_reauth
+
+REFRESH_CSV_FILENAME = 'refresh_jobs.csv'
+
+# Publish CSVs with the RefreshJobId of the refreshes started by the publish
+REFRESH_PUBLISH_CSV_FILENAMES = ['datasources_publish.csv', 'workbooks_publish.csv']
+
+# Extract column of the download CSVs for objects downloaded without their extract data
+EXTRACT_EXCLUDED = 'Excluded'
+
+JOB_STATUSES = {TSC.JobItem.FinishCode.Success: 'Success',
+                TSC.JobItem.FinishCode.Failed: 'Failed',
+                TSC.JobItem.FinishCode.Cancelled: 'Cancelled'}
+
+
+def get_extract_column(filepath, include_extract=True):
+    # Extract column of a download: Excluded when downloaded without the data of its extracts
+    if include_extract or not filepath or not os.path.isfile(filepath):
+        return ''
+    try:
+        return EXTRACT_EXCLUDED if has_extract_definitions(filepath) else ''
+    except Exception as e:
+        print(f"Could not read the extracts of '{filepath}': {str(e)}")
+        return ''
+
+
+def start_refresh(server, object_type, item_id):
+    # Start the extract refresh of a published datasource or workbook, returns the job ID
+    endpoint = server.datasources if object_type == 'Datasource' else server.workbooks
+    return call_with_reauth(server, endpoint.refresh, item_id).id
+
+
+def refresh_published(server, row, object_type, item_id):
+    '''
+    Start the extract refresh of an object published without its extract data.
+    Returns the job ID, None when not needed or not started, and the details to add to the publish details.
+    '''
+    if row.get('Extract') != EXTRACT_EXCLUDED:
+        return None, ''
+    try:
+        job_id = start_refresh(server, object_type, item_id)
+    except Exception as e:
+        return None, "\nExtract refresh could not be started:" + str(e)
+    return job_id, "\nExtract refresh job started:" + str(job_id)
+
+
+def get_job_status(job):
+    if job.completed_at is None:
+        return 'InProgress'
+    return JOB_STATUSES.get(job.finish_code, 'Unknown')
+
+
+def write_refresh_csv(csv_filename, job_rows):
+    with open(csv_filename, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=['Type', 'ProjectName', 'Name', 'JobId', 'Status', 'Details'])
+        writer.writeheader()
+        writer.writerows(job_rows)
+
+
+def get_refresh_jobs(publish_path):
+    # Refresh jobs started by the publish, read back from the RefreshJobId column of its publish CSVs
+    jobs = {}
+    for csv_filename in REFRESH_PUBLISH_CSV_FILENAMES:
+        csv_path = os.path.join(publish_path, csv_filename)
+        if not os.path.isfile(csv_path):
+            continue
+        with open(csv_path, 'r', newline='') as csvfile:
+            for row in csv.DictReader(csvfile):
+                if row.get('RefreshJobId'):
+                    jobs[row['RefreshJobId']] = {'Type': row['Type'], 'ProjectName': row['ProjectName'],
+                                                 'Name': row['Name'], 'JobId': row['RefreshJobId'],
+                                                 'Status': 'InProgress', 'Details': ''}
+    return jobs
+
+
+def wait_for_refresh_jobs(server, publish_path, workers=1, timeout=config.REFRESH_TIMEOUT,
+                          poll_interval=config.REFRESH_POLL_INTERVAL):
+    '''
+    Poll the refresh jobs started by the publish whose CSVs are in publish_path until every job
+    completed or the timeout passed. The job results are written to publish_path/refresh_jobs.csv.
+    Returns the job rows.
+    '''
+    jobs = get_refresh_jobs(publish_path)
+    csv_filename = os.path.join(publish_path, REFRESH_CSV_FILENAME)
+    if not jobs:
+        write_refresh_csv(csv_filename, [])
+        return []
+    print(f"Waiting for {len(jobs)} extract refresh jobs")
+
+    def poll(job_id):
+        try:
+            job = call_with_reauth(server, server.jobs.get_by_id, job_id)
+            return job_id, get_job_status(job), '; '.join(job.notes or [])
+        except Exception as e:
+            return job_id, 'Error', str(e)
+
+    deadline = time.monotonic() + timeout if timeout else None
+    pending = set(jobs)
+    with metrics.phase('refresh_jobs'), ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        while pending:
+            for job_id, status, details in executor.map(poll, sorted(pending)):
+                if status != 'InProgress':
+                    jobs[job_id].update(Status=status, Details=details)
+                    pending.discard(job_id)
+            metrics.record_queue_depth('refresh_jobs', len(pending))
+            if not pending or (deadline is not None and time.monotonic() >= deadline):
+                break
+            time.sleep(poll_interval)
+
+    job_rows = list(jobs.values())
+    write_refresh_csv(csv_filename, job_rows)
+    statuses = {}
+    for job_row in job_rows:
+        statuses[job_row['Status']] = statuses.get(job_row['Status'], 0) + 1
+    print("Extract refresh jobs:", statuses)
+    return job_rows
@@ -0,0 +1,58 @@
+'''
+    results.py
+
+    Streaming results of a run. The download and publish functions report every object to a Results
+    sink as soon as it is done instead of appending it to a list: the sink hands a compact record of
+    the object to an optional callback and only keeps counters by stage, type and response, so memory
+    stays constant in the number of objects. The full rows are in the download and publish CSVs.
+'''
+import threading
+
+RECORD_FIELDS = ['Stage', 'Type', 'Id', 'Name', 'ProjectName', 'Response', 'Details']
+
+
+def get_record(stage, details):
+    # Compact record of an object result, without the paths, views and other CSV columns
+    record = {'Stage': stage}
+    record.update((field, details.get(field)) for field in RECORD_FIELDS[1:])
+    return record
+
+
+class Results(object):
+    '''
+    Sink of object results. callback(record) is called with the compact record of every object
+    from the thread which finished it, so it must be thread safe with parallel workers.
+    '''
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, details):
+        record = get_record(stage, details)
+        with self._lock:
+            type_counts = self._counts.setdefault(stage, {}).setdefault(record['Type'], {})
+            type_counts[record['Response']] = type_counts.get(record['Response'], 0) + 1
+        if self.callback is not None:
+            self.callback(record)
+        return record
+
+    def get_total(self, stage, response=None):
+        # Objects of a stage, only those with the given response when one is given
+        with self._lock:
+            return sum(count for type_counts in self._counts.get(stage, {}).values()
+                       for object_response, count in type_counts.items()
+                       if response is None or object_response == response)
+
+    def get_summary(self):
+        # Counts by stage, type and response, e.g. {'publish': {'Workbook': {'Success': 10, 'Error': 1}}}
+        with self._lock:
+            return {stage: {object_type: dict(response_counts) for object_type, response_counts in type_counts.items()}
+                    for stage, type_counts in self._counts.items()}
+
+    def print_summary(self, stage=None):
+        for summary_stage, type_counts in self.get_summary().items():
+            if stage is None or summary_stage == stage:
+                for object_type, response_counts in sorted(type_counts.items()):
+                    print(f"{summary_stage} {object_type}:", response_counts)
@@ -0,0 +1,123 @@
+'''
+    rules.py
+
+    Connection remapping rules: source connection attributes (class, server, port, dbname and
+    username, with * ? [] wildcards) mapped to the target values. The rules file is compiled once
+    into a lookup indexed by exact server name, and the target values of every distinct source
+    connection are memoized, so each connection of a migration costs one dictionary lookup
+    instead of a scan over all rules.
+'''
+import fnmatch
+import hashlib
+import json
+import re
+import threading
+from typing import Dict
+
+# Connection attributes a rule matches on and the attributes it can set
+MATCH_FIELDS = ['class', 'server', 'port', 'dbname', 'username']
+TARGET_FIELDS = ['server', 'port', 'dbname', 'username']
+
+WILDCARD_CHARACTERS = set('*?[')
+
+
+def normalize_value(field, value):
+    # Attribute values compared as text, server names are case-insensitive
+    if value is None:
+        return None
+    value = str(value)
+    return value.lower() if field == 'server' else value
+
+
+def compile_pattern(field, pattern):
+    # Exact values stay strings for indexing, wildcard patterns become compiled regular expressions
+    pattern = normalize_value(field, pattern)
+    if not set(pattern) & WILDCARD_CHARACTERS:
+        return pattern
+    return re.compile(fnmatch.translate(pattern))
+
+
+def match_pattern(pattern, value):
+    if value is None:
+        return False
+    if isinstance(pattern, str):
+        return pattern == value
+    return pattern.match(value) is not None
+
+
+class ConnectionRules(object):
+    '''
+    Compiled connection rules, the first rule of the list matching a connection wins.
+    A rule is {'match': {attribute: pattern}, 'set': {attribute: target value}}, a rule
+    without match attributes matches every connection.
+    '''
+
+    def __init__(self, rules=()):
+        rules = list(rules)
+        # Hash of the rules, mapped copies built with other rules are mapped again
+        self.digest = hashlib.sha1(json.dumps(rules, sort_keys=True).encode()).hexdigest()
+        self.rule_count = 0
+        self._by_server = {}
+        self._other_rules = []
+        self._cache = {}
+        for order, rule in enumerate(rules):
+            match, updates = rule.get('match') or {}, rule.get('set') or {}
+            unknown = (set(match) - set(MATCH_FIELDS)) | (set(updates) - set(TARGET_FIELDS))
+            if unknown:
+                raise ValueError(f"Connection rule {order + 1} has unknown attributes: {sorted(unknown)}")
+            if not updates:
+                raise ValueError(f"Connection rule {order + 1} sets no attributes")
+            patterns = {field: compile_pattern(field, pattern) for field, pattern in match.items()}
+            compiled = (order, patterns, {field: str(value) for field, value in updates.items()})
+            if isinstance(patterns.get('server'), str):
+                self._by_server.setdefault(patterns['server'], []).append(compiled)
+            else:
+                self._other_rules.append(compiled)
+            self.rule_count += 1
+
+    def __len__(self):
+        return self.rule_count
+
+    def get_updates(self, attributes):
+        '''
+        Target values of a connection given its attributes, {} when no rule matches.
+        The returned dict is shared by all connections with the same attributes.
+        '''
+        key = tuple(normalize_value(field, attributes.get(field)) for field in MATCH_FIELDS)
+        updates = self._cache.get(key)
+        if updates is None:
+            updates = self._cache[key] = self._find_updates(dict(zip(MATCH_FIELDS, key)))
+        return updates
+
+    def _find_updates(self, values):
+        # Both rule lists are in file order, so the first match of each is the only candidate
+        best = None
+        for rules in (self._by_server.get(values['server'], []), self._other_rules):
+            for order, patterns, updates in rules:
+                if best is not None and order > best[0]:
+                    break
+                if all(match_pattern(pattern, values[field]) for field, pattern in patterns.items()):
+                    best = (order, updates)
+                    break
+        return best[1] if best is not None else {}
+
+
+# Compiled rules by rules file, shared by every worker and target of the run
+_loaded_rules: Dict[str, 'ConnectionRules'] = {}
+_rules_lock = threading.Lock()
+
+
+def load_connection_rules(rules_file):
+    '''
+    Compile the JSON list of rules in rules_file, once per file. Returns empty rules for no file.
+    '''
+    if not rules_file:
+        return ConnectionRules()
+    with _rules_lock:
+        if rules_file not in _loaded_rules:
+            with open(rules_file, 'r') as rules_json:
+                rules = json.load(rules_json)
+            if not isinstance(rules, list):
+                raise ValueError(f"Connection rules file must hold a list of rules: {rules_file}")
+            _loaded_rules[rules_file] = ConnectionRules(rules)
+        return _loaded_rules[rules_file]
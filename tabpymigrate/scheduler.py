@@ -0,0 +1,99 @@
+'''
+    scheduler.py
+
+    Dependency graph and level by level scheduling used for parallel publishing.
+    Datasources are published first, workbooks and flows that read a published
+    datasource of the same migration wait for the level holding that datasource.
+'''
+import os
+from concurrent.futures import ThreadPoolExecutor
+from .mapping import get_flow_datasource_names, get_workbook_datasource_names
+
+
+def get_datasource_references(row, get_names):
+    # Datasource names referenced by a downloaded object, empty when the file can't be read
+    if row.get('Response') == 'Error' or not row.get('Path'):
+        return set()
+    try:
+        return get_names(row['Path'])
+    except Exception as e:
+        print(f"Could not read datasource references from {row['Path']}: {str(e)}")
+        return set()
+
+
+def build_publish_graph(flows, datasources, workbooks):
+    '''
+    Build publish tasks from the download CSV rows with the keys of the tasks they depend on.
+    Datasource references are matched by name, a name shared by several projects depends on all of them.
+    '''
+    tasks = {}
+    datasource_keys = {}
+    for datasource in datasources:
+        key = ('Datasource', datasource['Sno'])
+        tasks[key] = {'Key': key, 'Type': 'Datasource', 'Row': datasource, 'DependsOn': set()}
+        datasource_keys.setdefault(datasource['Name'], set()).add(key)
+
+    for object_type, rows, get_names in (('Flow', flows, get_flow_datasource_names),
+                                         ('Workbook', workbooks, get_workbook_datasource_names)):
+        for row in rows:
+            key = (object_type, row['Sno'])
+            depends_on = set()
+            for name in get_datasource_references(row, get_names):
+                depends_on |= datasource_keys.get(name, set())
+            tasks[key] = {'Key': key, 'Type': object_type, 'Row': row, 'DependsOn': depends_on}
+    return tasks
+
+
+def get_publish_levels(tasks):
+    '''
+    Group tasks into levels (Kahn's algorithm): every task only depends on tasks of earlier levels.
+    '''
+    remaining = {key: set(task['DependsOn']) for key, task in tasks.items()}
+    dependents = {}
+    for key, depends_on in remaining.items():
+        for dependency in depends_on:
+            dependents.setdefault(dependency, []).append(key)
+
+    levels = []
+    ready = [key for key, depends_on in remaining.items() if not depends_on]
+    while ready:
+        levels.append([tasks[key] for key in ready])
+        next_ready = []
+        for key in ready:
+            del remaining[key]
+            for dependent in dependents.get(key, []):
+                remaining[dependent].discard(key)
+                if not remaining[dependent]:
+                    next_ready.append(dependent)
+        ready = next_ready
+
+    if remaining:
+        raise ValueError(f"Cyclic publish dependencies between: {sorted(remaining)}")
+    return levels
+
+
+def get_task_size(task):
+    # Bytes of the downloaded file of a task, 0 when it wasn't downloaded
+    path = task['Row'].get('Path')
+    return os.path.getsize(path) if path and os.path.isfile(path) else 0
+
+
+def run_levels(levels, function, workers=1, get_size=None, byte_budget=None):
+    '''
+    Run function on every task, one level after the other with the tasks of a level in parallel.
+    With get_size the largest tasks of a level start first, so a big task doesn't run alone at the
+    end of the level, and a byte budget (throttle.ByteBudget) caps the bytes of the tasks in flight.
+    Yields (level number, task, result) in start order within each level.
+    '''
+    def run(task):
+        if byte_budget is None:
+            return function(task)
+        with byte_budget.reserve(get_size(task) if get_size else 0):
+            return function(task)
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for level_number, level in enumerate(levels, start=1):
+            if get_size is not None:
+                level = sorted(level, key=get_size, reverse=True)
+            for task, result in zip(level, executor.map(run, level)):
+                yield level_number, task, result
@@ -0,0 +1,171 @@
+'''
+    store.py
+
+    Content-addressed store of downloaded files in filesystem_path/_store/<hash[:2]>/<hash>.
+    Downloads with identical content are hard links to one store entry, so they take the disk
+    space once. The hash of what was last published to every target object is appended per target
+    to filesystem_path/_cache/published_<server>.jsonl, so an object whose content, project and
+    publish options didn't change since is not uploaded again.
+'''
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from typing import Any, Dict
+from .manifest import get_file_hash
+from .transport import call_with_reauth
+
+STORE_FOLDER = '_store'
+PARTIAL_FOLDER = 'partial'
+
+_store_lock = threading.Lock()
+_published_lock = threading.Lock()
+# Published state of every target by state path, loaded on first use
+_published_states: Dict[str, Dict[str, Dict[str, Any]]] = {}
+
+
+def get_store_root(filesystem_path):
+    return os.path.join(filesystem_path, STORE_FOLDER)
+
+
+def get_partial_path(store_root):
+    # Folder a download is written to before it replaces the file in its project folder.
+    # Writing in place would truncate every file hard linked to the previous download.
+    partial_path = os.path.join(store_root, PARTIAL_FOLDER, uuid.uuid4().hex)
+    os.makedirs(partial_path, exist_ok=True)
+    return partial_path
+
+
+def move_download(partial_file, download_path):
+    filepath = os.path.join(download_path, os.path.basename(partial_file))
+    os.replace(partial_file, filepath)
+    return filepath
+
+
+def add_to_store(store_root, filepath, file_hash=None):
+    '''
+    Add a downloaded file to the store. A file identical to a stored one is replaced by a hard link
+    to the stored file. Returns the content hash.
+    '''
+    file_hash = file_hash or get_file_hash(filepath)
+    store_path = os.path.join(store_root, file_hash[:2], file_hash)
+    os.makedirs(os.path.dirname(store_path), exist_ok=True)
+    with _store_lock:
+        try:
+            if not os.path.isfile(store_path):
+                os.link(filepath, store_path)
+            elif not os.path.samefile(filepath, store_path):
+                # Link under a temp name first so the download is never missing
+                temp_path = filepath + '.link'
+                os.link(store_path, temp_path)
+                os.replace(temp_path, filepath)
+        except OSError as e:
+            # Filesystems without hard links keep the plain download
+            print(f"Could not link '{filepath}' into the content store: {str(e)}")
+    return file_hash
+
+
+def prune_store(store_root):
+    '''
+    Remove store entries no download links to anymore and partial downloads of interrupted runs.
+    Returns the number of bytes freed.
+    '''
+    freed = 0
+    if not os.path.isdir(store_root):
+        return freed
+    shutil.rmtree(os.path.join(store_root, PARTIAL_FOLDER), ignore_errors=True)
+    with _store_lock:
+        for folder in os.scandir(store_root):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                entry_stat = entry.stat()
+                if entry_stat.st_nlink <= 1:
+                    os.remove(entry.path)
+                    freed += entry_stat.st_size
+    return freed
+
+
+def get_publish_hash(filepath, **options):
+    # Hash of the published file together with the publish options that change the target object
+    sha256 = hashlib.sha256(get_file_hash(filepath).encode())
+    sha256.update(json.dumps(options, sort_keys=True, default=str).encode())
+    return sha256.hexdigest()
+
+
+def get_published_state_path(filesystem_path, server):
+    server_key = f"{server.server_address}|{server.site_id}".encode()
+    return os.path.join(filesystem_path, '_cache', f"published_{hashlib.sha1(server_key).hexdigest()}.jsonl")
+
+
+def load_published_state(state_path):
+    # Appended records are read once per target, the latest record of a key wins
+    with _published_lock:
+        if state_path not in _published_states:
+            state = {}
+            if os.path.isfile(state_path):
+                with open(state_path, 'r') as state_file:
+                    for line in state_file:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            # A line cut short by a crash is ignored
+                            continue
+                        state[record['Key']] = record
+            _published_states[state_path] = state
+        return _published_states[state_path]
+
+
+def get_published_key(object_type, project_id, name):
+    # Publishing overwrites the object with the same name in the project, which identifies it on the target
+    return f"{object_type}|{project_id}|{name}"
+
+
+def get_unchanged_publish(server, endpoint, state_path, key, publish_hash):
+    '''
+    Return the record of the last publish of the object when it had the same publish hash and the
+    target object is still the one published then, otherwise None.
+    '''
+    record = load_published_state(state_path).get(key)
+    if record is None or record['Hash'] != publish_hash:
+        return None
+    return record if is_published_current(server, endpoint, record) else None
+
+
+def is_published_current(server, endpoint, record):
+    # The target object is still the one of the publish record, not deleted or changed on the target since
+    try:
+        target_item = call_with_reauth(server, endpoint.get_by_id, record['Id'])
+    except Exception:
+        # Deleted on the target, or not readable: publish again
+        return False
+    updated_at = target_item.updated_at.isoformat() if target_item.updated_at is not None else None
+    return updated_at == record['UpdatedAt']
+
+
+def save_published(state_path, key, publish_hash, published_item, source_row=None, watermark=None,
+                   connection_count=None):
+    # The source revision lets a plan tell an object unchanged on both sides without downloading it,
+    # the watermark of an append datasource is where the next publish appends from and the connection
+    # count of the published file is what verification expects on the target
+    source_row = source_row or {}
+    record = {'Key': key,
+              'Hash': publish_hash,
+              'Id': published_item.id,
+              'UpdatedAt': published_item.updated_at.isoformat() if published_item.updated_at is not None else None,
+              'Url': published_item.webpage_url,
+              'SourceId': source_row.get('Id'),
+              'SourceUpdatedAt': source_row.get('UpdatedAt') or None,
+              'Watermark': watermark,
+              'Connections': connection_count}
+    state = load_published_state(state_path)
+    with _published_lock:
+        os.makedirs(os.path.dirname(state_path), exist_ok=True)
+        with open(state_path, 'a') as state_file:
+            state_file.write(json.dumps(record) + '\n')
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        state[key] = record
+    return record
@@ -4,14 +4,45 @@
     Tabpymigrate.py gets all input from config.py and execute download and publish for tableau server.
 '''
 import argparse
+import json
 import sys
 from . import config
+from . import metrics
+from .fanout import tabpymigrate_publish_targets
+from .inventory import select_inventory_items, tabpymigrate_inventory
+from .journal import open_journal
+from .pipeline import tabpymigrate_pipeline
+from .plan import load_plan_items, tabpymigrate_plan
+from .results import Results
 from .tabpymigrate_download import tabpymigrate_download
 from .tabpymigrate_publish import tabpymigrate_publish
 
 
 def execute(action=config.ACTION,
             tag_name=config.TAG_NAME,
+            project_name=config.PROJECT_NAME,
+            owner_name=config.OWNER_NAME,
+            updated_since=config.UPDATED_SINCE,
+            page_size=config.PAGE_SIZE,
+            inventory=config.INVENTORY,
+            inventory_workers=config.INVENTORY_WORKERS,
+            download_workers=config.DOWNLOAD_WORKERS,
+            incremental=config.INCREMENTAL_DOWNLOAD,
+            publish_workers=config.PUBLISH_WORKERS,
+            create_projects=config.CREATE_PROJECTS,
+            resume=config.RESUME,
+            pipeline=config.PIPELINE,
+            staging_budget=config.STAGING_BUDGET_BYTES,
+            collect_metrics=config.METRICS,
+            metrics_textfile=config.METRICS_TEXTFILE,
+            content_store=config.CONTENT_STORE,
+            skip_unchanged=config.SKIP_UNCHANGED_PUBLISH,
+            include_extract=config.INCLUDE_EXTRACT,
+            wait_for_refresh=config.WAIT_FOR_REFRESH,
+            connection_rules_file=config.CONNECTION_RULES_FILE,
+            verify=config.VERIFY_PUBLISH,
+            append_datasources=config.APPEND_DATASOURCES,
+            from_plan=config.FROM_PLAN,
             filesystem_path=config.FILESYSTEM_PATH,
             source_server_address=config.SOURCE_SERVER_ADDRESS,
             source_site_id=config.SOURCE_SITE_ID,
@@ -22,39 +53,180 @@ def execute(action=config.ACTION,
             target_site_id=config.TARGET_SITE_ID,
             target_username=config.TARGET_USERNAME,
             target_password=config.TARGET_PASSWORD,
-            target_is_personal_access_token=config.TARGET_IS_PERSONAL_ACCESS_TOKEN
+            target_is_personal_access_token=config.TARGET_IS_PERSONAL_ACCESS_TOKEN,
+            targets=config.TARGETS,
+            result_callback=None
             ):
     '''
     TabPyMigrate Execute function to call download and publish
+    result_callback(record) is called with a compact record of every object as soon as it is downloaded
+    or published (results.RECORD_FIELDS). Returns the counts of the objects by stage, type and response.
     '''
 
-    if action.upper() not in ["DOWNLOAD", "PUBLISH","DOWNLOAD_AND_PUBLISH"]:
+    if action.upper() not in ["DOWNLOAD", "PUBLISH", "DOWNLOAD_AND_PUBLISH", "PLAN", "INVENTORY"]:
         print("Invalid Action given...")
         sys.exit()
 
-    if action.upper() in ["DOWNLOAD", "DOWNLOAD_AND_PUBLISH"]:
-        print("Starting the Download....")
-        # Call download function
-        tabpymigrate_download(server_address=source_server_address,
-                              site_id=source_site_id,
-                              username=source_username,
-                              password=source_password,
-                              is_personal_access_token=source_is_personal_access_token,
-                              tag_name=tag_name,
-                              filesystem_path=filesystem_path
-                              )
-        print("Completed the Download....")
-
-    if action.upper() in ["PUBLISH", "DOWNLOAD_AND_PUBLISH"]:
-        print("Starting the Publish....")
-        # Execute Publish function
-        tabpymigrate_publish(server_address=target_server_address,
-                             site_id=target_site_id,
-                             username=target_username,
-                             password=target_password,
-                             is_personal_access_token=target_is_personal_access_token,
-                             filesystem_path=filesystem_path)
-        print("Completed the Download....")
+    # One run journal for the download and publish of this execution
+    journal = open_journal(filesystem_path, resume)
+    # Results are streamed to result_callback, only their counts are kept
+    results = Results(result_callback)
+
+    if collect_metrics:
+        metrics.start_run(filesystem_path, metrics_textfile or None)
+    # The pipeline publishes each object as soon as it is downloaded and mapped, to a single target
+    pipelined = pipeline and action.upper() == "DOWNLOAD_AND_PUBLISH" and not targets
+    # Objects to download from the plan written by an earlier PLAN action
+    plan_items = load_plan_items(filesystem_path) if from_plan and action.upper() != "PLAN" else None
+    # The inventory snapshots have no owner names, an owner filter lists the source instead
+    if inventory and owner_name:
+        print("The inventory can't select by owner, listing the source....")
+        inventory = False
+    try:
+        if action.upper() == "INVENTORY" or (inventory and plan_items is None
+                                             and action.upper() in ["DOWNLOAD", "DOWNLOAD_AND_PUBLISH"]):
+            print("Starting the Inventory....")
+            with metrics.phase('inventory'):
+                status, source_inventory = tabpymigrate_inventory(server_address=source_server_address,
+                                                                  username=source_username,
+                                                                  password=source_password,
+                                                                  site_id=source_site_id,
+                                                                  is_personal_access_token=source_is_personal_access_token,
+                                                                  filesystem_path=filesystem_path,
+                                                                  page_size=page_size,
+                                                                  workers=inventory_workers,
+                                                                  tag_name=tag_name)
+            # Objects to download selected from the snapshot, listed from the source when it failed
+            if status == "Success" and action.upper() != "INVENTORY":
+                plan_items = select_inventory_items(source_inventory, tag_name, project_name, updated_since)
+            print("Completed the Inventory....")
+
+        if action.upper() == "PLAN":
+            print("Starting the Plan....")
+            with metrics.phase('plan'):
+                tabpymigrate_plan(source_server_address=source_server_address,
+                                  target_server_address=target_server_address,
+                                  source_username=source_username,
+                                  source_password=source_password,
+                                  source_site_id=source_site_id,
+                                  source_is_personal_access_token=source_is_personal_access_token,
+                                  target_username=target_username,
+                                  target_password=target_password,
+                                  target_site_id=target_site_id,
+                                  target_is_personal_access_token=target_is_personal_access_token,
+                                  filesystem_path=filesystem_path,
+                                  tag_name=tag_name,
+                                  project_name=project_name,
+                                  owner_name=owner_name,
+                                  updated_since=updated_since,
+                                  page_size=page_size,
+                                  create_projects=create_projects,
+                                  skip_unchanged=skip_unchanged,
+                                  inventory=inventory,
+                                  inventory_workers=inventory_workers)
+            print("Completed the Plan....")
+
+        if pipelined:
+            print("Starting the pipelined Download and Publish....")
+            with metrics.phase('download_and_publish'):
+                tabpymigrate_pipeline(source_server_address=source_server_address,
+                                      target_server_address=target_server_address,
+                                      source_username=source_username,
+                                      source_password=source_password,
+                                      source_site_id=source_site_id,
+                                      source_is_personal_access_token=source_is_personal_access_token,
+                                      target_username=target_username,
+                                      target_password=target_password,
+                                      target_site_id=target_site_id,
+                                      target_is_personal_access_token=target_is_personal_access_token,
+                                      filesystem_path=filesystem_path,
+                                      tag_name=tag_name,
+                                      project_name=project_name,
+                                      owner_name=owner_name,
+                                      updated_since=updated_since,
+                                      page_size=page_size,
+                                      download_workers=download_workers,
+                                      incremental=incremental,
+                                      publish_workers=publish_workers,
+                                      create_projects=create_projects,
+                                      staging_budget=staging_budget,
+                                      content_store=content_store,
+                                      skip_unchanged=skip_unchanged,
+                                      include_extract=include_extract,
+                                      wait_for_refresh=wait_for_refresh,
+                                      connection_rules_file=connection_rules_file,
+                                      verify=verify,
+                                      append_datasources=append_datasources,
+                                      plan_items=plan_items,
+                                      results=results,
+                                      journal=journal)
+            print("Completed the pipelined Download and Publish....")
+
+        if action.upper() in ["DOWNLOAD", "DOWNLOAD_AND_PUBLISH"] and not pipelined:
+            print("Starting the Download....")
+            # Call download function
+            with metrics.phase('download'):
+                tabpymigrate_download(server_address=source_server_address,
+                                      site_id=source_site_id,
+                                      username=source_username,
+                                      password=source_password,
+                                      is_personal_access_token=source_is_personal_access_token,
+                                      tag_name=tag_name,
+                                      filesystem_path=filesystem_path,
+                                      project_name=project_name,
+                                      owner_name=owner_name,
+                                      updated_since=updated_since,
+                                      page_size=page_size,
+                                      download_workers=download_workers,
+                                      incremental=incremental,
+                                      content_store=content_store,
+                                      include_extract=include_extract,
+                                      plan_items=plan_items,
+                                      results=results,
+                                      journal=journal
+                                      )
+            print("Completed the Download....")
+
+        if action.upper() in ["PUBLISH", "DOWNLOAD_AND_PUBLISH"] and targets:
+            print(f"Starting the Publish to {len(targets)} targets....")
+            # Execute Publish function for every target at once
+            with metrics.phase('publish'):
+                tabpymigrate_publish_targets(targets,
+                                             filesystem_path=filesystem_path,
+                                             publish_workers=publish_workers,
+                                             create_projects=create_projects,
+                                             skip_unchanged=skip_unchanged,
+                                             wait_for_refresh=wait_for_refresh,
+                                             connection_rules_file=connection_rules_file,
+                                             verify=verify,
+                                             append_datasources=append_datasources,
+                                             results=results,
+                                             journal=journal)
+            print("Completed the Publish....")
+        elif action.upper() in ["PUBLISH", "DOWNLOAD_AND_PUBLISH"] and not pipelined:
+            print("Starting the Publish....")
+            # Execute Publish function
+            with metrics.phase('publish'):
+                tabpymigrate_publish(server_address=target_server_address,
+                                     site_id=target_site_id,
+                                     username=target_username,
+                                     password=target_password,
+                                     is_personal_access_token=target_is_personal_access_token,
+                                     filesystem_path=filesystem_path,
+                                     publish_workers=publish_workers,
+                                     create_projects=create_projects,
+                                     skip_unchanged=skip_unchanged,
+                                     wait_for_refresh=wait_for_refresh,
+                                     connection_rules_file=connection_rules_file,
+                                     verify=verify,
+                                     append_datasources=append_datasources,
+                                     results=results,
+                                     journal=journal)
+            print("Completed the Download....")
+    finally:
+        # Summary of where the run spent its time, also in filesystem_path/metrics_summary.json
+        metrics.print_summary(metrics.end_run())
+    return results.get_summary()
 
 
 def tabpymigrate():
@@ -65,8 +237,31 @@ def tabpymigrate():
     parser = argparse.ArgumentParser(description="TabPyMigrate helps on Tableau content download and publish")
 
     # Add all the arguments
-    parser.add_argument("-action", help="Action for Tabmigrate", choices=['DOWNLOAD', 'PUBLISH', 'DOWNLOAD_AND_PUBLISH'])
+    parser.add_argument("-action", help="Action for Tabmigrate", choices=['DOWNLOAD', 'PUBLISH', 'DOWNLOAD_AND_PUBLISH', 'PLAN', 'INVENTORY'])
+    parser.add_argument("-from_plan", help="Download the objects of the plan written by the PLAN action? - Default FALSE.", choices=["TRUE", "FALSE"])
     parser.add_argument("-tag_name", help="Tag name for downloading tagged objects.")
+    parser.add_argument("-project_name", help="Only download tagged objects from this project name.")
+    parser.add_argument("-owner_name", help="Only download tagged objects owned by this user.")
+    parser.add_argument("-updated_since", help="Only download tagged objects updated since this UTC timestamp, e.g. 2024-01-31T00:00:00Z.")
+    parser.add_argument("-page_size", help="Number of objects requested per page from the server.", type=int)
+    parser.add_argument("-inventory", help="Select the objects from the inventory snapshot of the site, refreshed incrementally? - Default FALSE.", choices=["TRUE", "FALSE"])
+    parser.add_argument("-inventory_workers", help="Number of pages of an inventory listing fetched concurrently, Default to 8", type=int)
+    parser.add_argument("-download_workers", help="Number of objects downloaded in parallel, Default to 1", type=int)
+    parser.add_argument("-incremental", help="Skip downloading objects not updated since the last download? - Default TRUE.", choices=["TRUE", "FALSE"])
+    parser.add_argument("-publish_workers", help="Number of objects published in parallel, Default to 1", type=int)
+    parser.add_argument("-create_projects", help="Create missing target projects before publishing? - Default FALSE.", choices=["TRUE", "FALSE"])
+    parser.add_argument("-resume", help="Resume the last run, skipping objects it already completed? - Default FALSE.", choices=["TRUE", "FALSE"])
+    parser.add_argument("-pipeline", help="Overlap download, mapping and publish for DOWNLOAD_AND_PUBLISH? - Default FALSE.", choices=["TRUE", "FALSE"])
+    parser.add_argument("-staging_budget", help="Bytes downloaded and not yet published in the pipeline, 0 for no limit.", type=int)
+    parser.add_argument("-metrics", help="Record run metrics in filesystem_path/metrics.jsonl? - Default TRUE.", choices=["TRUE", "FALSE"])
+    parser.add_argument("-metrics_textfile", help="Prometheus textfile the run metrics summary is written to.")
+    parser.add_argument("-content_store", help="Deduplicate identical downloads as hard links in filesystem_path/_store? - Default TRUE.", choices=["TRUE", "FALSE"])
+    parser.add_argument("-skip_unchanged", help="Skip the upload of objects unchanged since their last publish to the target? - Default TRUE.", choices=["TRUE", "FALSE"])
+    parser.add_argument("-include_extract", help="Download datasources and workbooks with their extract data? FALSE refreshes the extracts on the target - Default TRUE.", choices=["TRUE", "FALSE"])
+    parser.add_argument("-wait_for_refresh", help="Wait for the extract refresh jobs started on the target? - Default FALSE.", choices=["TRUE", "FALSE"])
+    parser.add_argument("-connection_rules_file", help="JSON file of rules remapping the source connections to the target on publish.")
+    parser.add_argument("-verify", help="Check every published object on the target from one listing per content type? - Default FALSE.", choices=["TRUE", "FALSE"])
+    parser.add_argument("-append_datasources_file", help="JSON file of the datasources published in append mode, by name with their watermark column.")
     parser.add_argument("-filesystem_path", help="Filesystem path for download and publish")
     parser.add_argument("-source_server_address", help="Source Tableau server address.")
     parser.add_argument("-source_site_id", help="Source Tableau server Site name, Default to None", default=None)
@@ -78,11 +273,51 @@ def tabpymigrate():
     parser.add_argument("-target_username", help="Target Tableau server username for authentication.")
     parser.add_argument("-target_password", help="Target Tableau server password for authentication.")
     parser.add_argument("-target_is_personal_access_token", help="Target Tableau server authentication via personal access token? - Default False.", choices=["TRUE", "FALSE"])
+    parser.add_argument("-targets_file", help="JSON file with a list of targets to publish to at once, replacing the target arguments.")
     args = parser.parse_args()
 
     # Check if username and password are provided as arguments
     action = args.action if args.action is not None else config.ACTION
+    from_plan = True if ((args.from_plan is not None and args.from_plan == "TRUE")
+                         or (args.from_plan is None and config.FROM_PLAN)) else False
     tag_name = args.tag_name if args.tag_name is not None else config.TAG_NAME
+    project_name = args.project_name if args.project_name is not None else config.PROJECT_NAME
+    owner_name = args.owner_name if args.owner_name is not None else config.OWNER_NAME
+    updated_since = args.updated_since if args.updated_since is not None else config.UPDATED_SINCE
+    page_size = args.page_size if args.page_size is not None else config.PAGE_SIZE
+    inventory = True if ((args.inventory is not None and args.inventory == "TRUE")
+                         or (args.inventory is None and config.INVENTORY)) else False
+    inventory_workers = args.inventory_workers if args.inventory_workers is not None else config.INVENTORY_WORKERS
+    download_workers = args.download_workers if args.download_workers is not None else config.DOWNLOAD_WORKERS
+    incremental = True if ((args.incremental is not None and args.incremental == "TRUE")
+                           or (args.incremental is None and config.INCREMENTAL_DOWNLOAD)) else False
+    publish_workers = args.publish_workers if args.publish_workers is not None else config.PUBLISH_WORKERS
+    create_projects = True if ((args.create_projects is not None and args.create_projects == "TRUE")
+                               or (args.create_projects is None and config.CREATE_PROJECTS)) else False
+    resume = True if ((args.resume is not None and args.resume == "TRUE")
+                      or (args.resume is None and config.RESUME)) else False
+    pipeline = True if ((args.pipeline is not None and args.pipeline == "TRUE")
+                        or (args.pipeline is None and config.PIPELINE)) else False
+    staging_budget = args.staging_budget if args.staging_budget is not None else config.STAGING_BUDGET_BYTES
+    collect_metrics = True if ((args.metrics is not None and args.metrics == "TRUE")
+                               or (args.metrics is None and config.METRICS)) else False
+    metrics_textfile = args.metrics_textfile if args.metrics_textfile is not None else config.METRICS_TEXTFILE
+    content_store = True if ((args.content_store is not None and args.content_store == "TRUE")
+                             or (args.content_store is None and config.CONTENT_STORE)) else False
+    skip_unchanged = True if ((args.skip_unchanged is not None and args.skip_unchanged == "TRUE")
+                              or (args.skip_unchanged is None and config.SKIP_UNCHANGED_PUBLISH)) else False
+    include_extract = True if ((args.include_extract is not None and args.include_extract == "TRUE")
+                               or (args.include_extract is None and config.INCLUDE_EXTRACT)) else False
+    wait_for_refresh = True if ((args.wait_for_refresh is not None and args.wait_for_refresh == "TRUE")
+                                or (args.wait_for_refresh is None and config.WAIT_FOR_REFRESH)) else False
+    connection_rules_file = args.connection_rules_file if args.connection_rules_file is not None else config.CONNECTION_RULES_FILE
+    verify = True if ((args.verify is not None and args.verify == "TRUE")
+                      or (args.verify is None and config.VERIFY_PUBLISH)) else False
+    if args.append_datasources_file is not None:
+        with open(args.append_datasources_file, 'r') as append_datasources_file:
+            append_datasources = json.load(append_datasources_file)
+    else:
+        append_datasources = config.APPEND_DATASOURCES
     filesystem_path = args.filesystem_path if args.filesystem_path is not None else config.FILESYSTEM_PATH
     source_server_address = args.source_server_address if args.source_server_address is not None else config.SOURCE_SERVER_ADDRESS
     source_site_id = args.source_site_id if args.source_site_id is not None else config.SOURCE_SITE_ID
@@ -96,10 +331,38 @@ def tabpymigrate():
     target_password = args.target_password if args.target_password is not None else config.TARGET_PASSWORD
     target_is_personal_access_token = True if ((args.target_is_personal_access_token is not None and args.target_is_personal_access_token == "TRUE")
                                                 or (args.target_is_personal_access_token is None and config.TARGET_IS_PERSONAL_ACCESS_TOKEN)) else False
+    if args.targets_file is not None:
+        with open(args.targets_file, 'r') as targets_file:
+            targets = json.load(targets_file)
+    else:
+        targets = config.TARGETS
 
     print(args)
     execute(action=action,
             tag_name=tag_name,
+            project_name=project_name,
+            owner_name=owner_name,
+            updated_since=updated_since,
+            page_size=page_size,
+            inventory=inventory,
+            inventory_workers=inventory_workers,
+            download_workers=download_workers,
+            incremental=incremental,
+            publish_workers=publish_workers,
+            create_projects=create_projects,
+            resume=resume,
+            pipeline=pipeline,
+            staging_budget=staging_budget,
+            collect_metrics=collect_metrics,
+            metrics_textfile=metrics_textfile,
+            content_store=content_store,
+            skip_unchanged=skip_unchanged,
+            include_extract=include_extract,
+            wait_for_refresh=wait_for_refresh,
+            connection_rules_file=connection_rules_file,
+            verify=verify,
+            append_datasources=append_datasources,
+            from_plan=from_plan,
             filesystem_path=filesystem_path,
             source_server_address=source_server_address,
             source_site_id=source_site_id,
@@ -110,7 +373,8 @@ def tabpymigrate():
             target_site_id=target_site_id,
             target_username=target_username,
             target_password=target_password,
-            target_is_personal_access_token=target_is_personal_access_token
+            target_is_personal_access_token=target_is_personal_access_token,
+            targets=targets
             )
 
 
@@ -4,16 +4,43 @@ This will help in downloading Tagged Objects from Tableau server
 
 import csv
 import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict
 import tableauserverclient as TSC
+from . import config
+from . import metrics
+from .query import FieldsRequestOptions, get_items
+from .manifest import get_unchanged_path, load_manifest, save_manifest, update_manifest_entry
+from .projects import get_project_index, get_project_path
+from .journal import get_completed_record, get_journal_key, open_journal, record_state
+from .refresh import get_extract_column
+from .results import Results
+from .store import add_to_store, get_partial_path, get_store_root, move_download, prune_store
+from .throttle import get_byte_budget
+from .transport import call_with_reauth, get_server, sign_in
 # requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
+# Fields requested when listing objects, trimmed to what the download needs
+# Fields of the project are related-resource expressions, projectId and projectName are only filter names
+FLOW_FIELDS = ['id', 'name', 'project.id', 'project.name', 'tags', 'updatedAt']
+DATASOURCE_FIELDS = ['id', 'name', 'project.id', 'project.name', 'tags', 'updatedAt']
+WORKBOOK_FIELDS = ['id', 'name', 'project.id', 'project.name', 'tags', 'updatedAt', 'showTabs', 'size']
+
+# Number of workbook names sent in one view query filter
+VIEW_FILTER_BATCH_SIZE = 50
+
+# Workbook sizes are reported by the server in megabytes
+WORKBOOK_SIZE_UNIT = 1024 * 1024
+
 
 # Function to get Tableau Server and Authentication
 def getTableauAuth(server_url, username=None, password=None, tag_name=None,
-                   site_id=None, is_personal_access_token=False):
+                   site_id=None, is_personal_access_token=False, workers=1):
 
-    server = TSC.Server(server_url, use_server_version=True,
-                        http_options={'verify': False})
+    server = get_server(server_url, workers=workers)
 
     if is_personal_access_token:
         tableau_auth = TSC.PersonalAccessTokenAuth(username, password, site_id)
@@ -23,164 +50,366 @@ def getTableauAuth(server_url, username=None, password=None, tag_name=None,
     return server, tableau_auth
 
 
-# Common Parameters and function for download
+# Build the REST query for tagged objects, optionally narrowed by project, owner and update time
+def get_request_options(tag_name, project_name=None, owner_name=None, updated_since=None,
+                        fields=None, page_size=config.PAGE_SIZE):
+    request_options = FieldsRequestOptions(pagesize=page_size, fields=fields)
+    if tag_name:
+        request_options.filter.add(TSC.Filter(TSC.RequestOptions.Field.Tags,
+                                              TSC.RequestOptions.Operator.Equals,
+                                              tag_name))
+    if project_name:
+        request_options.filter.add(TSC.Filter(TSC.RequestOptions.Field.ProjectName,
+                                              TSC.RequestOptions.Operator.Equals,
+                                              project_name))
+    if owner_name:
+        request_options.filter.add(TSC.Filter(TSC.RequestOptions.Field.OwnerName,
+                                              TSC.RequestOptions.Operator.Equals,
+                                              owner_name))
+    if updated_since:
+        request_options.filter.add(TSC.Filter(TSC.RequestOptions.Field.UpdatedAt,
+                                              TSC.RequestOptions.Operator.GreaterThanOrEqual,
+                                              updated_since))
+    return request_options
+
+
+# Objects tagged tag_name listed with the request options, none without a tag name
+# Listings of the whole site (inventory, plan target) use get_items with get_request_options(None, ...)
+def get_tagged_items(endpoint, request_options, tag_name):
+    if not tag_name:
+        return iter(())
+    return get_items(endpoint, request_options)
+
+
+# Common Parameters and function for download, the CSV file is closed when the download ends or fails
+@contextmanager
 def write_download_csv(csv_filename):
-    fieldnames = ['Sno', 'Type', 'ProjectName', 'Name', 'Path', 'Show_Tabs', 'Views', 'Response', 'Details']
-    csvfile = open(csv_filename, 'w', newline='')
-    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-    writer.writeheader()
-    return writer
+    fieldnames = ['Sno', 'Type', 'Id', 'ProjectName', 'ProjectPath', 'Name', 'UpdatedAt', 'Path', 'Show_Tabs', 'Views', 'Extract', 'Response', 'Details']
+    # Line buffered so every row is on disk as soon as it is written
+    with open(csv_filename, 'w', newline='', buffering=1) as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        yield writer
+
+
+# Semaphore per server address capping concurrent downloads from that server
+_server_semaphores: Dict[str, threading.BoundedSemaphore] = {}
+_server_semaphores_lock = threading.Lock()
 
 
-# Download flows by tagname
-def download_flows(server, filesystem_path, tag_name, response_details=[]):
+def get_server_semaphore(server_address, max_connections=config.MAX_CONNECTIONS_PER_SERVER):
+    with _server_semaphores_lock:
+        if server_address not in _server_semaphores:
+            _server_semaphores[server_address] = threading.BoundedSemaphore(max_connections)
+        return _server_semaphores[server_address]
+
+
+# Download one object into its project folder, returns filepath, response and details
+# With a content store the download is linked into it, identical downloads share one file
+# Without include_extract datasources and workbooks are downloaded without the data of their extracts
+def download_item(server, endpoint, item, download_root, item_type, manifest=None, journal=None, store_root=None,
+                  include_extract=True):
+    journal_key = get_journal_key(item_type, item.id)
+    if item.project_name is None:
+        record_state(journal, journal_key, 'failed', Name=item.name)
+        return '', "Error", f"Could not retrieve project name for {item_type} '{item.name}'. Skipping download."
+
+    # Skip objects already downloaded by the resumed run
+    record = get_completed_record(journal, journal_key, 'downloaded')
+    if record is not None and os.path.isfile(record['Path']):
+        return record['Path'], "Success", f"{item_type} '{item.name}' already downloaded in '{record['Path']}'"
+    record_state(journal, journal_key, 'listed', Name=item.name, ProjectName=item.project_name)
+
+    # Reuse the previous download when the object wasn't updated since
+    if manifest is not None:
+        filepath = get_unchanged_path(manifest, item, include_extract)
+        if filepath is not None:
+            record_state(journal, journal_key, 'downloaded', Path=filepath)
+            return filepath, "Success", f"{item_type} '{item.name}' unchanged since last download, reusing '{filepath}'"
+
+    # Create the download path if it doesn't exist
+    download_path = os.path.join(download_root, item.project_name)
+    os.makedirs(download_path, exist_ok=True)
+
+    partial_path = get_partial_path(store_root) if store_root is not None else None
+    # Flows have no extract option, they are always downloaded whole
+    download_options = {'include_extract': False} if not include_extract and item_type != 'Flow' else {}
+    try:
+        with get_server_semaphore(server.server_address):
+            filepath = call_with_reauth(server, endpoint.download, item.id, filepath=partial_path or download_path,
+                                        **download_options)
+        file_hash = None
+        if partial_path is not None:
+            filepath = move_download(filepath, download_path)
+        if manifest is not None:
+            file_hash = update_manifest_entry(manifest, item, item_type, filepath, include_extract)['Hash']
+        if store_root is not None:
+            add_to_store(store_root, filepath, file_hash)
+        record_state(journal, journal_key, 'downloaded', Path=filepath)
+        return filepath, "Success", f"{item_type} '{item.name}' downloaded successfully in '{filepath}'!"
+    except Exception as e:
+        record_state(journal, journal_key, 'failed', Details=str(e))
+        return '', "Error", "Error in download:" + str(e)
+    finally:
+        if partial_path is not None:
+            shutil.rmtree(partial_path, ignore_errors=True)
+
+
+# Estimated bytes of an object: its previous download, otherwise the size reported by the server, else None
+def get_item_size(item, manifest=None):
+    entry = manifest.get(item.id) if manifest else None
+    if entry is not None:
+        return entry['Size']
+    if getattr(item, 'size', None):
+        return int(float(item.size) * WORKBOOK_SIZE_UNIT)
+    return None
+
+
+# Download the listed objects using a pool of workers, results are yielded in listing order
+# The largest objects start first so a big download doesn't run alone at the end, and the bytes of
+# the downloads in flight are capped by the byte budget of the server
+# A staging budget (pipeline.StagingBudget) holds each download back until there is room for it
+def download_items(server, endpoint, items, download_root, item_type, download_workers=1, manifest=None,
+                   journal=None, staging_budget=None, store_root=None, include_extract=True):
+    byte_budget = get_byte_budget(server.server_address)
+
+    def download(item):
+        if staging_budget is not None:
+            staging_budget.wait_for_room()
+        with byte_budget.reserve(get_item_size(item, manifest) or 0), \
+                metrics.track_object('download', item_type, item.name) as tracked:
+            filepath, response, details = download_item(server, endpoint, item, download_root, item_type,
+                                                        manifest, journal, store_root, include_extract)
+            tracked['Response'] = response
+            tracked['Bytes'] = os.path.getsize(filepath) if response == "Success" else 0
+        if staging_budget is not None:
+            staging_budget.add(tracked['Bytes'])
+        return item, filepath, response, details
+
+    if download_workers <= 1:
+        yield from map(download, items)
+        return
+
+    # Objects are listed up front so every worker shares the one signed-in server
+    items = list(items)
+    with ThreadPoolExecutor(max_workers=download_workers) as executor:
+        futures = {}
+        for index in sorted(range(len(items)), key=lambda index: get_item_size(items[index], manifest) or 0,
+                            reverse=True):
+            futures[index] = executor.submit(download, items[index])
+        for index in range(len(items)):
+            result = futures.pop(index).result()
+            metrics.record_queue_depth('download', len(futures))
+            yield result
+
+
+# View names of the given workbooks grouped by workbook id, using paged view queries filtered by workbook name
+def get_workbook_views(server, workbooks, page_size=config.PAGE_SIZE, batch_size=VIEW_FILTER_BATCH_SIZE):
+    workbook_views = {workbook.id: [] for workbook in workbooks}
+
+    # Names with list delimiters can't be sent in an 'in' filter, their views are populated one by one
+    filter_names = sorted({workbook.name for workbook in workbooks if not set(workbook.name) & set(',[]')})
+    for workbook in workbooks:
+        if workbook.name not in filter_names:
+            call_with_reauth(server, server.workbooks.populate_views, workbook)
+            workbook_views[workbook.id] = [view.name for view in workbook.views]
+
+    for start in range(0, len(filter_names), batch_size):
+        request_options = FieldsRequestOptions(pagesize=page_size)
+        request_options.filter.add(TSC.Filter('workbookName', TSC.RequestOptions.Operator.In,
+                                              '[' + ','.join(filter_names[start:start + batch_size]) + ']'))
+        for view in get_items(server.views, request_options):
+            # Views of other workbooks sharing a name are not part of the selection
+            if view.workbook_id in workbook_views:
+                workbook_views[view.workbook_id].append(view.name)
+    return workbook_views
+
+
+# Download flows by tagname, every result is reported to the results sink (results.Results) which is returned
+def download_flows(server, filesystem_path, tag_name, results=None, request_options=None, download_workers=1,
+                   manifest=None, project_index=None, journal=None, staging_budget=None, row_callback=None,
+                   store_root=None, items=None):
     # Setup download path and CSV output
+    results = results if results is not None else Results()
     flows_path = os.path.join(filesystem_path, 'flow')
-    csvwriter = write_download_csv(os.path.join(filesystem_path, 'flows.csv'))
-
-    count = 0
-    for flow in TSC.Pager(server.flows):
-        if tag_name in flow.tags:
-            if flow.project_name is None:
-                response = "Error"
-                details = f"Could not retrieve project name for Flow '{flow.name}'. Skipping download."
-                filepath = ''
-            else:
-                # Create the download path if it doesn't exist
-                download_path = os.path.join(flows_path, flow.project_name)
-                os.makedirs(download_path, exist_ok=True)
-
-                # Download the flow
-                try:
-                    filepath = server.flows.download(flow.id, filepath=download_path)
-                    response = "Success"
-                    details = f"Flow '{flow.name}' downloaded successfully in '{filepath}'!"
-                except Exception as e:
-                    response = "Error"
-                    details = "Error in download:" + str(e)
+    with write_download_csv(os.path.join(filesystem_path, 'flows.csv')) as csvwriter:
+        if request_options is None:
+            request_options = get_request_options(tag_name, fields=FLOW_FIELDS)
 
+        count = 0
+        # Objects of a plan are downloaded without listing them again
+        flows = items if items is not None else get_tagged_items(server.flows, request_options, tag_name)
+        for flow, filepath, response, details in download_items(server, server.flows, flows, flows_path,
+                                                                 'Flow', download_workers, manifest, journal,
+                                                                 staging_budget, store_root):
             count += 1
             flow_details = {'Sno': count,
                             'Type': 'Flow',
+                            'Id': flow.id,
                             'Name': flow.name,
                             'ProjectName': flow.project_name,
+                            'ProjectPath': get_project_path(project_index, flow.project_id) if project_index else '',
+                            'UpdatedAt': flow.updated_at.isoformat() if flow.updated_at is not None else '',
                             'Path': filepath,
                             'Response': response,
                             'Details': details}
             csvwriter.writerow(flow_details)
             print("flow", flow_details, response)
-            response_details.append(flow_details)
-    return response_details
+            results.add('download', flow_details)
+            if row_callback is not None:
+                row_callback(flow_details)
+    return results
 
 
-# Download datasource by tagname
-def download_datasources(server, filesystem_path, tag_name, response_details=[]):
+# Download datasource by tagname, every result is reported to the results sink which is returned
+def download_datasources(server, filesystem_path, tag_name, results=None, request_options=None,
+                         download_workers=1, manifest=None, project_index=None, journal=None, staging_budget=None,
+                         row_callback=None, store_root=None, items=None, include_extract=True):
     # Setup download path and CSV output
+    results = results if results is not None else Results()
     datasources_path = os.path.join(filesystem_path, 'datasource')
-    csvwriter = write_download_csv(os.path.join(filesystem_path, 'datasources.csv'))
-
-    count = 0
-    for datasource in TSC.Pager(server.datasources):
-        if tag_name in datasource.tags:
-            if datasource.project_name is None:
-                response = "Error"
-                details = f"Could not retrieve project name for Datasource '{datasource.name}'. Skipping download."
-                filepath = ''
-            else:
-                # Create the download path if it doesn't exist
-                download_path = os.path.join(datasources_path, datasource.project_name)
-                os.makedirs(download_path, exist_ok=True)
-
-                # Download the Datasource
-                try:
-                    filepath = server.datasources.download(datasource.id, filepath=download_path)
-                    response = "Success"
-                    details = f"Datasource '{datasource.name}' downloaded successfully in '{filepath}'!"
-                except Exception as e:
-                    print(datasource)
-                    print(str(e))
-                    response = "Error"
-                    details = "Error in download:" + str(e)
+    with write_download_csv(os.path.join(filesystem_path, 'datasources.csv')) as csvwriter:
+        if request_options is None:
+            request_options = get_request_options(tag_name, fields=DATASOURCE_FIELDS)
+
+        count = 0
+        datasources = items if items is not None else get_tagged_items(server.datasources, request_options, tag_name)
+        for datasource, filepath, response, details in download_items(server, server.datasources, datasources,
+                                                                       datasources_path, 'Datasource',
+                                                                       download_workers, manifest, journal,
+                                                                       staging_budget, store_root, include_extract):
+            if response == "Error":
+                print(datasource)
+                print(details)
 
             count += 1
             datasource_details = {'Sno': count,
                                   'Type': 'Datasource',
+                                  'Id': datasource.id,
                                   'Name': datasource.name,
                                   'ProjectName': datasource.project_name,
+                                  'ProjectPath': get_project_path(project_index, datasource.project_id) if project_index else '',
+                                  'UpdatedAt': datasource.updated_at.isoformat() if datasource.updated_at is not None else '',
                                   'Path': filepath,
+                                  'Extract': get_extract_column(filepath, include_extract),
                                   'Response': response,
                                   'Details': details}
             csvwriter.writerow(datasource_details)
-            response_details.append(datasource_details)
-    return response_details
+            results.add('download', datasource_details)
+            if row_callback is not None:
+                row_callback(datasource_details)
+    return results
 
 
-# Download workbook by tagname
-def download_workbooks(server, filesystem_path, tag_name, response_details=[]):
+# Download workbook by tagname, every result is reported to the results sink which is returned
+def download_workbooks(server, filesystem_path, tag_name, results=None, request_options=None,
+                       download_workers=1, manifest=None, project_index=None, journal=None, staging_budget=None,
+                       row_callback=None, store_root=None, items=None, include_extract=True):
     # Setup download path and CSV output
+    results = results if results is not None else Results()
     workbooks_path = os.path.join(filesystem_path, 'workbook')
-    csvwriter = write_download_csv(os.path.join(filesystem_path, 'workbooks.csv'))
-
-    count = 0
-    for workbook in TSC.Pager(server.workbooks):
-        if tag_name in workbook.tags:
-            if workbook.project_name is None:
-                response = "Error"
-                details = f"Could not retrieve project name for Workbook '{workbook.name}'. Skipping download."
-                filepath = ''
-            else:
-                # Create the download path if it doesn't exist
-                download_path = os.path.join(workbooks_path, workbook.project_name)
-                os.makedirs(download_path, exist_ok=True)
-
-                # Download the workbook
-                try:
-                    filepath = server.workbooks.download(workbook.id, filepath=download_path)
-                    response = "Success"
-                    details = f"Workbook '{workbook.name}' downloaded successfully in '{filepath}'!"
-                except Exception as e:
-                    response = "Error"
-                    details = "Error in download:" + str(e)
-            server.workbooks.populate_views(workbook)
-            print(workbook.views)
-            print(workbook.hidden_views)
-            view_list = [view.name for view in workbook.views]
-            for view in workbook.views:
-                print(view.content_url)
-                print(view.name)
-                print(dir(view))
+    with write_download_csv(os.path.join(filesystem_path, 'workbooks.csv')) as csvwriter:
+        if request_options is None:
+            request_options = get_request_options(tag_name, fields=WORKBOOK_FIELDS)
+
+        # Views of all selected workbooks are fetched in bulk before downloading, a plan has them already
+        if items is not None:
+            workbooks = items
+            workbook_views = {workbook.id: workbook.views for workbook in workbooks}
+        else:
+            with metrics.phase('list_workbooks'):
+                workbooks = list(get_tagged_items(server.workbooks, request_options, tag_name))
+                workbook_views = get_workbook_views(server, workbooks, page_size=request_options.pagesize)
+
+        count = 0
+        for workbook, filepath, response, details in download_items(server, server.workbooks, workbooks,
+                                                                     workbooks_path, 'Workbook', download_workers,
+                                                                     manifest, journal, staging_budget, store_root,
+                                                                     include_extract):
+            view_list = workbook_views.get(workbook.id, [])
             count += 1
             workbook_details = {'Sno': count,
                                 'Type': 'Workbook',
+                                'Id': workbook.id,
                                 'Name': workbook.name,
                                 'ProjectName': workbook.project_name,
+                                'ProjectPath': get_project_path(project_index, workbook.project_id) if project_index else '',
+                                'UpdatedAt': workbook.updated_at.isoformat() if workbook.updated_at is not None else '',
                                 'Show_Tabs': workbook.show_tabs,
                                 'Views': view_list,
                                 'Path': filepath,
+                                'Extract': get_extract_column(filepath, include_extract),
                                 'Response': response,
                                 'Details': details}
             csvwriter.writerow(workbook_details)
-            response_details.append(workbook_details)
-    return response_details
+            results.add('download', workbook_details)
+            if row_callback is not None:
+                row_callback(workbook_details)
+    return results
 
 
-def tabpymigrate_download(server_address='', username=None, password=None, filesystem_path=None, tag_name=None, site_id=None, is_personal_access_token=False):
-    response_details = []
+def tabpymigrate_download(server_address='', username=None, password=None, filesystem_path=None, tag_name=None, site_id=None, is_personal_access_token=False,
+                          project_name=None, owner_name=None, updated_since=None, page_size=config.PAGE_SIZE,
+                          download_workers=config.DOWNLOAD_WORKERS, incremental=config.INCREMENTAL_DOWNLOAD,
+                          content_store=config.CONTENT_STORE, include_extract=config.INCLUDE_EXTRACT, plan_items=None,
+                          results=None, journal=None, resume=False):
+    # Sink of the download results, shared with the publish when started from execute
+    results = results if results is not None else Results()
     try:
         # Create server and tableau_auth object
-        server, tableau_auth = getTableauAuth(server_address, username=username, password=password, tag_name=None, site_id=site_id, is_personal_access_token=is_personal_access_token)
+        server, tableau_auth = getTableauAuth(server_address, username=username, password=password, tag_name=None, site_id=site_id, is_personal_access_token=is_personal_access_token,
+                                              workers=download_workers)
+
+        # Run journal of object states, shared with the publish when started from execute
+        if journal is None:
+            journal = open_journal(filesystem_path, resume)
 
         # Authenticate to Tableau Server
-        tableau_auth = TSC.TableauAuth(username, password, site_id=site_id)
-        with server.auth.sign_in(tableau_auth):
+        with sign_in(server, tableau_auth):
             print("starting")
             # download objects from server to the filesystem for given tag_name
-            response_details = download_flows(server, filesystem_path, tag_name, response_details)
-            response_details = download_datasources(server, filesystem_path, tag_name, response_details)
-            response_details = download_workbooks(server, filesystem_path, tag_name, response_details)
+            filters = {'project_name': project_name, 'owner_name': owner_name,
+                       'updated_since': updated_since, 'page_size': page_size}
+            # Manifest of previous downloads, saved after each object type
+            manifest = load_manifest(filesystem_path) if incremental else None
+            # Source project paths recorded for resolving nested projects on publish
+            with metrics.phase('list_projects'):
+                project_index = get_project_index(server, filesystem_path, page_size=page_size)
+            # Content store the downloads are deduplicated in
+            store_root = get_store_root(filesystem_path) if content_store else None
+            # Objects to transfer by type from the PLAN action (plan.load_plan_items), listed from the source otherwise
+            plan_items = plan_items or {}
+            with metrics.phase('download_flows'):
+                download_flows(server, filesystem_path, tag_name, results,
+                               get_request_options(tag_name, fields=FLOW_FIELDS, **filters),
+                               download_workers=download_workers, manifest=manifest, journal=journal,
+                               project_index=project_index, store_root=store_root,
+                               items=plan_items.get('Flow'))
+            if manifest is not None:
+                save_manifest(filesystem_path, manifest)
+            with metrics.phase('download_datasources'):
+                download_datasources(server, filesystem_path, tag_name, results,
+                                     get_request_options(tag_name, fields=DATASOURCE_FIELDS, **filters),
+                                     download_workers=download_workers, manifest=manifest, journal=journal,
+                                     project_index=project_index, store_root=store_root,
+                                     items=plan_items.get('Datasource'),
+                                     include_extract=include_extract)
+            if manifest is not None:
+                save_manifest(filesystem_path, manifest)
+            with metrics.phase('download_workbooks'):
+                download_workbooks(server, filesystem_path, tag_name, results,
+                                   get_request_options(tag_name, fields=WORKBOOK_FIELDS, **filters),
+                                   download_workers=download_workers, manifest=manifest, journal=journal,
+                                   project_index=project_index, store_root=store_root,
+                                   items=plan_items.get('Workbook'),
+                                   include_extract=include_extract)
+            if manifest is not None:
+                save_manifest(filesystem_path, manifest)
+            if store_root is not None:
+                print("Content store entries no longer downloaded freed", prune_store(store_root), "bytes")
 
-        print(response_details)
-        return 0, response_details
+        results.print_summary('download')
+        return 0, results
     except Exception as e:
         response_details = "Error in TabPyMigrate Export Execution:" + str(e)
         print(response_details)
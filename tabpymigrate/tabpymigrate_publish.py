@@ -15,15 +15,33 @@ Usage:
    variables in the 'tabpymigrate_publish' function to suit your Tableau Server environment and requirements.
 2. Run the script to initiate the publishing process.
 """
+import ast
 import csv
 import os
+from contextlib import contextmanager
 import tableauserverclient as TSC
-from mapping import update_flow_mapping, update_workbook_mapping
+from . import config
+from . import metrics
+from .append import get_append_column, publish_datasource_appending
+from .journal import get_completed_record, get_publish_journal_key, open_journal, record_state
+from .mapping import (get_connection_count, get_hidden_views, update_datasource_mapping, update_flow_mapping,
+                      update_workbook_mapping)
+from .projects import (create_project_paths, escape_project_name, get_project_index, get_unresolved_project_details,
+                       resolve_project_id)
+from .refresh import refresh_published, wait_for_refresh_jobs
+from .results import Results
+from .rules import load_connection_rules
+from .scheduler import build_publish_graph, get_publish_levels, get_task_size, run_levels
+from .store import get_publish_hash, get_published_key, get_published_state_path, get_unchanged_publish, save_published
+from .throttle import get_byte_budget
+from .transport import call_with_reauth, get_server, sign_in
+from .upload import get_upload_state_path, publish_datasource_in_chunks, publish_workbook_in_chunks
+from .verify import verify_publish
 
 
 # Function to get Tableau Server and Authentication
 def gettableauauth(server_address, username=None, password=None,
-                   site_id=None, is_personal_access_token=False):
+                   site_id=None, is_personal_access_token=False, workers=1):
     """
     Create Tableau Server and authentication objects.
 
@@ -34,11 +52,12 @@ def gettableauauth(server_address, username=None, password=None,
         tag_name (str): The tag name to filter objects during download.
         site_id (str): ID of the Tableau site. Not required if using Personal Access Token.
         is_personal_access_token (bool): Flag indicating whether Personal Access Token is being used.
+        workers (int): Number of workers sharing the server, used to size the connection pool.
 
     Returns:
         Tuple[TSC.Server, TSC.Auth]: The Tableau Server and authentication objects.
     """
-    server = TSC.Server(server_address, use_server_version=True, http_options={'verify': False})
+    server = get_server(server_address, workers=workers)
 
     if is_personal_access_token:
         tableau_auth = TSC.PersonalAccessTokenAuth(username, password, site_id)
@@ -49,39 +68,58 @@ def gettableauauth(server_address, username=None, password=None,
 
 
 # Common Parameters and function for download
+@contextmanager
 def read_download_csv(csv_filename):
     """
     Read the CSV file containing object metadata for download (flows.csv, datasources.csv, workbooks.csv).
+    The file is closed when the with block ends.
 
     Args:
         csv_filename (str): The filename of the CSV to be read.
 
-    Returns:
+    Yields:
         csv.DictReader: A CSV reader object containing object metadata.
-    """    
+    """
     if os.path.isfile(csv_filename) is True:
-        csvfile = open(csv_filename, 'r', newline='')
-        return csv.DictReader(csvfile)
+        with open(csv_filename, 'r', newline='') as csvfile:
+            yield csv.DictReader(csvfile)
     else:
         print("CSV File not found:" + str(csv_filename))
-        return []
+        yield []
+
+
+def read_download_rows(csv_filename):
+    """
+    Read all rows of a download CSV, see read_download_csv.
+
+    Args:
+        csv_filename (str): The filename of the CSV to be read.
+
+    Returns:
+        list: The rows of the CSV as dicts.
+    """
+    with read_download_csv(csv_filename) as csvreader:
+        return list(csvreader)
 
 
+@contextmanager
 def write_publish_csv(csv_filename):
     """
     Create a CSV writer for storing details of the publishing process.
+    The file is closed when the with block ends.
 
     Args:
         csv_filename (str): The filename of the CSV to be created.
 
-    Returns:
+    Yields:
         csv.DictWriter: A CSV writer object.
     """
-    fieldnames = ['Sno', 'Type', 'ProjectName', 'Name', 'Show_Tabs', 'Hidden_Views', 'Path', 'Response', 'Details']
-    csvfile = open(csv_filename, 'w', newline='')
-    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-    writer.writeheader()
-    return writer
+    fieldnames = ['Sno', 'Type', 'ProjectName', 'Name', 'Show_Tabs', 'Hidden_Views', 'Path', 'Response', 'Details', 'RefreshJobId']
+    # Line buffered so every row is on disk as soon as it is written
+    with open(csv_filename, 'w', newline='', buffering=1) as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        yield writer
 
 
 def publish_flow(server, flow, project_id, filepath):
@@ -102,232 +140,567 @@ def publish_flow(server, flow, project_id, filepath):
     return flow
 
 
-def publish_datasource(server, datasource, project_id, filepath):
+def publish_datasource(server, datasource, project_id, filepath, upload_state_path=None):
     """
     Publish a Datasource to Tableau Server.
 
+    Files of at least config.UPLOAD_CHUNK_THRESHOLD bytes are sent in resumable chunks
+    when an upload_state_path is given.
+
     Args:
         server (TSC.Server): The Tableau Server object.
         project_id (str): The ID of the project to which the flow will be published.
         filepath (str): The local file path of the flow to be published.
+        upload_state_path (str, optional): The file persisting upload sessions for resuming chunked uploads.
 
     Returns:
         TSC.DatasourceItem: The published flow object.
     """
     new_ds = TSC.DatasourceItem(project_id=project_id, name=datasource['Name'])
     overwrite_true = TSC.Server.PublishMode.Overwrite
+    if upload_state_path is not None and os.path.getsize(filepath) >= config.UPLOAD_CHUNK_THRESHOLD:
+        return publish_datasource_in_chunks(server, new_ds, filepath, upload_state_path, overwrite_true)
     datasource = server.datasources.publish(new_ds, filepath, overwrite_true)
     return datasource
 
 
-def publish_workbook(server, project_id, filepath, show_tabs=True, hidden_views=[]):
+def publish_workbook(server, project_id, filepath, show_tabs=True, hidden_views=[], upload_state_path=None):
     """
     Publish a Workbook to Tableau Server.
 
+    Files of at least config.UPLOAD_CHUNK_THRESHOLD bytes are sent in resumable chunks
+    when an upload_state_path is given.
+
     Args:
         server (TSC.Server): The Tableau Server object.
         project_id (str): The ID of the project to which the flow will be published.
         filepath (str): The local file path of the flow to be published.
+        upload_state_path (str, optional): The file persisting upload sessions for resuming chunked uploads.
 
     Returns:
         TSC.WorkookItem: The published flow object.
     """
     new_wb = TSC.WorkbookItem(project_id=project_id, show_tabs=show_tabs)
+    # Hidden views are set on the workbook, TSC deprecates the publish parameter
+    new_wb.hidden_views = hidden_views
     overwrite_true = TSC.Server.PublishMode.Overwrite
+    if upload_state_path is not None and os.path.getsize(filepath) >= config.UPLOAD_CHUNK_THRESHOLD:
+        return publish_workbook_in_chunks(server, new_wb, filepath, upload_state_path)
     workbook = server.workbooks.publish(new_wb, filepath, overwrite_true,
-                                        skip_connection_check=True,
-                                        hidden_views=hidden_views)
+                                        skip_connection_check=True)
     return workbook
 
 
-def publish_flows(server, filesystem_path, project_list, response_details=[]):
+def record_publish_result(journal, journal_key, object_details):
     """
-    Publish flows to Tableau Server based on metadata from flows.csv.
+    Record the publish result of an object in the run journal.
+
+    Args:
+        journal (dict): The run journal, nothing is recorded when None.
+        journal_key (str): The journal key of the object.
+        object_details (dict): Details of the publishing response written to the publish CSV.
+    """
+    state = 'published' if object_details['Response'] == "Success" else 'failed'
+    record_state(journal, journal_key, state, Row=object_details)
+
+
+def publish_unless_unchanged(server, endpoint, filesystem_path, object_type, project_id, row, filepath,
+                             publish_function, skip_unchanged=True, **options):
+    """
+    Publish an object unless the target object was last published from identical content with the same options
+    and wasn't changed on the target since. Every publish is recorded in the published state of the target,
+    with the connection count of the file, which verification compares the target with.
 
     Args:
         server (TSC.Server): The Tableau Server object.
+        endpoint: The server endpoint of the object type, used to check the target object.
+        filesystem_path (str): The path holding the published state of the target in its _cache folder.
+        object_type (str): Flow, Datasource or Workbook.
+        project_id (str): The target project ID.
+        row (dict): The download CSV row of the object, published under its name.
+        filepath (str): The file to publish.
+        publish_function (callable): Publishes the file and returns the published item.
+        skip_unchanged (bool): Compare with the last publish, otherwise always publish.
+        **options: Publish options that change the target object, part of the compared hash.
+
+    Returns:
+        tuple: The webpage URL and ID of the target object and True when the upload was skipped.
+    """
+    state_path = get_published_state_path(filesystem_path, server)
+    key = get_published_key(object_type, project_id, row['Name'])
+    publish_hash = get_publish_hash(filepath, **options)
+    if skip_unchanged:
+        record = get_unchanged_publish(server, endpoint, state_path, key, publish_hash)
+        if record is not None:
+            return record['Url'], record['Id'], True
+    published_item = publish_function()
+    save_published(state_path, key, publish_hash, published_item, row,
+                   connection_count=get_connection_count(object_type, filepath))
+    return published_item.webpage_url, published_item.id, False
+
+
+@metrics.timed_object('publish', 'Flow')
+def publish_flow_row(server, flow, filesystem_path, project_index, journal=None, mapped_path=None,
+                     skip_unchanged=config.SKIP_UNCHANGED_PUBLISH, connection_rules=None):
+    """
+    Map and publish a single flow row from flows.csv.
+
+    Args:
+        server (TSC.Server): The Tableau Server object.
+        flow (dict): The flows.csv row of the flow to publish.
         filesystem_path (str): The path to the file system containing object metadata CSVs and objects to publish.
-        project_list (dict): A dictionary containing project names as keys and project IDs as values.
-        response_details (list, optional): A list to store details of the publishing response. Default is an empty list.
+        project_index (dict): The target project index built by projects.get_project_index.
+        journal (dict, optional): The run journal, flows already published in a resumed run are skipped.
+        mapped_path (str, optional): The flow already mapped to the target, mapped here when None.
+        skip_unchanged (bool, optional): Skip the upload when the target has the identical flow.
+        connection_rules (rules.ConnectionRules, optional): Rules mapping the database connections to the target.
 
     Returns:
-        list: A list containing dictionaries with details of the publishing response for each flow.
+        dict: Details of the publishing response for the flow.
     """
-    # Setup download path and CSV output
-    csvreader = read_download_csv(os.path.join(filesystem_path, 'flows.csv'))
-    csvwriter = write_publish_csv(os.path.join(filesystem_path, 'flows_publish.csv'))
-
-    for flow in csvreader:
-        print(flow)
-        project_name = flow['ProjectName']
-        project_id = project_list.get(project_name)
-        if project_id is not None:
-            try:
-                flowFile = flow['Path']
+    journal_key = get_publish_journal_key(server, flow)
+    record = get_completed_record(journal, journal_key, 'published')
+    if record is not None:
+        return record['Row']
+
+    print(flow)
+    project_name = flow['ProjectName']
+    project_id = resolve_project_id(project_index, flow.get('ProjectPath'), project_name)
+    if project_id is not None:
+        try:
+            if mapped_path is None:
                 updated_flowFile, details = update_flow_mapping(flow, server.server_address,
-                                                                project_list, filesystem_path)
-                published_flow = publish_flow(server, flow, project_id, updated_flowFile)
-                response = "Success"
-                details = "Flow has been successfully published:"
-                details += str(published_flow.webpage_url)
-            except Exception as e:
-                response = "Error"
-                details = str(e)
-
-        else:
+                                                                project_index, filesystem_path,
+                                                                connection_rules=connection_rules)
+                record_state(journal, journal_key, 'mapped', Path=updated_flowFile)
+            else:
+                updated_flowFile = mapped_path
+            webpage_url, _, skipped = publish_unless_unchanged(
+                server, server.flows, filesystem_path, 'Flow', project_id, flow, updated_flowFile,
+                lambda: call_with_reauth(server, publish_flow, server, flow, project_id, updated_flowFile),
+                skip_unchanged)
+            response = "Success"
+            details = "Flow unchanged since last publish, upload skipped:" if skipped else "Flow has been successfully published:"
+            details += str(webpage_url)
+        except Exception as e:
             response = "Error"
-            details = "Project not found in server:" + str(project_name)
+            details = str(e)
 
-        flow_details = {'Sno': flow['Sno'],
-                        'Type': 'Flow',
-                        'Name': flow['Name'],
-                        'ProjectName': project_name,
-                        'Path': flow['Path'],
-                        'Response': response,
-                        'Details': details}
-        csvwriter.writerow(flow_details)
-        response_details.append(flow_details)
-    return response_details
+    else:
+        response = "Error"
+        details = get_unresolved_project_details(project_index, flow.get('ProjectPath'), project_name)
+
+    flow_details = {'Sno': flow['Sno'],
+                    'Type': 'Flow',
+                    'Name': flow['Name'],
+                    'ProjectName': project_name,
+                    'Path': flow['Path'],
+                    'Response': response,
+                    'Details': details}
+    record_publish_result(journal, journal_key, flow_details)
+    return flow_details
+
+
+def publish_flows(server, filesystem_path, project_index, results=None, journal=None,
+                  skip_unchanged=config.SKIP_UNCHANGED_PUBLISH, connection_rules=None):
+    """
+    Publish flows to Tableau Server based on metadata from flows.csv.
 
+    Args:
+        server (TSC.Server): The Tableau Server object.
+        filesystem_path (str): The path to the file system containing object metadata CSVs and objects to publish.
+        project_index (dict): The target project index built by projects.get_project_index.
+        results (results.Results, optional): The sink every publish result is reported to, a new one when None.
+        journal (dict, optional): The run journal recording the state of every object.
+        skip_unchanged (bool, optional): Skip the upload of objects the target already has identical.
+        connection_rules (rules.ConnectionRules, optional): Rules mapping the connections to the target.
 
+    Returns:
+        results.Results: The sink with the counts of the published flows.
+    """
+    # Setup download path and CSV output
+    results = results if results is not None else Results()
+    with read_download_csv(os.path.join(filesystem_path, 'flows.csv')) as csvreader, \
+            write_publish_csv(os.path.join(filesystem_path, 'flows_publish.csv')) as csvwriter:
+        for flow in csvreader:
+            flow_details = publish_flow_row(server, flow, filesystem_path, project_index, journal,
+                                            skip_unchanged=skip_unchanged, connection_rules=connection_rules)
+            csvwriter.writerow(flow_details)
+            results.add('publish', flow_details)
+    return results
+
+
+@metrics.timed_object('publish', 'Datasource')
+def publish_datasource_row(server, datasource, filesystem_path, project_index, journal=None, mapped_path=None,
+                           skip_unchanged=config.SKIP_UNCHANGED_PUBLISH, connection_rules=None,
+                           append_datasources=None):
+    """
+    Publish a single datasource row from datasources.csv.
 
-def publish_datasources(server, filesystem_path, project_list, response_details=[]):
+    Args:
+        server (TSC.Server): The Tableau Server object.
+        datasource (dict): The datasources.csv row of the datasource to publish.
+        filesystem_path (str): The path to the file system containing object metadata CSVs and objects to publish.
+        project_index (dict): The target project index built by projects.get_project_index.
+        journal (dict, optional): The run journal, datasources already published in a resumed run are skipped.
+        mapped_path (str, optional): The datasource already mapped to the target, mapped here when None
+            and there are connection rules.
+        skip_unchanged (bool, optional): Skip the upload when the target has the identical datasource.
+        connection_rules (rules.ConnectionRules, optional): Rules mapping the connections to the target.
+        append_datasources (dict, optional): Watermark columns of the datasources published in append mode by name.
+
+    Returns:
+        dict: Details of the publishing response for the datasource.
+    """
+    journal_key = get_publish_journal_key(server, datasource)
+    record = get_completed_record(journal, journal_key, 'published')
+    if record is not None:
+        return record['Row']
+
+    print(datasource)
+    project_name = datasource['ProjectName']
+    project_id = resolve_project_id(project_index, datasource.get('ProjectPath'), project_name)
+    filePath = datasource['Path']
+    refresh_job_id = None
+    if project_id is not None:
+        try:
+            # Datasources are published as downloaded unless connection rules map them
+            if mapped_path is None and connection_rules:
+                filePathUpd = update_datasource_mapping(filePath, server.server_address, project_name,
+                                                        filesystem_path, connection_rules=connection_rules,
+                                                        object_id=datasource.get('Id'))
+                record_state(journal, journal_key, 'mapped', Path=filePathUpd)
+            else:
+                filePathUpd = mapped_path or filePath
+            def publish_function():
+                return call_with_reauth(server, publish_datasource, server, datasource, project_id, filePathUpd,
+                                        upload_state_path=get_upload_state_path(filesystem_path))
+
+            # Datasources whose rows only grow get the new rows appended to the target
+            append_column = get_append_column(datasource['Name'], append_datasources)
+            append_details = ''
+            if append_column:
+                webpage_url, datasource_id, skipped, append_details = publish_datasource_appending(
+                    server, filesystem_path, project_id, datasource, filePathUpd, append_column, publish_function,
+                    skip_unchanged, upload_state_path=get_upload_state_path(filesystem_path))
+            else:
+                webpage_url, datasource_id, skipped = publish_unless_unchanged(
+                    server, server.datasources, filesystem_path, 'Datasource', project_id, datasource, filePathUpd,
+                    publish_function, skip_unchanged)
+            response = "Success"
+            details = "Datasource unchanged since last publish, upload skipped:" if skipped else "Datasource has been successfully published:"
+            details += str(webpage_url) + append_details
+            # Published without its extract data, the target builds the extract
+            if not skipped:
+                refresh_job_id, refresh_details = refresh_published(server, datasource, 'Datasource', datasource_id)
+                details += refresh_details
+        except Exception as e:
+            response = "Error"
+            details = str(e)
+
+    else:
+        response = "Error"
+        details = get_unresolved_project_details(project_index, datasource.get('ProjectPath'), project_name)
+
+    datasource_details = {'Sno': datasource['Sno'],
+                          'Type': 'Datasource',
+                          'Name': datasource['Name'],
+                          'ProjectName': project_name,
+                          'Path': filePath,
+                          'Response': response,
+                          'Details': details,
+                          'RefreshJobId': refresh_job_id}
+    record_publish_result(journal, journal_key, datasource_details)
+    return datasource_details
+
+
+def publish_datasources(server, filesystem_path, project_index, results=None, journal=None,
+                        skip_unchanged=config.SKIP_UNCHANGED_PUBLISH, connection_rules=None, append_datasources=None):
     """
     Publish Datasources to Tableau Server based on metadata from flows.csv.
 
     Args:
         server (TSC.Server): The Tableau Server object.
         filesystem_path (str): The path to the file system containing object metadata CSVs and objects to publish.
-        project_list (dict): A dictionary containing project names as keys and project IDs as values.
-        response_details (list, optional): A list to store details of the publishing response. Default is an empty list.
+        project_index (dict): The target project index built by projects.get_project_index.
+        results (results.Results, optional): The sink every publish result is reported to, a new one when None.
+        journal (dict, optional): The run journal recording the state of every object.
+        skip_unchanged (bool, optional): Skip the upload of objects the target already has identical.
+        connection_rules (rules.ConnectionRules, optional): Rules mapping the connections to the target.
+        append_datasources (dict, optional): Watermark columns of the datasources published in append mode by name.
 
     Returns:
-        list: A list containing dictionaries with details of the publishing response for each flow.
+        results.Results: The sink with the counts of the published datasources.
     """    
     # Setup download path and CSV output
-    csvreader = read_download_csv(os.path.join(filesystem_path, 'datasources.csv'))
-    csvwriter = write_publish_csv(os.path.join(filesystem_path, 'datasources_publish.csv'))
-
-    for datasource in csvreader:
-        print(datasource)
-        project_name = datasource['ProjectName']
-        project_id = project_list.get(project_name)
-        filePath = datasource['Path']
-        if project_id is not None:
-            try:
-                published_datasource = publish_datasource(server, datasource, project_id, filePath)
-                response = "Success"
-                details = "Datasource has been successfully published:"
-                details += str(published_datasource.webpage_url)
-            except Exception as e:
-                response = "Error"
-                details = str(e)
-
-        else:
+    results = results if results is not None else Results()
+    with read_download_csv(os.path.join(filesystem_path, 'datasources.csv')) as csvreader, \
+            write_publish_csv(os.path.join(filesystem_path, 'datasources_publish.csv')) as csvwriter:
+        for datasource in csvreader:
+            datasource_details = publish_datasource_row(server, datasource, filesystem_path, project_index, journal,
+                                                        skip_unchanged=skip_unchanged,
+                                                        connection_rules=connection_rules,
+                                                        append_datasources=append_datasources)
+            csvwriter.writerow(datasource_details)
+            results.add('publish', datasource_details)
+    return results
+
+
+def get_display_views(workbook):
+    """
+    Read the view names recorded in the Views column of workbooks.csv.
+
+    Args:
+        workbook (dict): The workbooks.csv row of the workbook.
+
+    Returns:
+        list: The view names, or None when no views were recorded.
+    """
+    try:
+        display_views = ast.literal_eval(workbook.get('Views') or '[]')
+    except (ValueError, SyntaxError):
+        return None
+    return list(display_views) if display_views else None
+
+
+@metrics.timed_object('publish', 'Workbook')
+def publish_workbook_row(server, workbook, filesystem_path, project_index, journal=None, mapped_path=None,
+                         skip_unchanged=config.SKIP_UNCHANGED_PUBLISH, connection_rules=None):
+    """
+    Map and publish a single workbook row from workbooks.csv.
+
+    Args:
+        server (TSC.Server): The Tableau Server object.
+        workbook (dict): The workbooks.csv row of the workbook to publish.
+        filesystem_path (str): The path to the file system containing object metadata CSVs and objects to publish.
+        project_index (dict): The target project index built by projects.get_project_index.
+        journal (dict, optional): The run journal, workbooks already published in a resumed run are skipped.
+        mapped_path (str, optional): The workbook already mapped to the target, mapped here when None.
+        skip_unchanged (bool, optional): Skip the upload when the target has the identical workbook and view settings.
+        connection_rules (rules.ConnectionRules, optional): Rules mapping the database connections to the target.
+
+    Returns:
+        dict: Details of the publishing response for the workbook.
+    """
+    journal_key = get_publish_journal_key(server, workbook)
+    record = get_completed_record(journal, journal_key, 'published')
+    if record is not None:
+        return record['Row']
+
+    print(workbook)
+    project_name = workbook['ProjectName']
+    project_id = resolve_project_id(project_index, workbook.get('ProjectPath'), project_name)
+    filePath = workbook['Path']
+    show_tabs = workbook['Show_Tabs']
+    show_tabs = False if show_tabs.lower() == 'false' else True
+    display_views = get_display_views(workbook)
+    hidden_views = []
+    refresh_job_id = None
+    if project_id is not None:
+        try:
+            if mapped_path is None:
+                filePathUpd = update_workbook_mapping(filePath,
+                                                      server.server_address,
+                                                      project_name, filesystem_path,
+                                                      connection_rules=connection_rules,
+                                                      object_id=workbook.get('Id'))
+                record_state(journal, journal_key, 'mapped', Path=filePathUpd)
+            else:
+                filePathUpd = mapped_path
+            # Hide the sheets that were not views on the source, so the workbook is published once
+            if display_views is not None:
+                hidden_views = get_hidden_views(filePathUpd, display_views)
+            if len(hidden_views) > 0:
+                print("hidden_views-publishing", hidden_views)
+            webpage_url, workbook_id, skipped = publish_unless_unchanged(
+                server, server.workbooks, filesystem_path, 'Workbook', project_id, workbook, filePathUpd,
+                lambda: call_with_reauth(server, publish_workbook, server, project_id, filePathUpd,
+                                         show_tabs=show_tabs, hidden_views=hidden_views,
+                                         upload_state_path=get_upload_state_path(filesystem_path)),
+                skip_unchanged, show_tabs=show_tabs, hidden_views=sorted(hidden_views))
+            response = "Success"
+            details = "Workbook unchanged since last publish, upload skipped:" if skipped else "Workbook has been successfully published:"
+            details += str(webpage_url)
+            if not skipped:
+                refresh_job_id, refresh_details = refresh_published(server, workbook, 'Workbook', workbook_id)
+                details += refresh_details
+        except Exception as e:
             response = "Error"
-            details = "Project not found in server:" + str(project_name)
+            details = str(e)
+
+    else:
+        response = "Error"
+        details = get_unresolved_project_details(project_index, workbook.get('ProjectPath'), project_name)
 
-        datasource_details = {'Sno': datasource['Sno'],
-                              'Type': 'Datasource',
-                              'Name': datasource['Name'],
-                              'ProjectName': project_name,
-                              'Path': filePath,
-                              'Response': response,
-                              'Details': details}
-        csvwriter.writerow(datasource_details)
-        response_details.append(datasource_details)
-    return response_details
+    workbook_details = {'Sno': workbook['Sno'],
+                        'Type': 'Workbook',
+                        'Name': workbook['Name'],
+                        'ProjectName': project_name,
+                        'Path': filePath,
+                        'Show_Tabs': show_tabs,
+                        'Hidden_Views': hidden_views,
+                        'Response': response,
+                        'Details': details,
+                        'RefreshJobId': refresh_job_id}
+    record_publish_result(journal, journal_key, workbook_details)
+    return workbook_details
 
 
-def publish_workbooks(server, filesystem_path, project_list, response_details=[], username=None, password=None):
+def publish_workbooks(server, filesystem_path, project_index, results=None, username=None, password=None,
+                      journal=None, skip_unchanged=config.SKIP_UNCHANGED_PUBLISH, connection_rules=None):
     """
     Publish workbooks to Tableau Server based on metadata from flows.csv.
 
     Args:
         server (TSC.Server): The Tableau Server object.
         filesystem_path (str): The path to the file system containing object metadata CSVs and objects to publish.
-        project_list (dict): A dictionary containing project names as keys and project IDs as values.
-        response_details (list, optional): A list to store details of the publishing response. Default is an empty list.
+        project_index (dict): The target project index built by projects.get_project_index.
+        results (results.Results, optional): The sink every publish result is reported to, a new one when None.
+        journal (dict, optional): The run journal recording the state of every object.
+        skip_unchanged (bool, optional): Skip the upload of objects the target already has identical.
+        connection_rules (rules.ConnectionRules, optional): Rules mapping the connections to the target.
 
     Returns:
-        list: A list containing dictionaries with details of the publishing response for each flow.
+        results.Results: The sink with the counts of the published workbooks.
     """
     # Setup download path and CSV output
-    csvreader = read_download_csv(os.path.join(filesystem_path, 'workbooks.csv'))
-    csvwriter = write_publish_csv(os.path.join(filesystem_path, 'workbooks_publish.csv'))
-
-    for workbook in csvreader:
-        print(workbook)
-        project_name = workbook['ProjectName']
-        project_id = project_list.get(project_name)
-        filePath = workbook['Path']
-        show_tabs = workbook['Show_Tabs']
-        show_tabs = False if show_tabs.lower() == 'false' else True
-        display_views = workbook['Views']
-        hidden_views = []
-        if project_id is not None:
-            try:
-                filePathUpd = update_workbook_mapping(filePath,
-                                                      server.server_address)
-                published_workbook = publish_workbook(server, project_id, filePath, show_tabs=show_tabs, hidden_views=hidden_views)
-                server.workbooks.populate_views(published_workbook)
-                for view in published_workbook.views:
-                    if view.name not in display_views:
-                        hidden_views.append(view.name)
-                if len(hidden_views) > 0:
-                    print("hidden_views-publishing", hidden_views)
-                    published_workbook = publish_workbook(server, project_id, filePath, show_tabs=show_tabs, hidden_views=hidden_views)
-                response = "Success"
-                details = "Workbook has been successfully published:"
-                details += str(published_workbook.webpage_url)
-            except Exception as e:
-                response = "Error"
-                details = str(e)
-
-        else:
-            response = "Error"
-            details = "Project not found in server:" + str(project_name)
-
-        workbook_details = {'Sno': workbook['Sno'],
-                            'Type': 'Workbook',
-                            'Name': workbook['Name'],
-                            'ProjectName': project_name,
-                            'Path': filePath,
-                            'Show_Tabs': show_tabs,
-                            'Hidden_Views': hidden_views,
-                            'Response': response,
-                            'Details': details}
-        csvwriter.writerow(workbook_details)
-        response_details.append(workbook_details)
-    return response_details
-
-
-def get_project_list(server):
-    project_list = {}
-    for project in TSC.Pager(server.projects):
-        if project_list.get(project.name) is None:
-            project_list[project.name] = project.id
-        else:
-            print("duplicate", project.name, project_list.get(project.name))
-    return project_list
-
-
-def tabpymigrate_publish(server_address, username=None, password=None, filesystem_path=None, site_id=None, is_personal_access_token=False):
+    results = results if results is not None else Results()
+    with read_download_csv(os.path.join(filesystem_path, 'workbooks.csv')) as csvreader, \
+            write_publish_csv(os.path.join(filesystem_path, 'workbooks_publish.csv')) as csvwriter:
+        for workbook in csvreader:
+            workbook_details = publish_workbook_row(server, workbook, filesystem_path, project_index, journal,
+                                                    skip_unchanged=skip_unchanged, connection_rules=connection_rules)
+            csvwriter.writerow(workbook_details)
+            results.add('publish', workbook_details)
+    return results
+
+
+def publish_with_dependencies(server, filesystem_path, project_index, results=None, publish_workers=1,
+                              journal=None, skip_unchanged=config.SKIP_UNCHANGED_PUBLISH, connection_rules=None,
+                              append_datasources=None):
+    """
+    Publish flows, datasources and workbooks level by level following their datasource dependencies.
+
+    Workbooks and flows which connect to a published datasource of this migration wait until that
+    datasource has been published; every object within a level is published concurrently, the largest
+    first, with the bytes in flight capped by the byte budget of the server.
+
+    Args:
+        server (TSC.Server): The Tableau Server object.
+        filesystem_path (str): The path to the file system containing object metadata CSVs and objects to publish.
+        project_index (dict): The target project index built by projects.get_project_index.
+        results (results.Results, optional): The sink every publish result is reported to, a new one when None.
+        publish_workers (int): Number of objects published in parallel within a level.
+        journal (dict, optional): The run journal recording the state of every object.
+        skip_unchanged (bool, optional): Skip the upload of objects the target already has identical.
+        connection_rules (rules.ConnectionRules, optional): Rules mapping the connections to the target.
+        append_datasources (dict, optional): Watermark columns of the datasources published in append mode by name.
+
+    Returns:
+        results.Results: The sink with the counts of the published objects.
+    """
+    results = results if results is not None else Results()
+    publish_functions = {'Flow': publish_flow_row,
+                         'Datasource': publish_datasource_row,
+                         'Workbook': publish_workbook_row}
+    tasks = build_publish_graph(read_download_rows(os.path.join(filesystem_path, 'flows.csv')),
+                                read_download_rows(os.path.join(filesystem_path, 'datasources.csv')),
+                                read_download_rows(os.path.join(filesystem_path, 'workbooks.csv')))
+
+    def publish(task):
+        return publish_functions[task['Type']](server, task['Row'], filesystem_path, project_index, journal,
+                                               skip_unchanged=skip_unchanged, connection_rules=connection_rules,
+                                               **({'append_datasources': append_datasources}
+                                                  if task['Type'] == 'Datasource' else {}))
+
+    levels = get_publish_levels(tasks)
+    pending = sum(len(level) for level in levels)
+    with write_publish_csv(os.path.join(filesystem_path, 'flows_publish.csv')) as flows_csvwriter, \
+            write_publish_csv(os.path.join(filesystem_path, 'datasources_publish.csv')) as datasources_csvwriter, \
+            write_publish_csv(os.path.join(filesystem_path, 'workbooks_publish.csv')) as workbooks_csvwriter:
+        csvwriters = {'Flow': flows_csvwriter,
+                      'Datasource': datasources_csvwriter,
+                      'Workbook': workbooks_csvwriter}
+        for level, task, object_details in run_levels(levels, publish, publish_workers, get_size=get_task_size,
+                                                      byte_budget=get_byte_budget(server.server_address)):
+            pending -= 1
+            metrics.record_queue_depth('publish', pending)
+            print("Published level", level, object_details)
+            csvwriters[task['Type']].writerow(object_details)
+            results.add('publish', object_details)
+    return results
+
+
+def get_publish_project_paths(filesystem_path):
+    """
+    Collect the source project paths of all objects to publish from the download CSVs.
+
+    Args:
+        filesystem_path (str): The path to the file system containing object metadata CSVs.
+
+    Returns:
+        set: The project paths, or project names for rows downloaded without a path.
+    """
+    project_paths = set()
+    for csv_filename in ['flows.csv', 'datasources.csv', 'workbooks.csv']:
+        for row in read_download_rows(os.path.join(filesystem_path, csv_filename)):
+            if row.get('ProjectPath') or row.get('ProjectName'):
+                project_paths.add(row.get('ProjectPath') or escape_project_name(row['ProjectName']))
+    return project_paths
+
+
+def tabpymigrate_publish(server_address, username=None, password=None, filesystem_path=None, site_id=None, is_personal_access_token=False,
+                         publish_workers=config.PUBLISH_WORKERS, create_projects=config.CREATE_PROJECTS,
+                         skip_unchanged=config.SKIP_UNCHANGED_PUBLISH, wait_for_refresh=config.WAIT_FOR_REFRESH,
+                         connection_rules_file=config.CONNECTION_RULES_FILE, verify=config.VERIFY_PUBLISH,
+                         append_datasources=config.APPEND_DATASOURCES, results=None, journal=None, resume=False):
     try:
-        response_details = []
+        # Sink of the publish results, shared with the download when started from execute
+        results = results if results is not None else Results()
         # Create server and tableau_auth object
-        server, tableau_auth = gettableauauth(server_address, username=username, password=password, site_id=site_id, is_personal_access_token=is_personal_access_token)
-
-        with server.auth.sign_in(tableau_auth):
-            project_list = get_project_list(server)
+        server, tableau_auth = gettableauauth(server_address, username=username, password=password, site_id=site_id, is_personal_access_token=is_personal_access_token,
+                                              workers=publish_workers)
+
+        # Run journal of object states, shared with the download when started from execute
+        if journal is None:
+            journal = open_journal(filesystem_path, resume)
+        # Connection rules compiled once for every object of the publish
+        connection_rules = load_connection_rules(connection_rules_file)
+
+        with sign_in(server, tableau_auth):
+            with metrics.phase('target_projects'):
+                project_index = get_project_index(server, filesystem_path)
+                if create_projects:
+                    create_project_paths(server, project_index, get_publish_project_paths(filesystem_path), filesystem_path)
             print("Starting publish")
             # publish objects to server from filesystem/metadata csv
-            response_details = publish_flows(server, filesystem_path, project_list, response_details)
-            response_details = publish_datasources(server, filesystem_path, project_list, response_details)
-            response_details = publish_workbooks(server, filesystem_path, project_list, response_details, username=username, password=password)
-
-        print(response_details)
-        return "Success", response_details
+            if publish_workers > 1:
+                with metrics.phase('publish_levels'):
+                    publish_with_dependencies(server, filesystem_path, project_index, results,
+                                              publish_workers=publish_workers, journal=journal,
+                                              skip_unchanged=skip_unchanged, connection_rules=connection_rules,
+                                              append_datasources=append_datasources)
+            else:
+                with metrics.phase('publish_flows'):
+                    publish_flows(server, filesystem_path, project_index, results, journal=journal,
+                                  skip_unchanged=skip_unchanged, connection_rules=connection_rules)
+                with metrics.phase('publish_datasources'):
+                    publish_datasources(server, filesystem_path, project_index, results, journal=journal,
+                                        skip_unchanged=skip_unchanged, connection_rules=connection_rules,
+                                        append_datasources=append_datasources)
+                with metrics.phase('publish_workbooks'):
+                    publish_workbooks(server, filesystem_path, project_index, results, username=username, password=password,
+                                      journal=journal, skip_unchanged=skip_unchanged, connection_rules=connection_rules)
+            # Extract refreshes started for objects published without their extract data
+            if wait_for_refresh:
+                wait_for_refresh_jobs(server, filesystem_path, workers=publish_workers)
+            # Published objects checked against one listing of the target
+            if verify:
+                with metrics.phase('verify'):
+                    verify_publish(server, filesystem_path, results=results, journal=journal)
+
+        results.print_summary('publish')
+        return "Success", results
     except Exception as e:
         response_details = "Error in TabPyMigrate Publish Execution:" + str(e)
         print(response_details)
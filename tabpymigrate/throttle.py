@@ -0,0 +1,115 @@
+'''
+    throttle.py
+
+    Per server limits shared by every download and publish worker: a byte budget capping the bytes
+    of the objects being transferred at once, and a requests per second cap applied to every REST
+    request, so parallel workers run at full bandwidth without exhausting memory or tripping the
+    server request throttling.
+'''
+import contextlib
+import threading
+import time
+from typing import Dict
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from . import config
+from . import metrics
+
+
+class ByteBudget(object):
+    '''
+    Cap of the bytes in flight. An object waits until its size fits in the budget; an object larger
+    than the whole budget waits until nothing else is in flight and then goes alone.
+    '''
+
+    def __init__(self, max_bytes=config.MAX_INFLIGHT_BYTES, name='inflight_bytes'):
+        self.max_bytes = max_bytes
+        self.name = name
+        self.inflight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size):
+        with self._condition:
+            if self.max_bytes:
+                self._condition.wait_for(lambda: self.inflight + size <= self.max_bytes or self.inflight == 0)
+            self.inflight += size
+            metrics.record_queue_depth(self.name, self.inflight)
+
+    def release(self, size):
+        with self._condition:
+            self.inflight -= size
+            metrics.record_queue_depth(self.name, self.inflight)
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def reserve(self, size):
+        self.acquire(size)
+        try:
+            yield
+        finally:
+            self.release(size)
+
+
+class RateLimiter(object):
+    '''
+    Token bucket allowing requests_per_second on average with bursts of up to burst requests.
+    '''
+
+    def __init__(self, requests_per_second=config.MAX_REQUESTS_PER_SECOND, burst=None):
+        self.rate = requests_per_second
+        self.burst = burst or max(requests_per_second, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # The token is taken right away, a caller without one sleeps until its token is due
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class ThrottledAdapter(HTTPAdapter):
+    # HTTP adapter taking a token of the server rate limiter before sending every request
+    def __init__(self, rate_limiter=None, **kwargs):
+        self.rate_limiter = rate_limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        return super().send(request, **kwargs)
+
+
+def get_server_key(server_address):
+    url = urlsplit(server_address if '://' in server_address else 'https://' + server_address)
+    return url.netloc.lower()
+
+
+# Limits per server, shared by all sessions and workers talking to the same server
+_byte_budgets: Dict[str, 'ByteBudget'] = {}
+_rate_limiters: Dict[str, 'RateLimiter'] = {}
+_limits_lock = threading.Lock()
+
+
+def get_byte_budget(server_address, max_bytes=config.MAX_INFLIGHT_BYTES):
+    server_key = get_server_key(server_address)
+    with _limits_lock:
+        if server_key not in _byte_budgets:
+            _byte_budgets[server_key] = ByteBudget(max_bytes, name=f"inflight_bytes:{server_key}")
+        return _byte_budgets[server_key]
+
+
+def get_rate_limiter(server_address, requests_per_second=config.MAX_REQUESTS_PER_SECOND):
+    server_key = get_server_key(server_address)
+    with _limits_lock:
+        if server_key not in _rate_limiters:
+            _rate_limiters[server_key] = RateLimiter(requests_per_second)
+        return _rate_limiters[server_key]
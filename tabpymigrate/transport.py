@@ -0,0 +1,111 @@
+'''
+    transport.py
+
+    Shared HTTP transport for the source and target servers: a pooled keep-alive
+    session sized to the worker count and rate limited per server, exponential backoff
+    with jitter that honours Retry-After on 429/502/503/504 (publishes and upload chunks only on 429
+    or Retry-After), and signing in again when the auth token expires.
+'''
+import random
+import threading
+import weakref
+from typing import Union
+import requests
+import tableauserverclient as TSC
+from urllib3.util.retry import Retry
+from . import config
+from . import metrics
+from .throttle import ThrottledAdapter, get_rate_limiter
+
+# Error code of the REST API for a missing, invalid or expired auth token
+TOKEN_EXPIRED_CODE = '401002'
+
+# Methods retried on any retry status: the idempotent methods of urllib3 less PUT, which appends file upload chunks
+RETRY_METHODS = Retry.DEFAULT_ALLOWED_METHODS - {'PUT'}
+
+_server_auth: 'weakref.WeakKeyDictionary[TSC.Server, Union[TSC.TableauAuth, TSC.PersonalAccessTokenAuth]]' = weakref.WeakKeyDictionary()
+_sign_in_lock = threading.Lock()
+
+
+class JitterRetry(Retry):
+    # Exponential backoff capped at RETRY_BACKOFF_MAX with random jitter, so workers don't retry in lockstep
+    def get_backoff_time(self):
+        backoff = min(super().get_backoff_time(), config.RETRY_BACKOFF_MAX)
+        return random.uniform(backoff / 2, backoff)
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if super().is_retry(method, status_code, has_retry_after):
+            return True
+        # A publish or upload chunk failing with 502/503/504 may have been applied already, so requests
+        # outside of the idempotent methods are only retried when refused with 429 or a Retry-After
+        return bool(self.total) and status_code in self.status_forcelist and \
+            (status_code == 429 or (has_retry_after and self.respect_retry_after_header))
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        metrics.record_retry(method, url, status=response.status if response is not None else None,
+                             error=str(error) if error is not None else None)
+        return super().increment(method=method, url=url, response=response, error=error, _pool=_pool,
+                                 _stacktrace=_stacktrace)
+
+
+def get_retry(total=config.RETRY_TOTAL, backoff_factor=config.RETRY_BACKOFF_FACTOR):
+    return JitterRetry(total=total,
+                       backoff_factor=backoff_factor,
+                       status_forcelist=config.RETRY_STATUS_CODES,
+                       allowed_methods=RETRY_METHODS,
+                       respect_retry_after_header=True,
+                       raise_on_status=False)
+
+
+def record_response(response, *args, **kwargs):
+    # Count every REST request with its time to response headers and its request and response bytes
+    request_body = response.request.body
+    metrics.record_request(response.request.method, response.url, response.status_code,
+                           response.elapsed.total_seconds(),
+                           len(request_body) if isinstance(request_body, (bytes, str)) else 0,
+                           int(response.headers.get('Content-Length') or 0))
+
+
+def create_session(pool_size, rate_limiter=None):
+    session = requests.Session()
+    session.hooks['response'].append(record_response)
+    adapter = ThrottledAdapter(rate_limiter, pool_connections=pool_size, pool_maxsize=pool_size,
+                               max_retries=get_retry(), pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_server(server_address, workers=1, requests_per_second=config.MAX_REQUESTS_PER_SECOND):
+    # Connection pool sized to the workers sharing the server, never below the requests default
+    pool_size = max(workers, config.MIN_POOL_SIZE)
+    rate_limiter = get_rate_limiter(server_address, requests_per_second)
+    return TSC.Server(server_address, use_server_version=True,
+                      http_options={'verify': False},
+                      session_factory=lambda: create_session(pool_size, rate_limiter))
+
+
+def sign_in(server, tableau_auth):
+    # Sign in and remember the credentials for signing in again after token expiry
+    _server_auth[server] = tableau_auth
+    return server.auth.sign_in(tableau_auth)
+
+
+def call_with_reauth(server, function, *args, **kwargs):
+    '''
+    Call function, signing in again and retrying once when the server rejects the auth token.
+    '''
+    auth_token = server.auth_token
+    try:
+        return function(*args, **kwargs)
+    except TSC.ServerResponseError as e:
+        if str(e.code) != TOKEN_EXPIRED_CODE or server not in _server_auth:
+            raise
+        print("Auth token expired, signing in again:", server.server_address)
+
+    # Only the first worker hitting the expired token signs in again
+    with _sign_in_lock:
+        if server.auth_token == auth_token:
+            metrics.record_reauth(server.server_address)
+            server.auth.sign_in(_server_auth[server])
+    return function(*args, **kwargs)
@@ -0,0 +1,160 @@
+'''
+    upload.py
+
+    Chunked and resumable publishing of large datasource and workbook files.
+    Files are sent through Tableau file-upload sessions; the session ID and the
+    offset of the last acknowledged chunk are persisted in upload_sessions.json so
+    an interrupted publish resumes from that chunk instead of re-sending the whole file.
+    The server doesn't report how much of a session it holds, so a session with a chunk
+    whose append failed or never returned is dropped and the file is sent to a new session:
+    the server may have applied that chunk, and sending it again would corrupt the file.
+'''
+import json
+import os
+import threading
+import tableauserverclient as TSC
+from tableauserverclient.server import RequestFactory
+from . import config
+from .transport import call_with_reauth
+
+UPLOAD_STATE_FILENAME = 'upload_sessions.json'
+
+_upload_state_lock = threading.Lock()
+
+
+def get_upload_state_path(filesystem_path):
+    return os.path.join(filesystem_path, UPLOAD_STATE_FILENAME)
+
+
+def load_upload_state(state_path):
+    if not os.path.isfile(state_path):
+        return {}
+    with open(state_path, 'r') as state_file:
+        return json.load(state_file)
+
+
+def save_upload_session(state_path, key, session):
+    # Update one session in the state file, written to a temp file and renamed so a crash can't corrupt it
+    with _upload_state_lock:
+        state = load_upload_state(state_path)
+        if session is None:
+            state.pop(key, None)
+        else:
+            state[key] = session
+        temp_path = state_path + '.tmp'
+        with open(temp_path, 'w') as state_file:
+            json.dump(state, state_file, indent=2)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.replace(temp_path, state_path)
+
+
+def is_client_error(error):
+    # The server rejected the request for good, e.g. an upload session which expired or was committed already
+    return isinstance(error, TSC.ServerResponseError) and str(error.code).startswith('4')
+
+
+def get_upload_key(filepath):
+    # A changed file (size or modified time) never resumes an older session
+    file_stat = os.stat(filepath)
+    return f"{os.path.abspath(filepath)}|{file_stat.st_size}|{int(file_stat.st_mtime)}"
+
+
+def upload_file(server, filepath, state_path, chunk_size=config.UPLOAD_CHUNK_SIZE):
+    '''
+    Upload a file in chunks to a file-upload session, resuming a persisted session if there is one.
+    Returns the upload session ID and the key of the session in the state file.
+    '''
+    key = get_upload_key(filepath)
+    with _upload_state_lock:
+        session = load_upload_state(state_path).get(key)
+    # A chunk was in flight when the upload stopped, the offset of the session is unknown
+    if session is not None and session.get('Pending'):
+        print(f"Upload of {filepath} stopped during a chunk, uploading to a new session")
+        session = None
+
+    if session is None:
+        session = {'UploadSessionId': call_with_reauth(server, server.fileuploads.initiate), 'Offset': 0}
+        save_upload_session(state_path, key, session)
+    else:
+        print(f"Resuming upload of {filepath} at byte {session['Offset']}")
+
+    with open(filepath, 'rb') as upload_file_content:
+        upload_file_content.seek(session['Offset'])
+        while True:
+            chunk = upload_file_content.read(chunk_size)
+            if not chunk:
+                break
+            # Marked pending until the server acknowledges the chunk, so a crash never resumes past an unknown offset
+            session['Pending'] = True
+            save_upload_session(state_path, key, session)
+            try:
+                request, content_type = RequestFactory.Fileupload.chunk_req(chunk)
+                call_with_reauth(server, server.fileuploads.append, session['UploadSessionId'], request, content_type)
+            except Exception:
+                # The server may have applied the chunk before the error or lost response, the next attempt
+                # uploads to a new session instead of appending the chunk twice
+                save_upload_session(state_path, key, None)
+                raise
+            session['Offset'] += len(chunk)
+            session['Pending'] = False
+            save_upload_session(state_path, key, session)
+
+    return session['UploadSessionId'], key
+
+
+def publish_with_retries(server, filepath, state_path, publish_upload, chunk_size=config.UPLOAD_CHUNK_SIZE,
+                         retries=config.UPLOAD_RETRIES):
+    '''
+    Upload the file and commit it with publish_upload(upload_session_id), retrying on failure. A retry resumes
+    a session whose chunks were all acknowledged; a session with a failed chunk or whose commit the server
+    rejects is dropped, the next attempt uploads to a new session.
+    '''
+    for attempt in range(1, retries + 2):
+        try:
+            upload_session_id, key = upload_file(server, filepath, state_path, chunk_size=chunk_size)
+            try:
+                published_item = call_with_reauth(server, publish_upload, upload_session_id)
+            except Exception as e:
+                if is_client_error(e):
+                    save_upload_session(state_path, key, None)
+                raise
+            # A committed session is consumed by the server and never resumed
+            save_upload_session(state_path, key, None)
+            return published_item
+        except Exception as e:
+            if attempt > retries:
+                raise
+            print(f"Upload of {filepath} failed (attempt {attempt}), retrying: {str(e)}")
+
+
+def publish_datasource_in_chunks(server, datasource_item, filepath, state_path, mode=TSC.Server.PublishMode.Overwrite,
+                                 chunk_size=config.UPLOAD_CHUNK_SIZE, retries=config.UPLOAD_RETRIES):
+    file_extension = os.path.splitext(filepath)[1][1:]
+
+    def publish_upload(upload_session_id):
+        url = f"{server.datasources.baseurl}?datasourceType={file_extension}&uploadSessionId={upload_session_id}"
+        if mode in (TSC.Server.PublishMode.Overwrite, TSC.Server.PublishMode.Append):
+            url += f"&{mode.lower()}=true"
+        xml_request, content_type = RequestFactory.Datasource.publish_req_chunked(datasource_item)
+        server_response = server.datasources.post_request(url, xml_request, content_type)
+        return TSC.DatasourceItem.from_response(server_response.content, server.namespace)[0]
+
+    return publish_with_retries(server, filepath, state_path, publish_upload, chunk_size=chunk_size, retries=retries)
+
+
+def publish_workbook_in_chunks(server, workbook_item, filepath, state_path, chunk_size=config.UPLOAD_CHUNK_SIZE,
+                               retries=config.UPLOAD_RETRIES):
+    file_extension = os.path.splitext(filepath)[1][1:]
+    if not workbook_item.name:
+        workbook_item.name = os.path.splitext(os.path.basename(filepath))[0]
+
+    def publish_upload(upload_session_id):
+        url = (f"{server.workbooks.baseurl}?workbookType={file_extension}&overwrite=true"
+               f"&skipConnectionCheck=true&uploadSessionId={upload_session_id}")
+        # Hidden views are published from workbook_item.hidden_views
+        xml_request, content_type = RequestFactory.Workbook.publish_req_chunked(workbook_item)
+        server_response = server.workbooks.post_request(url, xml_request, content_type)
+        return TSC.WorkbookItem.from_response(server_response.content, server.namespace)[0]
+
+    return publish_with_retries(server, filepath, state_path, publish_upload, chunk_size=chunk_size, retries=retries)
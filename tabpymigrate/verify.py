@@ -0,0 +1,188 @@
+'''
+    verify.py
+
+    Verification of a publish against the target site. The target is read once after all publishes,
+    by refreshing its inventory snapshot (one paged listing per content type), and every object the
+    publish CSVs report as published is checked in memory: it is in the project it was published
+    to, a workbook has the views of the source, and the object is still the one the publish left,
+    with the id, update time and connection count of the published state. The REST API lists
+    connections one object at a time, so the connection counts of the target are read in batches
+    from the Metadata API. Mismatches go to verify.csv, without a request per object.
+'''
+import ast
+import csv
+import os
+from . import config
+from . import metrics
+from .journal import get_publish_journal_key, record_state
+from .inventory import get_inventory_objects, get_inventory_project_index, refresh_inventory
+from .projects import get_unresolved_project_details, resolve_project_id
+from .results import Results
+from .store import get_published_key, get_published_state_path, load_published_state
+from .transport import call_with_reauth
+
+VERIFY_FILENAME = 'verify.csv'
+VERIFY_FIELDS = ['Sno', 'Type', 'Id', 'Name', 'ProjectName', 'ProjectPath', 'Response', 'Details']
+
+# Download and publish CSVs of every content type and its endpoint
+VERIFY_TYPES = [('Flow', 'flows', 'flows.csv', 'flows_publish.csv'),
+                ('Datasource', 'datasources', 'datasources.csv', 'datasources_publish.csv'),
+                ('Workbook', 'workbooks', 'workbooks.csv', 'workbooks_publish.csv')]
+
+# Metadata API listing of every content type and the upstream objects counted as its connections,
+# as mapping.CONNECTION_COUNTERS counts them in the published file
+CONNECTION_LISTINGS = {'Flow': ('flowsConnection', ['upstreamDatasources', 'upstreamDatabases']),
+                       'Datasource': ('publishedDatasourcesConnection', ['upstreamDatabases']),
+                       'Workbook': ('workbooksConnection', ['embeddedDatasources'])}
+CONNECTION_QUERY = '''query connections($first: Int, $afterToken: String, $luids: [String]) {{
+  {listing}(first: $first, after: $afterToken, filter: {{luidWithin: $luids}}) {{
+    nodes {{ luid {fields} }}
+    pageInfo {{ hasNextPage endCursor }}
+  }}
+}}'''
+# Number of object IDs in one Metadata API filter, also the page size of the query
+CONNECTION_BATCH_SIZE = 100
+
+
+def read_csv_rows(csv_filename):
+    # Rows of a download or publish CSV, none when the object type wasn't downloaded or published
+    if not os.path.isfile(csv_filename):
+        return []
+    with open(csv_filename, 'r', newline='') as csvfile:
+        return list(csv.DictReader(csvfile))
+
+
+def get_view_names(views_column):
+    try:
+        return set(ast.literal_eval(views_column or '[]'))
+    except (ValueError, SyntaxError):
+        return None
+
+
+def get_connection_counts(server, object_type, target_ids, batch_size=CONNECTION_BATCH_SIZE):
+    '''
+    Connection counts of the target objects by ID from the Metadata API. Objects the Metadata API
+    doesn't know yet are left out, and none are returned when it can't be queried.
+    '''
+    listing, fields = CONNECTION_LISTINGS[object_type]
+    query = CONNECTION_QUERY.format(listing=listing, fields=' '.join(field + ' { id }' for field in fields))
+    connection_counts = {}
+    target_ids = sorted(target_ids)
+    try:
+        for start in range(0, len(target_ids), batch_size):
+            variables = {'first': batch_size, 'afterToken': None, 'luids': target_ids[start:start + batch_size]}
+            result = call_with_reauth(server, server.metadata.paginated_query, query, variables, abort_on_error=True)
+            for page in result['pages']:
+                for node in page['data'][listing]['nodes']:
+                    connection_counts[node['luid']] = sum(len(node[field] or []) for field in fields)
+    except Exception as e:
+        print(f"Connection counts of the target {object_type}s not verified, the Metadata API failed: {str(e)}")
+        return {}
+    return connection_counts
+
+
+def get_target_item(row, download_row, project_index, target_objects):
+    # Project ID and target inventory item of a published object, the item is None when not found
+    project_id = resolve_project_id(project_index, download_row.get('ProjectPath'), row['ProjectName'])
+    if project_id is None:
+        return None, None
+    return project_id, target_objects.get((project_id, row['Name']))
+
+
+def verify_object(row, download_row, project_index, target_objects, workbook_views, published_state,
+                  connection_counts=None):
+    '''
+    Check one published object against the target inventory and the connection counts of the target
+    by ID. Returns the target ID and the mismatches.
+    '''
+    project_id, target_item = get_target_item(row, download_row, project_index, target_objects)
+    if project_id is None:
+        return None, [get_unresolved_project_details(project_index, download_row.get('ProjectPath'), row['ProjectName'])]
+    if target_item is None:
+        return None, ["Not found in the target project"]
+
+    mismatches = []
+    # The object published, or left unchanged, by this publish and not changed on the target since.
+    # An extract refresh started by the publish changes the update time, so it is not compared then.
+    record = published_state.get(get_published_key(row['Type'], project_id, row['Name']))
+    if record is not None:
+        updated_at = target_item.updated_at.isoformat() if target_item.updated_at is not None else None
+        if record['Id'] != target_item.id:
+            mismatches.append(f"Target object {target_item.id} is not the published object {record['Id']}")
+        elif record['UpdatedAt'] != updated_at and not row.get('RefreshJobId'):
+            mismatches.append(f"Updated on the target at {updated_at} after the publish at {record['UpdatedAt']}")
+        # Counts are only compared when both are known, records of earlier versions have none
+        expected_connections = record.get('Connections')
+        target_connections = (connection_counts or {}).get(target_item.id)
+        if record['Id'] == target_item.id and expected_connections is not None and target_connections is not None \
+                and expected_connections != target_connections:
+            mismatches.append(f"{target_connections} connections on the target, "
+                              f"{expected_connections} in the published file")
+
+    if row['Type'] == 'Workbook':
+        expected_views = get_view_names(download_row.get('Views'))
+        actual_views = set(workbook_views.get(target_item.id, []))
+        if expected_views and expected_views != actual_views:
+            if expected_views - actual_views:
+                mismatches.append("Missing views:" + str(sorted(expected_views - actual_views)))
+            if actual_views - expected_views:
+                mismatches.append("Unexpected views:" + str(sorted(actual_views - expected_views)))
+    return target_item.id, mismatches
+
+
+def verify_publish(server, filesystem_path, publish_path=None, results=None, stage='verify',
+                   page_size=config.PAGE_SIZE, workers=config.INVENTORY_WORKERS, journal=None):
+    '''
+    Verify the objects published to the signed-in target. The download CSVs are read from
+    filesystem_path, the publish CSVs, published state and verify.csv are in publish_path
+    (filesystem_path by default). Every published object is reported to the results sink
+    under stage with the response Success or Mismatch, and recorded as verified in the
+    journal when it matches. Returns the sink.
+    '''
+    results = results if results is not None else Results()
+    publish_path = publish_path or filesystem_path
+    with metrics.phase('verify_inventory'):
+        # The ids of every object are listed again, an object deleted on the target since is not found
+        inventory = refresh_inventory(server, publish_path, page_size=page_size, workers=workers, sweep_interval=0)
+    project_index = get_inventory_project_index(inventory)
+    published_state = load_published_state(get_published_state_path(publish_path, server))
+    workbook_views = {}
+    for view in inventory['Items']['views'].values():
+        workbook_views.setdefault(view['WorkbookId'], []).append(view['Name'])
+
+    with open(os.path.join(publish_path, VERIFY_FILENAME), 'w', newline='') as verify_file:
+        writer = csv.DictWriter(verify_file, fieldnames=VERIFY_FIELDS)
+        writer.writeheader()
+        for object_type, endpoint_name, download_csv, publish_csv in VERIFY_TYPES:
+            target_objects = get_inventory_objects(inventory, endpoint_name)
+            download_rows = {row['Sno']: row for row in read_csv_rows(os.path.join(filesystem_path, download_csv))}
+            published_rows = [row for row in read_csv_rows(os.path.join(publish_path, publish_csv))
+                              if row['Response'] == "Success"]
+            # Connection counts of every published object found on the target, one query per batch of IDs
+            target_ids = set()
+            for row in published_rows:
+                _, target_item = get_target_item(row, download_rows.get(row['Sno'], {}), project_index,
+                                                 target_objects)
+                if target_item is not None:
+                    target_ids.add(target_item.id)
+            with metrics.phase('verify_connections'):
+                connection_counts = get_connection_counts(server, object_type, target_ids) if target_ids else {}
+            for row in published_rows:
+                download_row = download_rows.get(row['Sno'], {})
+                target_id, mismatches = verify_object(row, download_row, project_index, target_objects,
+                                                      workbook_views, published_state, connection_counts)
+                object_details = {'Sno': row['Sno'],
+                                  'Type': object_type,
+                                  'Id': target_id,
+                                  'Name': row['Name'],
+                                  'ProjectName': row['ProjectName'],
+                                  'ProjectPath': download_row.get('ProjectPath'),
+                                  'Response': "Mismatch" if mismatches else "Success",
+                                  'Details': '; '.join(mismatches)}
+                writer.writerow(object_details)
+                results.add(stage, object_details)
+                # A resumed run returns the publish row of a verified object instead of publishing it again
+                if not mismatches and download_row:
+                    record_state(journal, get_publish_journal_key(server, download_row), 'verified', Row=row)
+    results.print_summary(stage)
+    return results
@@ -0,0 +1,83 @@
+import io
+import os
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+from tabpymigrate import mapping
+
+
+class CopyZipMemberTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.source_path = os.path.join(self.temp_dir.name, 'source.tflx')
+        self.target_path = os.path.join(self.temp_dir.name, 'target.tflx')
+        self.members = {'flow': b'{"nodes": {}}' * 100, 'Data/Extracts/extract.hyper': os.urandom(4096)}
+        with zipfile.ZipFile(self.source_path, 'w') as source_zip:
+            source_zip.writestr('flow', self.members['flow'], compress_type=zipfile.ZIP_DEFLATED)
+            source_zip.writestr('Data/Extracts/extract.hyper', self.members['Data/Extracts/extract.hyper'],
+                                compress_type=zipfile.ZIP_STORED)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def copy_members(self):
+        with zipfile.ZipFile(self.source_path) as source_zip, \
+                zipfile.ZipFile(self.target_path, 'w', zipfile.ZIP_DEFLATED) as target_zip:
+            for zip_info in source_zip.infolist():
+                mapping.copy_zip_member(source_zip, target_zip, zip_info)
+        with zipfile.ZipFile(self.target_path) as target_zip:
+            self.assertIsNone(target_zip.testzip())
+            self.assertEqual({info.filename: info.compress_type for info in target_zip.infolist()},
+                             {'flow': zipfile.ZIP_DEFLATED, 'Data/Extracts/extract.hyper': zipfile.ZIP_STORED})
+            return {name: target_zip.read(name) for name in target_zip.namelist()}
+
+    def test_copy_raw(self):
+        self.assertTrue(mapping.RAW_COPY_SUPPORTED)
+        with mock.patch.object(mapping, 'copy_zip_member_decompressed') as copy_decompressed:
+            self.assertEqual(self.members, self.copy_members())
+        copy_decompressed.assert_not_called()
+
+    def test_copy_without_zipfile_internals(self):
+        with mock.patch.object(mapping, 'RAW_COPY_SUPPORTED', False), \
+                mock.patch.object(mapping, 'copy_zip_member_decompressed',
+                                  wraps=mapping.copy_zip_member_decompressed) as copy_decompressed:
+            self.assertEqual(self.members, self.copy_members())
+        self.assertEqual(2, copy_decompressed.call_count)
+
+
+class RewriteConnectionsTests(unittest.TestCase):
+    def rewrite(self, xml, get_attribute_updates):
+        source, target = io.BytesIO(xml), io.BytesIO()
+        connection_count = mapping.rewrite_connections(source, target, get_attribute_updates, block_size=16)
+        return connection_count, target.getvalue()
+
+    def test_connection_customization_not_rewritten(self):
+        xml = (b"<datasource><connection class='postgres' server='source' dbname='warehouse'>"
+               b"<connection-customization class='postgres' enabled='false' version='18.1'/>"
+               b"</connection><connection class='hyper' dbname='extract.hyper'/></datasource>")
+
+        def get_attribute_updates(attributes):
+            return {'class': 'sqlserver'}
+
+        connection_count, rewritten = self.rewrite(xml, get_attribute_updates)
+        self.assertEqual(2, connection_count)
+        self.assertEqual(xml.replace(b"<connection class='postgres'", b"<connection class='sqlserver'")
+                            .replace(b"<connection class='hyper'", b"<connection class='sqlserver'"), rewritten)
+        self.assertIn(b"<connection-customization class='postgres'", rewritten)
+
+
+class ConnectionCountTests(unittest.TestCase):
+    def test_datasource_connections_leave_out_federated_and_extract(self):
+        tds = (b"<datasource><connection class='federated'><named-connections>"
+               b"<named-connection name='a'><connection class='postgres' server='db' dbname='sales'/></named-connection>"
+               b"<named-connection name='b'><connection class='postgres' server='db' dbname='sales'/></named-connection>"
+               b"<named-connection name='c'><connection class='sqlserver' server='mssql' dbname='hr'/>"
+               b"</named-connection></named-connections></connection>"
+               b"<extract enabled='true'><connection class='hyper' dbname='Data/Extracts/extract.hyper'/></extract>"
+               b"</datasource>")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            datasource_path = os.path.join(temp_dir, 'source.tdsx')
+            with zipfile.ZipFile(datasource_path, 'w') as datasource_zip:
+                datasource_zip.writestr('source.tds', tds)
+            self.assertEqual(2, mapping.get_connection_count('Datasource', datasource_path))
@@ -0,0 +1,81 @@
+import os
+import re
+import tempfile
+import unittest
+import requests
+from tabpymigrate.upload import get_upload_key, load_upload_state, publish_with_retries, save_upload_session
+
+FILE_PART = re.compile(rb'name="tableau_file"; filename="file"\r\nContent-Type: [^\r]*\r\n\r\n(.*)\r\n--', re.S)
+
+
+class FileUploads(object):
+    # File-upload sessions of a server which applies the chunks of the appends listed in lost_responses
+    # and then fails as if the response was lost on the way back
+    def __init__(self, lost_responses=()):
+        self.sessions = {}
+        self.appends = 0
+        self.lost_responses = set(lost_responses)
+
+    def initiate(self):
+        upload_session_id = f"session{len(self.sessions)}"
+        self.sessions[upload_session_id] = b''
+        return upload_session_id
+
+    def append(self, upload_session_id, request, content_type):
+        self.sessions[upload_session_id] += FILE_PART.search(request).group(1)
+        self.appends += 1
+        if self.appends in self.lost_responses:
+            raise requests.exceptions.ConnectionError("Connection reset by peer")
+
+
+class Server(object):
+    auth_token = 'token'
+
+    def __init__(self, fileuploads):
+        self.fileuploads = fileuploads
+
+
+class UploadTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.state_path = os.path.join(self.temp_dir.name, 'upload_sessions.json')
+        self.filepath = os.path.join(self.temp_dir.name, 'datasource.tdsx')
+        self.content = bytes(range(26)) * 4
+        with open(self.filepath, 'wb') as upload_file:
+            upload_file.write(self.content)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def publish(self, fileuploads, retries=1):
+        server = Server(fileuploads)
+        return publish_with_retries(server, self.filepath, self.state_path,
+                                    lambda upload_session_id: fileuploads.sessions[upload_session_id],
+                                    chunk_size=10, retries=retries)
+
+    def test_chunk_applied_and_response_lost(self):
+        # The second chunk reaches the server but its response is lost, it must not be appended twice
+        fileuploads = FileUploads(lost_responses=[2])
+        self.assertEqual(self.content, self.publish(fileuploads))
+        self.assertEqual(2, len(fileuploads.sessions))
+        self.assertEqual({}, load_upload_state(self.state_path))
+
+    def test_resume_acknowledged_chunks(self):
+        # A session with every chunk acknowledged resumes at its offset
+        fileuploads = FileUploads()
+        upload_session_id = fileuploads.initiate()
+        fileuploads.sessions[upload_session_id] = self.content[:20]
+        save_upload_session(self.state_path, get_upload_key(self.filepath),
+                            {'UploadSessionId': upload_session_id, 'Offset': 20, 'Pending': False})
+        self.assertEqual(self.content, self.publish(fileuploads, retries=0))
+        self.assertEqual(1, len(fileuploads.sessions))
+
+    def test_pending_chunk_not_resumed(self):
+        # A chunk was in flight when the run stopped, the session may hold it already
+        fileuploads = FileUploads()
+        upload_session_id = fileuploads.initiate()
+        fileuploads.sessions[upload_session_id] = self.content[:30]
+        save_upload_session(self.state_path, get_upload_key(self.filepath),
+                            {'UploadSessionId': upload_session_id, 'Offset': 20, 'Pending': True})
+        self.assertEqual(self.content, self.publish(fileuploads, retries=0))
+        self.assertEqual(2, len(fileuploads.sessions))